@@ -0,0 +1,2 @@
+from .errors import MakeloveError, ConfigError, HookError, DownloadError, BuildError
+from .makelove import build, BuildResult, TargetResult, Artifact
@@ -0,0 +1,161 @@
+import hashlib
+import os
+import shutil
+from collections import namedtuple
+
+from PIL import Image, UnidentifiedImageError
+
+from .binarycache import CacheEntry, ensure, get_cache_dir
+from .errors import BuildError, ConfigError
+from .filelist import get_matching_files
+
+# Bump this if the packing or the output changes, so cached atlases are not used
+atlas_version = "1"
+
+Sprite = namedtuple("Sprite", ["path", "width", "height"])
+
+# page is the index of the page in the list of pages
+Placement = namedtuple("Placement", ["sprite", "page", "x", "y"])
+
+
+def pack_shelves(sprites, max_size, padding):
+    """
+    Packs the sprites into pages of at most max_size x max_size pixels with a
+    shelf packer: sprites are sorted by height and placed left to right in rows
+    (shelves), each as high as its first sprite. Returns the placements and the
+    (width, height) of every page.
+    """
+    placements = []
+    pages = []
+    x, y, shelf_height = 0, 0, 0
+    page_width, page_height = 0, 0
+    for sprite in sorted(sprites, key=lambda s: (-s.height, -s.width, s.path)):
+        if sprite.width > max_size or sprite.height > max_size:
+            raise BuildError(
+                "'{}' ({}x{}) is larger than the atlas page size {}".format(
+                    sprite.path, sprite.width, sprite.height, max_size
+                )
+            )
+        if x + sprite.width > max_size:
+            x, y, shelf_height = 0, y + shelf_height, 0
+        if y + sprite.height > max_size:
+            pages.append((page_width, page_height))
+            x, y, shelf_height = 0, 0, 0
+            page_width, page_height = 0, 0
+
+        placements.append(Placement(sprite, len(pages), x, y))
+        page_width = max(page_width, x + sprite.width)
+        page_height = max(page_height, y + sprite.height)
+        x += sprite.width + padding
+        shelf_height = max(shelf_height, sprite.height + padding)
+
+    if len(placements) > 0:
+        pages.append((page_width, page_height))
+    return placements, pages
+
+
+def lua_string(s):
+    return '"{}"'.format(s.replace("\\", "\\\\").replace('"', '\\"'))
+
+
+def get_lua_table(placements, pages, page_files):
+    lines = ["-- Generated by makelove, do not edit", "return {", "    pages = {"]
+    for page_file, (width, height) in zip(page_files, pages):
+        lines.append(
+            "        {{ file = {}, width = {}, height = {} }},".format(
+                lua_string(page_file), width, height
+            )
+        )
+    lines.append("    },")
+    lines.append("    quads = {")
+    quad = "        [{}] = {{ page = {}, x = {}, y = {}, width = {}, height = {} }},"
+    for p in sorted(placements, key=lambda p: p.sprite.path):
+        lines.append(
+            quad.format(
+                lua_string(p.sprite.path),
+                p.page + 1,
+                p.x,
+                p.y,
+                p.sprite.width,
+                p.sprite.height,
+            )
+        )
+    lines.append("    },")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def load_sprites(game_directory, paths):
+    sprites = []
+    for path in paths:
+        try:
+            with Image.open(os.path.join(game_directory, path)) as image:
+                width, height = image.size
+        except (UnidentifiedImageError, OSError) as exc:
+            raise BuildError("Could not load '{}' for the atlas: {}".format(path, exc))
+        # Paths as löve's filesystem uses them
+        sprites.append(Sprite(path.replace(os.sep, "/"), width, height))
+    return sprites
+
+
+def get_atlas_key(game_directory, paths, params):
+    key = hashlib.sha256(repr((atlas_version, params)).encode("utf-8"))
+    for path in paths:
+        key.update(path.encode("utf-8") + b"\0")
+        with open(os.path.join(game_directory, path), "rb") as f:
+            key.update(hashlib.sha256(f.read()).digest())
+    return key.hexdigest()
+
+
+def build_atlas(config, game_directory):
+    """
+    Packs the images in game_directory that match atlas.files into atlas pages,
+    removes them from game_directory and adds the pages and a Lua module
+    (atlas.output + ".lua") with the position of every image on its page.
+    Atlases are cached by the content of the images.
+    """
+    section = config["atlas"]
+    if not "files" in section:
+        raise ConfigError("atlas.files has to be specified")
+    paths = get_matching_files(game_directory, section["files"])
+    if len(paths) == 0:
+        print("No images to pack into the atlas")
+        return
+
+    max_size = section.get("max_size", 2048)
+    padding = section.get("padding", 1)
+    output = section.get("output", "atlas")
+
+    def populate(path):
+        page_files = []
+        sprites = load_sprites(game_directory, paths)
+        placements, pages = pack_shelves(sprites, max_size, padding)
+        for i, size in enumerate(pages):
+            page_files.append("{}_{}.png".format(output, i + 1))
+            page = Image.new("RGBA", size)
+            for placement in placements:
+                if placement.page != i:
+                    continue
+                sprite_path = os.path.join(game_directory, placement.sprite.path)
+                with Image.open(sprite_path) as image:
+                    page.paste(image.convert("RGBA"), (placement.x, placement.y))
+            page.save(os.path.join(path, "page_{}.png".format(i + 1)), optimize=True)
+        with open(os.path.join(path, "atlas.lua"), "w", encoding="utf-8") as f:
+            f.write(get_lua_table(placements, pages, page_files))
+
+    key = get_atlas_key(game_directory, paths, (max_size, padding, output))
+    cache_path = os.path.join(get_cache_dir(), "atlas", key)
+    atlas_path = ensure(CacheEntry(cache_path, populate))
+
+    for path in paths:
+        os.remove(os.path.join(game_directory, path))
+    output_path = os.path.join(game_directory, output)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    shutil.copyfile(os.path.join(atlas_path, "atlas.lua"), output_path + ".lua")
+    num_pages = len([f for f in os.listdir(atlas_path) if f.startswith("page_")])
+    for i in range(1, num_pages + 1):
+        shutil.copyfile(
+            os.path.join(atlas_path, "page_{}.png".format(i)),
+            "{}_{}.png".format(output_path, i),
+        )
+    print("Packed {} images into {} atlas pages".format(len(paths), num_pages))
@@ -0,0 +1,228 @@
+import contextvars
+import io
+import json
+import os
+import sys
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import toml
+
+from . import validators as val
+from .config import all_targets
+from .errors import ConfigError, MakeloveError
+from .makelove import build
+from .util import format_size
+
+batch_params = {
+    "max_parallel": val.Int(),
+    "targets": val.List(val.Choice(*all_targets)),
+    "disabled_hooks": val.List(val.Choice("prebuild", "postbuild", "all")),
+    "project": val.List(
+        val.Section(
+            {
+                "path": val.Path(),
+                "name": val.String(),
+                "config": val.Path(),
+                "targets": val.List(val.Choice(*all_targets)),
+                "version": val.String(),
+                "disabled_hooks": val.List(val.Choice("prebuild", "postbuild", "all")),
+            }
+        )
+    ),
+}
+
+Project = namedtuple(
+    "Project", ["name", "path", "config", "targets", "version", "disabled_hooks"]
+)
+
+ProjectReport = namedtuple(
+    "ProjectReport", ["project", "result", "error", "log", "duration"]
+)
+
+
+class ThreadOutput(object):
+    """
+    Replaces sys.stdout, so the output of the builds running in parallel can be
+    collected per thread. Threads that did not call capture() write through.
+    The buffer is stored in a context variable, so threads that run functions
+    in a copy of the context (like the hooks and downloads of a build) write
+    into the buffer of the build as well.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = contextvars.ContextVar("buffer", default=None)
+
+    def capture(self, buffer):
+        self.buffer.set(buffer)
+
+    def is_capturing(self):
+        return self.buffer.get() != None
+
+    def write(self, s):
+        return (self.buffer.get() or self.stream).write(s)
+
+    def flush(self):
+        (self.buffer.get() or self.stream).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def load_batch_file(path):
+    if not os.path.isfile(path):
+        raise ConfigError("Batch file '{}' does not exist".format(path))
+    with open(path) as f:
+        batch = toml.load(f)
+    try:
+        val.Section(batch_params).validate(batch)
+    except ValueError as exc:
+        raise ConfigError("Could not parse batch file:\n{}".format(exc))
+
+    # Project paths are relative to the batch file
+    base_dir = os.path.dirname(os.path.abspath(path))
+    projects = []
+    for entry in batch.get("project", []):
+        if not "path" in entry:
+            raise ConfigError("Every project in '{}' needs a path".format(path))
+        project_path = os.path.normpath(os.path.join(base_dir, entry["path"]))
+        name = entry.get("name", os.path.basename(project_path))
+        if any(p.name == name for p in projects):
+            raise ConfigError("Duplicate project name '{}' in '{}'".format(name, path))
+        projects.append(
+            Project(
+                name,
+                project_path,
+                entry.get("config"),
+                entry.get("targets", batch.get("targets")),
+                entry.get("version"),
+                entry.get("disabled_hooks", batch.get("disabled_hooks", [])),
+            )
+        )
+    return batch, projects
+
+
+def build_project(project, output, force):
+    buffer = io.StringIO()
+    output.capture(buffer)
+    start_time = time.monotonic()
+    result, error = None, None
+    try:
+        result = build(
+            project.path,
+            project.config,
+            targets=project.targets,
+            version=project.version,
+            force=force,
+            disabled_hooks=project.disabled_hooks,
+        )
+    except MakeloveError as exc:
+        error = str(exc)
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        output.capture(None)
+    return ProjectReport(
+        project, result, error, buffer.getvalue(), time.monotonic() - start_time
+    )
+
+
+def run_batch(projects, max_parallel, force=False):
+    """
+    Builds all projects in one process with up to max_parallel builds at the
+    same time, so the imported modules, the download cache, the löve release
+    metadata and the icon and precompression caches are shared between them.
+    Returns a ProjectReport for every project (in the order of projects).
+    """
+    output = ThreadOutput(sys.stdout)
+    sys.stdout = output
+    reports = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            futures = [
+                executor.submit(build_project, project, output, force)
+                for project in projects
+            ]
+            for future in as_completed(futures):
+                report = future.result()
+                reports[report.project.name] = report
+                if report.error != None:
+                    print(report.log, end="")
+                    print("[{}] FAILED: {}".format(report.project.name, report.error))
+                else:
+                    print(
+                        "[{}] done in {:.1f}s".format(
+                            report.project.name, report.duration
+                        )
+                    )
+    finally:
+        sys.stdout = output.stream
+    return [reports[project.name] for project in projects]
+
+
+def get_report_data(reports):
+    data = []
+    for report in reports:
+        entry = {
+            "name": report.project.name,
+            "path": report.project.path,
+            "success": report.error == None,
+            "duration": round(report.duration, 3),
+            "error": report.error,
+            "targets": [],
+        }
+        if report.result != None:
+            entry["version"] = report.result.version
+            for target in report.result.targets:
+                entry["targets"].append(
+                    {
+                        "target": target.target,
+                        "duration": round(target.duration, 3),
+                        "artifacts": [
+                            {"path": a.path, "size": a.size} for a in target.artifacts
+                        ],
+                    }
+                )
+        data.append(entry)
+    return data
+
+
+def print_report(reports, duration):
+    print()
+    row = "{:<30} {:<8} {:>7.1f}s {:>10}  {}"
+    print("{:<30} {:<8} {:>8} {:>10}  {}".format("Project", "Status", "Time", "Size", "Targets"))
+    for report in reports:
+        if report.result != None:
+            size = sum(
+                a.size for target in report.result.targets for a in target.artifacts
+            )
+            targets = ", ".join(target.target for target in report.result.targets)
+            print(
+                row.format(
+                    report.project.name, "ok", report.duration, format_size(size), targets
+                )
+            )
+        else:
+            print(
+                row.format(
+                    report.project.name,
+                    "FAILED",
+                    report.duration,
+                    "-",
+                    report.error.strip().splitlines()[-1],
+                )
+            )
+    failed = sum(1 for report in reports if report.error != None)
+    print(
+        "{} projects built in {:.1f}s, {} failed".format(
+            len(reports) - failed, duration, failed
+        )
+    )
+
+
+def write_report(path, reports):
+    with open(path, "w") as f:
+        json.dump(get_report_data(reports), f, indent=4)
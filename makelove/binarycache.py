@@ -0,0 +1,340 @@
+import contextvars
+import hashlib
+import os
+import shutil
+import sys
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import appdirs
+
+from .util import getenv, parse_size
+
+# Every cache entry is a directory, which is populated in a temporary directory
+# next to it and then renamed into place. The completion marker is written last,
+# so a directory without one is a leftover from an interrupted download.
+# Partial downloads (*.part) in the temporary directory are kept if populating
+# fails, so the download can be resumed next time.
+complete_marker = ".makelove-complete"
+
+# populate is a function that takes the path of an (empty) directory and fills it
+CacheEntry = namedtuple("CacheEntry", ["path", "populate"])
+
+# In these directories every file is a cache entry of its own
+file_cache_dirs = ["precompressed", "json", "icons", "bytecode", "images"]
+
+CacheInfo = namedtuple("CacheInfo", ["path", "size", "last_used"])
+
+# Builds do not hold a lock while they read from an entry, so entries that were
+# used (see touch) this many seconds ago or less are never pruned
+min_prune_age = 10 * 60
+
+
+def get_cache_dir():
+    return appdirs.user_cache_dir("makelove")
+
+
+class FileLock(object):
+    """
+    An exclusive lock between processes (and threads, since every FileLock opens
+    its own file) that is released when the process dies.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def _lock(self, blocking):
+        if sys.platform.startswith("win"):
+            import msvcrt
+
+            while True:
+                try:
+                    mode = msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK
+                    msvcrt.locking(self.file.fileno(), mode, 1)
+                    return True
+                except OSError:  # LK_LOCK gives up after 10 seconds
+                    if not blocking:
+                        return False
+        else:
+            import fcntl
+
+            try:
+                flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+                fcntl.flock(self.file.fileno(), flags)
+                return True
+            except BlockingIOError:
+                return False
+
+    def _unlock(self):
+        if sys.platform.startswith("win"):
+            import msvcrt
+
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+    def acquire(self, blocking=True):
+        # Returns whether the lock was acquired (always true if blocking)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        while True:
+            self.file = open(self.path, "a+b")
+            if not self._lock(blocking):
+                self.file.close()
+                self.file = None
+                return False
+            # The lock file might have been removed (see remove_entry) while
+            # waiting for it, then the lock has to be taken on the new file
+            try:
+                if os.path.samestat(os.fstat(self.file.fileno()), os.stat(self.path)):
+                    return True
+            except FileNotFoundError:
+                pass
+            self._unlock()
+
+    def release(self):
+        self._unlock()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+
+def _clear_tmp_directory(path):
+    for name in os.listdir(path):
+        if name.endswith(".part"):
+            continue
+        item_path = os.path.join(path, name)
+        if os.path.isdir(item_path) and not os.path.islink(item_path):
+            shutil.rmtree(item_path)
+        else:
+            os.remove(item_path)
+
+
+def is_complete(path):
+    return os.path.isfile(os.path.join(path, complete_marker))
+
+
+def touch(path):
+    # Records the use of a cache entry (by updating the modification time of its
+    # completion marker), which is used to find the least recently used entries.
+    if os.path.isdir(path):
+        path = os.path.join(path, complete_marker)
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def ensure(entry):
+    if is_complete(entry.path):
+        touch(entry.path)
+        return entry.path
+
+    with FileLock(entry.path + ".lock"):
+        # Another process might have populated it while we were waiting
+        if is_complete(entry.path):
+            return entry.path
+
+        # Only the holder of the lock uses the temporary directory
+        tmp_path = entry.path + ".tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        _clear_tmp_directory(tmp_path)
+        try:
+            entry.populate(tmp_path)
+            open(os.path.join(tmp_path, complete_marker), "w").close()
+        except BaseException:
+            _clear_tmp_directory(tmp_path)
+            raise
+
+        if os.path.exists(entry.path):
+            # Incomplete leftover or a cache directory of an older makelove version
+            shutil.rmtree(entry.path)
+        os.rename(tmp_path, entry.path)
+    return entry.path
+
+
+def get_converted_file(source_path, cache_name, extension, convert, key=""):
+    """
+    Returns the path of a cached conversion of source_path (e.g. an icon in
+    another format), which is created with convert(source_path, path) if
+    necessary. Conversions are cached by the content hash of the source, so
+    builds (and projects) with the same source only convert it once.
+    key has to contain everything else the result depends on (e.g. options).
+    """
+    source_hash = hashlib.sha256(key.encode("utf-8"))
+    with open(source_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            source_hash.update(chunk)
+
+    cache_path = os.path.join(
+        get_cache_dir(), cache_name, source_hash.hexdigest() + extension
+    )
+    if os.path.isfile(cache_path):
+        touch(cache_path)
+        return cache_path
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = "{}.{}.tmp{}".format(cache_path, uuid.uuid4().hex, extension)
+    try:
+        convert(source_path, tmp_path)
+        os.replace(tmp_path, cache_path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+    return cache_path
+
+
+def get_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _dirs, files in os.walk(path):
+        for f in files:
+            file_path = os.path.join(root, f)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+def get_lock_path(path):
+    # The lock of a directory entry is held while it is populated (in its
+    # temporary directory) and removed
+    if path.endswith(".tmp"):
+        path = path[: -len(".tmp")]
+    elif path.endswith(".lock"):
+        path = path[: -len(".lock")]
+    return path + ".lock"
+
+
+def is_orphaned_lock(path):
+    entry_path = path[: -len(".lock")]
+    return not os.path.exists(entry_path) and not os.path.exists(entry_path + ".tmp")
+
+
+def list_entries():
+    """
+    Returns all cache entries, including leftover temporary directories (e.g.
+    with partial downloads) and lock files of entries that do not exist anymore.
+    """
+    cache_dir = get_cache_dir()
+    entries = []
+    for root, dirs, files in os.walk(cache_dir):
+        if os.path.relpath(root, cache_dir) in file_cache_dirs:
+            for f in files:
+                path = os.path.join(root, f)
+                stat = os.stat(path)
+                entries.append(CacheInfo(path, stat.st_size, stat.st_mtime))
+            dirs.clear()
+        elif complete_marker in files:
+            last_used = os.path.getmtime(os.path.join(root, complete_marker))
+            entries.append(CacheInfo(root, get_size(root), last_used))
+            dirs.clear()
+        else:
+            for d in [d for d in dirs if d.endswith(".tmp")]:
+                path = os.path.join(root, d)
+                entries.append(CacheInfo(path, get_size(path), os.path.getmtime(path)))
+                dirs.remove(d)
+            for f in files:
+                path = os.path.join(root, f)
+                if f.endswith(".lock") and is_orphaned_lock(path):
+                    stat = os.stat(path)
+                    entries.append(CacheInfo(path, stat.st_size, stat.st_mtime))
+    return entries
+
+
+def remove_entry(path):
+    """
+    Removes a cache entry, unless another thread or process holds its lock
+    (because it is populating it). Returns whether it was removed.
+    """
+    if not os.path.isdir(path) and not path.endswith(".lock"):
+        os.remove(path)
+        return True
+
+    lock_path = get_lock_path(path)
+    lock = FileLock(lock_path)
+    if not lock.acquire(blocking=False):
+        return False
+    try:
+        if path != lock_path:
+            if is_complete(path):
+                # Remove the marker first, so the entry is never used half-deleted
+                os.remove(os.path.join(path, complete_marker))
+            shutil.rmtree(path)
+        elif not is_orphaned_lock(path):
+            return False
+        if is_orphaned_lock(lock_path):
+            try:
+                os.remove(lock_path)
+            except OSError:  # Windows can not remove open files
+                return path != lock_path
+    finally:
+        lock.release()
+    return True
+
+
+def prune(max_size):
+    """
+    Removes the least recently used cache entries (that are not in use and were
+    not used in the last min_prune_age seconds) until the cache is not larger
+    than max_size bytes. Lock files of entries that do not exist anymore are
+    always removed. Returns the removed entries.
+    """
+    entries = sorted(list_entries(), key=lambda e: e.last_used)
+    total_size = sum(entry.size for entry in entries)
+    removed = []
+    now = time.time()
+    for entry in entries:
+        orphaned_lock = entry.path.endswith(".lock")
+        if total_size <= max_size and not orphaned_lock:
+            continue
+        if not orphaned_lock and now - entry.last_used < min_prune_age:
+            continue
+        if remove_entry(entry.path):
+            total_size -= entry.size
+            removed.append(entry)
+    return removed
+
+
+def prune_from_environment():
+    max_size = getenv("MAKELOVE_CACHE_MAX_SIZE")
+    if max_size:
+        for entry in prune(parse_size(max_size)):
+            print("Removed '{}' from the cache".format(entry.path))
+
+
+class Prefetch(object):
+    """
+    Populates all given cache entries in parallel in the background.
+    wait() waits until all of them are complete and re-raises errors.
+    """
+
+    def __init__(self, entries):
+        unique_entries = {}
+        for entry in entries:
+            unique_entries.setdefault(entry.path, entry)
+
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(unique_entries)))
+        # In a copy of the context, so captured output stays captured
+        self.futures = [
+            self.executor.submit(contextvars.copy_context().run, ensure, entry)
+            for entry in unique_entries.values()
+        ]
+
+    def wait(self):
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.executor.shutdown()
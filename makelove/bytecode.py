@@ -0,0 +1,74 @@
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from .binarycache import get_converted_file
+from .errors import BuildError, ConfigError
+from .filelist import get_matching_files
+
+# love.js runs PUC Lua compiled to JavaScript, which can not load LuaJIT bytecode
+default_bytecode_targets = ["win32", "win64", "appimage", "macos"]
+
+
+def target_uses_bytecode(config, target):
+    if not "bytecode" in config:
+        return False
+    return config.get(target, {}).get("bytecode", target in default_bytecode_targets)
+
+
+def get_compiler(config):
+    compiler = config["bytecode"].get("compiler", "luajit")
+    compiler_path = shutil.which(compiler)
+    if compiler_path == None:
+        raise ConfigError(
+            "Could not find the Lua bytecode compiler '{}'. ".format(compiler)
+            + "Install LuaJIT or set bytecode.compiler."
+        )
+    return compiler_path
+
+
+def compile_file(compiler, flags, game_directory, path):
+    def convert(source_path, output_path):
+        # The compiler runs in the game directory, so the chunk names (in error
+        # messages and tracebacks) are the paths inside the .love, like löve's own
+        res = subprocess.run(
+            [compiler, "-b"] + flags + ["-t", "raw", path, output_path],
+            cwd=game_directory,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+        if res.returncode != 0:
+            raise BuildError(
+                "Could not compile '{}' to bytecode:\n{}".format(path, res.stdout)
+            )
+
+    # The bytecode depends on the compiler (version) and the chunk name as well
+    stat = os.stat(compiler)
+    key = "\0".join(
+        [compiler, str(stat.st_size), str(stat.st_mtime_ns), path] + flags
+    )
+    return get_converted_file(
+        os.path.join(game_directory, path), "bytecode", ".luac", convert, key
+    )
+
+
+def compile_game_directory(config, game_directory):
+    """
+    Compiles the Lua files in game_directory that match bytecode.files and
+    returns a dict of their paths (relative to game_directory) to the compiled
+    files in the cache. The compiler runs as up to bytecode.max_parallel
+    processes at once.
+    """
+    compiler = get_compiler(config)
+    flags = ["-g"] if config["bytecode"].get("debug_info", False) else ["-s"]
+    paths = get_matching_files(
+        game_directory, config["bytecode"].get("files", ["*.lua"])
+    )
+    max_parallel = config["bytecode"].get("max_parallel", os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel)) as executor:
+        compiled = executor.map(
+            lambda path: compile_file(compiler, flags, game_directory, path), paths
+        )
+        return dict(zip(paths, compiled))
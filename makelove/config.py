@@ -7,6 +7,7 @@ import re
 import toml
 
 from . import validators as val
+from .errors import ConfigError
 from .util import prompt
 
 default_config_name = "makelove.toml"
@@ -43,19 +44,56 @@ all_love_versions = [
     "0.1.1",
 ]
 
+hook_params = val.Section(
+    {
+        "name": val.String(),
+        "command": val.Command(),
+        "after": val.List(val.String()),
+        "modifies_config": val.Bool(),
+        "inputs": val.List(val.Path()),
+        "outputs": val.List(val.Path()),
+    }
+)
+
 config_params = {
     "name": val.String(),
     "love_version": val.Choice(*all_love_versions),
     "default_targets": val.List(val.Choice(*all_targets)),
     "build_directory": val.Path(),
+    "mirror": val.Path(),
     "icon_file": val.Path(),
     "love_files": val.List(val.Path()),
     "keep_game_directory": val.Bool(),
+    "reproducible": val.Bool(),
+    "atlas": val.Section(
+        {
+            "files": val.List(val.Path()),
+            "output": val.Path(),
+            "max_size": val.Int(),
+            "padding": val.Int(),
+        }
+    ),
+    "patches": val.Section(
+        {"previous_versions": val.Int(), "delta_min_size": val.String()}
+    ),
+    "remote_cache": val.Section({"url": val.Path(), "read_only": val.Bool()}),
+    "optimize_images": val.Section(
+        {"files": val.List(val.Path()), "max_parallel": val.Int()}
+    ),
+    "bytecode": val.Section(
+        {
+            "compiler": val.Path(),
+            "files": val.List(val.Path()),
+            "debug_info": val.Bool(),
+            "max_parallel": val.Int(),
+        }
+    ),
     "archive_files": val.Dict(val.Path(), val.Path()),
     "hooks": val.Section(
         {
-            "prebuild": val.List(val.Command()),
-            "postbuild": val.List(val.Command()),
+            "prebuild": val.List(val.Option(val.Command(), hook_params)),
+            "postbuild": val.List(val.Option(val.Command(), hook_params)),
+            "max_parallel": val.Int(),
             "parameters": val.Dict(val.Any(), val.Any()),
         }
     ),
@@ -70,6 +108,8 @@ config_params = {
             "love_binaries": val.Path(),
             "shared_libraries": val.List(val.Path()),
             "artifacts": val.ValueOrList(val.Choice("directory", "archive")),
+            "love_files": val.List(val.Path()),
+            "bytecode": val.Bool(),
         }
     ),
     "win64": val.Section(
@@ -77,6 +117,8 @@ config_params = {
             "love_binaries": val.Path(),
             "shared_libraries": val.List(val.Path()),
             "artifacts": val.ValueOrList(val.Choice("directory", "archive")),
+            "love_files": val.List(val.Path()),
+            "bytecode": val.Bool(),
         }
     ),
     "linux": val.Section(
@@ -87,6 +129,9 @@ config_params = {
             "source_appimage": val.Path(),
             "shared_libraries": val.List(val.Path()),
             "artifacts": val.ValueOrList(val.Choice("appdir", "appimage")),
+            "release_cache_ttl": val.Int(),
+            "love_files": val.List(val.Path()),
+            "bytecode": val.Bool(),
         }
     ),
     "macos": val.Section(
@@ -95,12 +140,22 @@ config_params = {
             "icon_file": val.Path(),
             "app_metadata": val.Dict(val.String(), val.String()),
             "archive_files": val.Dict(val.Path(), val.Path()),
+            "love_files": val.List(val.Path()),
+            "bytecode": val.Bool(),
         }
     ),
     "lovejs": val.Section(
         {
+            "love_binaries": val.Path(),
             "title": val.String(),
             "memory": val.String(),
+            "package": val.Choice("love", "files"),
+            "deferred_files": val.List(val.Path()),
+            "chunk_size": val.Int(),
+            "artifacts": val.ValueOrList(val.Choice("directory", "archive")),
+            "precompress": val.ValueOrList(val.Choice("gzip", "brotli")),
+            "love_files": val.List(val.Path()),
+            "bytecode": val.Bool(),
         }
     ),
 }
@@ -120,11 +175,13 @@ def load_config_file(path):
     return config_data
 
 
-def is_inside_git_repo():
+def is_inside_git_repo(project_dir="."):
     try:
         return (
             subprocess.run(
-                ["git", "rev-parse", "--is-inside-work-tree"], capture_output=True
+                ["git", "rev-parse", "--is-inside-work-tree"],
+                capture_output=True,
+                cwd=project_dir,
             ).returncode
             == 0
         )
@@ -132,13 +189,18 @@ def is_inside_git_repo():
         return False
 
 
-def guess_name():
-    res = subprocess.run(["git", "rev-parse", "--show-toplevel"], capture_output=True)
-    if res.returncode == 0:
+def guess_name(project_dir="."):
+    try:
+        res = subprocess.run(
+            ["git", "rev-parse", "--show-toplevel"], capture_output=True, cwd=project_dir
+        )
+    except FileNotFoundError:  # git is not installed
+        res = None
+    if res != None and res.returncode == 0:
         git_root_path = res.stdout.decode("utf-8").strip()
         return os.path.basename(git_root_path)
     else:
-        return os.path.basename(os.getcwd())
+        return os.path.basename(os.path.abspath(project_dir))
 
 
 def get_default_targets():
@@ -148,22 +210,22 @@ def get_default_targets():
     return targets
 
 
-def get_conf_filename():
+def get_conf_filename(project_dir="."):
     candidates = ["conf.lua", "conf.moon", "conf.ts"]
     for name in candidates:
-        if os.path.isfile(name):
+        if os.path.isfile(os.path.join(project_dir, name)):
             print("Found {}".format(name))
             return name
     print("Could not find löve config file")
     return None
 
 
-def guess_love_version():
-    filename = get_conf_filename()
+def guess_love_version(project_dir="."):
+    filename = get_conf_filename(project_dir)
     if filename == None:
         return None
 
-    with open(filename) as f:
+    with open(os.path.join(project_dir, filename)) as f:
         conf_lua = f.read()
 
     regex = re.compile(r"(?<!--)\.version\s*=\s*\"(.*)\"")
@@ -180,13 +242,17 @@ def guess_love_version():
     return matches[0]
 
 
-def get_default_love_files(build_directory):
-    if is_inside_git_repo():
+def get_default_love_files(build_directory, project_dir="."):
+    if is_inside_git_repo(project_dir):
         return [
             "::git-ls-tree::",
             "-*/.*",
         ]
     else:
+        # The patterns are relative to the project directory
+        build_directory = os.path.relpath(
+            os.path.join(project_dir, build_directory), project_dir
+        )
         return [
             "+*",
             "-*/.*",
@@ -198,31 +264,37 @@ def validate_config(config):
     try:
         val.Section(config_params).validate(config)
     except ValueError as exc:
-        sys.exit("Could not parse config:\n{}".format(exc))
+        raise ConfigError("Could not parse config:\n{}".format(exc))
 
 
-def get_raw_config(config_path):
+def get_raw_config(config_path, project_dir="."):
     if config_path != None:
+        config_path = os.path.join(project_dir, config_path)
         if not os.path.isfile(config_path):
-            sys.exit("Config file '{}' does not exist".format(config_path))
+            raise ConfigError("Config file '{}' does not exist".format(config_path))
         print("Loading config file '{}'".format(config_path))
         return load_config_file(config_path)
     else:
-        if os.path.isfile(default_config_name):
-            print("Loading config from default path '{}'".format(default_config_name))
-            return load_config_file(default_config_name)
+        default_config_path = os.path.join(project_dir, default_config_name)
+        if os.path.isfile(default_config_path):
+            print("Loading config from default path '{}'".format(default_config_path))
+            return load_config_file(default_config_path)
         else:
             print("No config file found. Using default config.")
             return {}
 
 
-def get_config(config_path):
-    config = get_raw_config(config_path)
+def get_config(config_path, project_dir="."):
+    return complete_config(get_raw_config(config_path, project_dir), project_dir)
+
+
+def complete_config(config, project_dir="."):
+    # Fills in the defaults for everything that is not specified
     if not "name" in config:
-        config["name"] = guess_name()
+        config["name"] = guess_name(project_dir)
         print("Guessing project name as '{}'".format(config["name"]))
     if not "love_version" in config:
-        conf_love_version = guess_love_version()
+        conf_love_version = guess_love_version(project_dir)
         if conf_love_version:
             config["love_version"] = conf_love_version
             print(
@@ -239,12 +311,57 @@ def get_config(config_path):
         config["build_directory"] = "makelove-build"
         print("Using default build directory '{}'".format(config["build_directory"]))
     if not "love_files" in config:
-        config["love_files"] = get_default_love_files(config["build_directory"])
+        config["love_files"] = get_default_love_files(
+            config["build_directory"], project_dir
+        )
         print("Using default love_files patterns: {}".format(config["love_files"]))
     validate_config(config)
     return config
 
 
+def _resolve_path(path, project_dir):
+    return os.path.normpath(os.path.join(project_dir, path))
+
+
+def resolve_config_paths(config, project_dir):
+    """
+    Makes all paths in the config that refer to files on disk absolute (relative
+    to project_dir), so the build does not depend on the working directory.
+    love_files patterns and paths inside the built archives are left alone.
+    """
+    project_dir = os.path.abspath(project_dir)
+    for key in ["build_directory", "icon_file"]:
+        if key in config:
+            config[key] = _resolve_path(config[key], project_dir)
+    if "mirror" in config and not re.match(r"^\w+://", config["mirror"]):
+        config["mirror"] = _resolve_path(config["mirror"], project_dir)
+    remote_cache_url = config.get("remote_cache", {}).get("url", "")
+    if remote_cache_url and not re.match(r"^\w+://", remote_cache_url):
+        config["remote_cache"]["url"] = _resolve_path(remote_cache_url, project_dir)
+    # A compiler without a directory is looked up in PATH
+    compiler = config.get("bytecode", {}).get("compiler", "")
+    if os.path.dirname(compiler) != "":
+        config["bytecode"]["compiler"] = _resolve_path(compiler, project_dir)
+
+    for section in [config] + [config[k] for k in ["windows", "macos"] if k in config]:
+        if "archive_files" in section:
+            section["archive_files"] = {
+                _resolve_path(src, project_dir): dest
+                for src, dest in section["archive_files"].items()
+            }
+
+    for target in ["win32", "win64", "macos", "lovejs", "appimage"]:
+        section = config.get(target, {})
+        for key in ["love_binaries", "icon_file", "source_appimage"]:
+            if key in section:
+                section[key] = _resolve_path(section[key], project_dir)
+        if "shared_libraries" in section:
+            section["shared_libraries"] = [
+                _resolve_path(path, project_dir) for path in section["shared_libraries"]
+            ]
+    return config
+
+
 init_config_template = """name = {name}
 default_targets = [{default_targets}]
 build_directory = {build_directory}
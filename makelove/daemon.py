@@ -0,0 +1,349 @@
+import hashlib
+import importlib
+import json
+import os
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import traceback
+
+from .batch import ThreadOutput
+from .binarycache import get_cache_dir
+from .config import all_targets, get_config, resolve_config_paths
+from .errors import ConfigError, MakeloveError
+from .hooks import get_hooks, get_project_package
+from .util import build_environment
+from .makelove import (
+    all_hooks,
+    build_command,
+    get_build_parser,
+    get_build_version,
+    get_makelove_version,
+    get_targets,
+)
+
+# A build request is a single line of JSON ({"cwd": ..., "argv": [...],
+# "environment": {...}} with the environment variables of the client that
+# influence builds, see is_build_variable). The daemon answers with one line of
+# JSON per chunk of output ({"stdout": ...} or {"stderr": ...}) and finally
+# {"exit": <exit status>}.
+
+
+def get_socket_path():
+    return os.environ.get("MAKELOVE_DAEMON_SOCKET") or os.path.join(
+        get_cache_dir(), "daemon.sock"
+    )
+
+
+class SocketOutput(object):
+    def __init__(self, wfile, name):
+        self.wfile = wfile
+        self.name = name
+
+    def write(self, s):
+        if len(s) > 0:
+            self.wfile.write((json.dumps({self.name: s}) + "\n").encode("utf-8"))
+            self.wfile.flush()
+        return len(s)
+
+    def flush(self):
+        pass
+
+
+def is_build_variable(name):
+    return name.startswith("MAKELOVE_") or name == "SOURCE_DATE_EPOCH"
+
+
+def get_client_environment():
+    return {
+        name: value for name, value in os.environ.items() if is_build_variable(name)
+    }
+
+
+def get_build_environment(client_environment):
+    # The environment of the daemon, but with the build variables of the client
+    environment = {
+        name: value for name, value in os.environ.items() if not is_build_variable(name)
+    }
+    environment.update(client_environment)
+    return environment
+
+
+def is_inside(path, directory):
+    return not os.path.relpath(path, directory).startswith("..")
+
+
+def _hash_file(tree_hash, path):
+    stat = os.stat(path)
+    line = "{}\0{}\0{}\n".format(path, stat.st_size, stat.st_mtime_ns)
+    tree_hash.update(line.encode("utf-8"))
+
+
+def update_tree_hash(tree_hash, path, exclude=()):
+    # Hashes the names, sizes and modification times of all files in path
+    if os.path.isfile(path):
+        _hash_file(tree_hash, path)
+        return
+    if not os.path.isdir(path):
+        tree_hash.update("{}\0missing\n".format(path).encode("utf-8"))
+        return
+    for root, dirs, files in os.walk(path, followlinks=True):
+        dirs[:] = sorted(d for d in dirs if not os.path.join(root, d) in exclude)
+        for f in sorted(files):
+            try:
+                _hash_file(tree_hash, os.path.join(root, f))
+            except OSError:  # e.g. a broken symlink
+                pass
+
+
+def get_external_paths(config):
+    # Files outside of the game directory that end up in the build
+    paths = []
+    for section in [config] + [config.get(k, {}) for k in ["windows", "macos"]]:
+        paths.extend(section.get("archive_files", {}).keys())
+    for section in [config] + [config.get(t, {}) for t in ["win32", "win64", "macos"]]:
+        if "icon_file" in section:
+            paths.append(section["icon_file"])
+    for target in ["win32", "win64", "macos", "lovejs", "appimage"]:
+        section = config.get(target, {})
+        for key in ["love_binaries", "source_appimage"]:
+            if key in section:
+                paths.append(section[key])
+        paths.extend(section.get("shared_libraries", []))
+    compiler = config.get("bytecode", {}).get("compiler", "")
+    if os.path.dirname(compiler) != "":
+        paths.append(compiler)
+    return paths
+
+
+def can_skip_unchanged(args, config, project_dir):
+    """
+    Whether a build can be skipped if nothing changed. Versioned builds always
+    produce something new and hooks without declared inputs might do anything.
+    """
+    if args.version != None or args.check or args.display_version:
+        return False
+    if get_build_version(config, None) != None:
+        return False
+    disabled_hooks = all_hooks if "all" in args.disabled_hooks else args.disabled_hooks
+    for hook in all_hooks:
+        if hook in disabled_hooks or not hook in config.get("hooks", {}):
+            continue
+        if any(h.inputs == None for h in get_hooks(config, hook)):
+            return False
+    return True
+
+
+def get_build_fingerprint(args, config, project_dir, client_environment):
+    """
+    Hashes everything a build depends on. The files are not read, but all of
+    them are stat'ed (there is no file watcher), so this takes longer the more
+    files the project has.
+    """
+    fingerprint = hashlib.sha256()
+    data = {
+        "makelove": get_makelove_version(),
+        "config": config,
+        "args": vars(args),
+        "environment": client_environment,
+    }
+    fingerprint.update(json.dumps(data, sort_keys=True, default=str).encode("utf-8"))
+
+    build_directory = config["build_directory"]
+    exclude = [build_directory, os.path.join(project_dir, ".git")]
+    update_tree_hash(fingerprint, project_dir, exclude)
+    for path in get_external_paths(config):
+        if not is_inside(path, project_dir):
+            update_tree_hash(fingerprint, path)
+
+    love_files = [config["love_files"]] + [
+        config.get(target, {}).get("love_files", []) for target in all_targets
+    ]
+    if any("git-ls-tree" in rule for rules in love_files for rule in rules):
+        res = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, cwd=project_dir
+        )
+        fingerprint.update(res.stdout)
+
+    # The outputs have to be unchanged as well
+    for target in get_targets(args.targets, config):
+        update_tree_hash(fingerprint, os.path.join(build_directory, target))
+    return fingerprint.hexdigest()
+
+
+def forget_project_modules(project_dir):
+    # Python hooks of the project have to be imported again, they might have
+    # changed. They are imported as submodules of a package of the project, so
+    # the modules of other projects (even with the same names) are not affected.
+    package = get_project_package(project_dir)
+    for name in list(sys.modules):
+        if name.startswith(package + "."):
+            del sys.modules[name]
+    # Otherwise new modules might not be found
+    importlib.invalidate_caches()
+
+
+class DaemonState(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.project_locks = {}
+        self.fingerprints = {}
+
+    def get_project_lock(self, project_dir):
+        with self.lock:
+            return self.project_locks.setdefault(project_dir, threading.Lock())
+
+
+def handle_build_request(state, project_dir, argv, client_environment):
+    args = get_build_parser().parse_args(argv)
+    if args.init:
+        raise ConfigError("--init can not be used with the daemon")
+
+    # Not in os.environ, because other builds might run at the same time
+    token = build_environment.set(get_build_environment(client_environment))
+    try:
+        with state.get_project_lock(project_dir):
+            build_project(state, project_dir, argv, args, client_environment)
+    finally:
+        build_environment.reset(token)
+
+
+def build_project(state, project_dir, argv, args, client_environment):
+    forget_project_modules(project_dir)
+
+    config = resolve_config_paths(get_config(args.config, project_dir), project_dir)
+    key = (project_dir, tuple(argv))
+    skippable = can_skip_unchanged(args, config, project_dir)
+    get_fingerprint = lambda: get_build_fingerprint(
+        args, config, project_dir, client_environment
+    )
+    if skippable:
+        if state.fingerprints.get(key) == get_fingerprint():
+            print("Nothing changed since the last build. Skipping.")
+            return
+    state.fingerprints.pop(key, None)
+
+    build_command(args, project_dir, config)
+
+    # Files written by the build (e.g. by hooks) should not trigger a rebuild
+    if skippable:
+        state.fingerprints[key] = get_fingerprint()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode("utf-8"))
+        self.server.stdout.capture(SocketOutput(self.wfile, "stdout"))
+        self.server.stderr.capture(SocketOutput(self.wfile, "stderr"))
+        try:
+            handle_build_request(
+                self.server.state,
+                os.path.abspath(request["cwd"]),
+                request["argv"],
+                request.get("environment", {}),
+            )
+            status = 0
+        except SystemExit as exc:
+            if isinstance(exc.code, str):
+                print(exc.code, file=sys.stderr)
+                status = 1
+            else:
+                status = exc.code or 0
+        except MakeloveError as exc:
+            print(str(exc), file=sys.stderr)
+            status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            self.server.stdout.capture(None)
+            self.server.stderr.capture(None)
+        self.wfile.write((json.dumps({"exit": status}) + "\n").encode("utf-8"))
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def is_daemon_running(socket_path):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+        return True
+    except OSError:
+        return False
+
+
+def run_server(socket_path):
+    """
+    Executes build requests from run_client until interrupted. Everything that
+    is cached in memory (imported modules, release metadata, the fingerprints
+    of the last builds) stays warm between builds.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        raise ConfigError("The daemon is not supported on this platform")
+    if os.path.exists(socket_path):
+        if is_daemon_running(socket_path):
+            raise ConfigError(
+                "A daemon is already listening on '{}'".format(socket_path)
+            )
+        os.remove(socket_path)
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+
+    # Builds run hooks, so only the owner may send requests. The socket is
+    # created with these permissions, so there is no moment in which others
+    # could connect.
+    old_umask = os.umask(0o077)
+    try:
+        server = DaemonServer(socket_path, RequestHandler)
+    finally:
+        os.umask(old_umask)
+    server.state = DaemonState()
+    server.stdout = ThreadOutput(sys.stdout)
+    server.stderr = ThreadOutput(sys.stderr)
+    sys.stdout, sys.stderr = server.stdout, server.stderr
+    print("Listening on '{}'".format(socket_path))
+    # Also clean up the socket when stopped with SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdout, sys.stderr = server.stdout.stream, server.stderr.stream
+        server.server_close()
+        os.remove(socket_path)
+
+
+def run_client(argv, socket_path=None):
+    # Sends the build to the daemon, prints its output and returns the exit status
+    socket_path = socket_path or get_socket_path()
+    if not hasattr(socket, "AF_UNIX"):
+        raise ConfigError("The daemon is not supported on this platform")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError as exc:
+            raise MakeloveError(
+                "Could not connect to the daemon at '{}' ({}). ".format(socket_path, exc)
+                + "Start it with 'makelove daemon'."
+            )
+        request = {
+            "cwd": os.getcwd(),
+            "argv": argv,
+            "environment": get_client_environment(),
+        }
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with sock.makefile("r", encoding="utf-8") as responses:
+            for line in responses:
+                response = json.loads(line)
+                if "stdout" in response:
+                    sys.stdout.write(response["stdout"])
+                elif "stderr" in response:
+                    sys.stderr.write(response["stderr"])
+                elif "exit" in response:
+                    return response["exit"]
+    raise MakeloveError("The daemon closed the connection")
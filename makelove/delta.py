@@ -0,0 +1,370 @@
+import bisect
+import hashlib
+import json
+import os
+import shutil
+import struct
+import zipfile
+
+from .config import all_targets
+from .errors import BuildError
+from .util import format_size
+
+# A delta describes how to build a new file from an old one with a sequence of
+# operations: b"C" + <u64 offset, u32 length> copies bytes from the old file and
+# b"D" + <u32 length> + <data> inserts new bytes. All integers are little endian.
+delta_magic = b"MLDELTA1"
+copy_op = b"C"
+data_op = b"D"
+
+# Files are split into content-defined chunks: every byte is mapped to one
+# pseudo-random bit (with bytes.translate, which is fast) and a chunk ends where
+# the bits of the bytes before it spell chunk_pattern. Chunks are between
+# min_chunk_size and max_chunk_size long, and the longer a chunk gets, the
+# shorter the suffix of the pattern that is enough to end it (see chunk_levels,
+# like the normalized chunking of FastCDC). So chunks of data with little
+# entropy (e.g. text) are not much larger than others. Since the boundaries
+# only depend on the content right before them, inserting or removing data
+# only changes the chunks around it, not all chunks after it (like fixed size
+# blocks would).
+chunk_bit_table = bytes(
+    b"01"[hashlib.sha256(bytes([i])).digest()[0] & 1] for i in range(256)
+)
+chunk_pattern = b"0110100110010110"
+min_chunk_size = 16 * 1024
+max_chunk_size = 256 * 1024
+# (length of the pattern suffix, size up to which it is required)
+chunk_levels = [(16, 64 * 1024), (12, 128 * 1024), (8, max_chunk_size)]
+read_size = 4 * 1024 * 1024
+
+# Merged copies still have to fit into the 32-bit length of a copy operation
+max_copy_length = 2 ** 32 - 1
+block_size = 1024 * 1024
+
+manifest_format = 1
+
+
+def find_pattern_ends(buffer):
+    """
+    Returns a sorted list of the positions in buffer that follow a match of the
+    pattern suffix for every level of chunk_levels. A position is only in the
+    list of the longest suffix that matches there.
+    """
+    bits = buffer.translate(chunk_bit_table)
+    shortest = chunk_pattern[-chunk_levels[-1][0] :]
+    ends = [[] for _level in chunk_levels]
+    # A match of a longer suffix is also a match of the shortest one
+    pos = bits.find(shortest)
+    while pos != -1:
+        end = pos + len(shortest)
+        for level, (length, _size) in enumerate(chunk_levels):
+            if bits[end - length : end] == chunk_pattern[-length:]:
+                ends[level].append(end)
+                break
+        pos = bits.find(shortest, pos + 1)
+    return ends
+
+
+def find_chunk_end(buffer_length, pattern_ends, pos):
+    # Returns the end of the chunk that starts at pos
+    limit = min(pos + max_chunk_size, buffer_length)
+    low = pos + min_chunk_size
+    for level, (_length, size) in enumerate(chunk_levels):
+        high = min(pos + size, limit)
+        # Matches of longer suffixes are enough as well
+        matches = []
+        for ends in pattern_ends[: level + 1]:
+            i = bisect.bisect_left(ends, low)
+            if i < len(ends) and ends[i] <= high:
+                matches.append(ends[i])
+        if len(matches) > 0:
+            return min(matches)
+        low = high + 1
+    return limit
+
+
+def iter_chunks(f):
+    # Yields (offset, data) of every chunk of the file object f
+    buffer, pattern_ends, pos, offset, eof = b"", [], 0, 0, False
+    while True:
+        if not eof and len(buffer) - pos < max_chunk_size:
+            data = f.read(read_size)
+            eof = len(data) == 0
+            buffer, pos = buffer[pos:] + data, 0
+            pattern_ends = find_pattern_ends(buffer)
+            continue
+        if pos >= len(buffer):
+            return
+        chunk = buffer[pos : find_chunk_end(len(buffer), pattern_ends, pos)]
+        yield offset, chunk
+        offset += len(chunk)
+        pos += len(chunk)
+
+
+def index_chunks(f):
+    # Returns a dict of the hash of every chunk of f to its offset and length
+    index = {}
+    for offset, chunk in iter_chunks(f):
+        index.setdefault(hashlib.sha256(chunk).digest(), (offset, len(chunk)))
+    return index
+
+
+def write_delta(old_index, new_file, out):
+    """
+    Writes a delta from the old file (described by old_index, see index_chunks)
+    to the contents of new_file into the file object out. Returns the size of
+    the delta.
+    """
+    size = out.write(delta_magic)
+    pending_copy = None
+
+    def flush_copy():
+        if pending_copy != None:
+            return out.write(copy_op + struct.pack("<QI", *pending_copy))
+        return 0
+
+    for _offset, chunk in iter_chunks(new_file):
+        match = old_index.get(hashlib.sha256(chunk).digest())
+        if match != None:
+            # Copies of consecutive chunks of the old file are merged
+            if (
+                pending_copy != None
+                and sum(pending_copy) == match[0]
+                and pending_copy[1] + match[1] <= max_copy_length
+            ):
+                pending_copy = (pending_copy[0], pending_copy[1] + match[1])
+            else:
+                size += flush_copy()
+                pending_copy = match
+        else:
+            size += flush_copy()
+            pending_copy = None
+            size += out.write(data_op + struct.pack("<I", len(chunk)) + chunk)
+    size += flush_copy()
+    return size
+
+
+def copy_bytes(f, out, length):
+    # Copies length bytes from f to out in blocks, so memory use is bounded
+    while length > 0:
+        data = f.read(min(length, block_size))
+        if len(data) == 0:
+            raise ValueError("Unexpected end of file")
+        out.write(data)
+        length -= len(data)
+
+
+def apply_delta(old_file, delta_file, out):
+    # The reference implementation for updaters
+    if delta_file.read(len(delta_magic)) != delta_magic:
+        raise ValueError("Not a delta file")
+    while True:
+        op = delta_file.read(1)
+        if op == b"":
+            return
+        elif op == copy_op:
+            offset, length = struct.unpack("<QI", delta_file.read(12))
+            old_file.seek(offset)
+            copy_bytes(old_file, out, length)
+        elif op == data_op:
+            (length,) = struct.unpack("<I", delta_file.read(4))
+            copy_bytes(delta_file, out, length)
+        else:
+            raise ValueError("Invalid delta operation {}".format(op))
+
+
+def hash_file(f):
+    file_hash = hashlib.sha256()
+    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+        file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class PatchWriter(object):
+    """
+    Writes the changed files of a patch into output_directory/data and
+    describes them with manifest entries.
+    """
+
+    def __init__(self, output_directory, delta_min_size):
+        self.output_directory = output_directory
+        self.delta_min_size = delta_min_size
+        self.num_files = 0
+        self.size = 0
+        os.makedirs(os.path.join(output_directory, "data"), exist_ok=True)
+
+    def _data_path(self, extension):
+        self.num_files += 1
+        return "data/{}{}".format(self.num_files, extension)
+
+    def diff(self, open_old, open_new, new_size):
+        """
+        Returns the manifest entry for a file. open_old and open_new
+        return binary file objects (open_old is None for added files).
+        """
+        with open_new() as new_file:
+            entry = {"sha256": hash_file(new_file), "size": new_size}
+        if open_old != None:
+            with open_old() as old_file:
+                entry["old_sha256"] = hash_file(old_file)
+            if entry["old_sha256"] == entry["sha256"]:
+                entry["action"] = "unchanged"
+                return entry
+
+        if open_old != None and new_size >= self.delta_min_size:
+            data_path = self._data_path(".delta")
+            path = os.path.join(self.output_directory, data_path)
+            with open_old() as old_file:
+                old_index = index_chunks(old_file)
+            with open_new() as new_file, open(path, "wb") as out:
+                delta_size = write_delta(old_index, new_file, out)
+            # A delta is not worth it if most of the file changed
+            if delta_size < new_size:
+                entry.update({"action": "delta", "patch": data_path})
+                self.size += delta_size
+                return entry
+            os.remove(path)
+
+        data_path = self._data_path(".bin")
+        with open_new() as new_file:
+            with open(os.path.join(self.output_directory, data_path), "wb") as out:
+                shutil.copyfileobj(new_file, out, 1024 * 1024)
+        entry.update(
+            {"action": "replace" if open_old != None else "add", "patch": data_path}
+        )
+        self.size += new_size
+        return entry
+
+
+def get_target_files(target_directory):
+    files = {}
+    for root, _dirs, names in os.walk(target_directory):
+        for name in names:
+            path = os.path.join(root, name)
+            files[os.path.relpath(path, target_directory).replace(os.sep, "/")] = path
+    return files
+
+
+def is_zip_artifact(path):
+    return path.endswith(".zip") and zipfile.is_zipfile(path)
+
+
+def diff_zip(writer, old_path, new_path):
+    # Returns the manifest entries for the files in the zip at new_path
+    with zipfile.ZipFile(old_path) as old_zip, zipfile.ZipFile(new_path) as new_zip:
+        old_infos = {i.filename: i for i in old_zip.infolist() if not i.is_dir()}
+        entries = []
+        for info in new_zip.infolist():
+            if info.is_dir():
+                continue
+            old_info = old_infos.pop(info.filename, None)
+            open_old = None
+            if old_info != None:
+                open_old = lambda: old_zip.open(old_info)
+            open_new = lambda: new_zip.open(info)
+            entry = writer.diff(open_old, open_new, info.file_size)
+            entry["name"] = info.filename
+            # The permissions (e.g. of executables in a macOS app)
+            if info.external_attr >> 16 != 0:
+                entry["mode"] = info.external_attr >> 16
+            entries.append(entry)
+        for name in sorted(old_infos):
+            entries.append({"name": name, "action": "remove"})
+    return entries
+
+
+def diff_target(old_directory, new_directory, output_directory, delta_min_size, info):
+    """
+    Writes a patch from the artifacts in old_directory to the ones in
+    new_directory and its manifest (with the fields in info) into
+    output_directory and returns the size of the patch. The files in
+    .zip artifacts are patched individually, because updaters usually patch the
+    extracted files. Changed files that are at least delta_min_size bytes large
+    are patched with a delta, if that is smaller than the file.
+    """
+    writer = PatchWriter(output_directory, delta_min_size)
+    old_files = get_target_files(old_directory)
+    artifacts = []
+    for name, new_path in sorted(get_target_files(new_directory).items()):
+        old_path = old_files.pop(name, None)
+        new_size = os.path.getsize(new_path)
+        is_zip = old_path != None and is_zip_artifact(old_path)
+        if is_zip and is_zip_artifact(new_path):
+            with open(new_path, "rb") as f:
+                artifact = {"path": name, "type": "zip", "sha256": hash_file(f)}
+            with open(old_path, "rb") as f:
+                artifact["old_sha256"] = hash_file(f)
+            if artifact["sha256"] == artifact["old_sha256"]:
+                artifact["action"] = "unchanged"
+            else:
+                artifact["action"] = "patch"
+                artifact["entries"] = diff_zip(writer, old_path, new_path)
+        else:
+            open_old = None
+            if old_path != None:
+                open_old = lambda: open(old_path, "rb")
+            artifact = writer.diff(open_old, lambda: open(new_path, "rb"), new_size)
+            artifact.update({"path": name, "type": "file"})
+        artifacts.append(artifact)
+    for name in sorted(old_files):
+        artifacts.append({"path": name, "type": "file", "action": "remove"})
+
+    manifest = dict(info, format=manifest_format, artifacts=artifacts)
+    with open(os.path.join(output_directory, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4)
+    return writer.size
+
+
+def diff_builds(
+    build_directory, old_version, new_version, targets, output_directory, delta_min_size
+):
+    """
+    Writes patches for all targets that were built in both versions into
+    output_directory/<target>. Returns the targets that were patched.
+    """
+    old_directory = os.path.join(build_directory, old_version)
+    new_directory = os.path.join(build_directory, new_version)
+    for directory in [old_directory, new_directory]:
+        if not os.path.isdir(directory):
+            raise BuildError("There is no build in '{}'".format(directory))
+
+    if targets == None or len(targets) == 0:
+        targets = [
+            t for t in all_targets if os.path.isdir(os.path.join(new_directory, t))
+        ]
+    patched = []
+    for target in targets:
+        old_target_directory = os.path.join(old_directory, target)
+        new_target_directory = os.path.join(new_directory, target)
+        built = [old_target_directory, new_target_directory]
+        if not all(os.path.isdir(directory) for directory in built):
+            print("Target {} was not built in both versions. Skipping.".format(target))
+            continue
+        target_output_directory = os.path.join(output_directory, target)
+        if os.path.isdir(target_output_directory):
+            shutil.rmtree(target_output_directory)
+        info = {
+            "target": target,
+            "from_version": old_version,
+            "to_version": new_version,
+        }
+        size = diff_target(
+            old_target_directory,
+            new_target_directory,
+            target_output_directory,
+            delta_min_size,
+            info,
+        )
+        new_files = get_target_files(new_target_directory).values()
+        new_size = sum(os.path.getsize(path) for path in new_files)
+        print(
+            "Patch {} -> {} for {}: {} (full build: {})".format(
+                old_version,
+                new_version,
+                target,
+                format_size(size),
+                format_size(new_size),
+            )
+        )
+        patched.append(target)
+    return patched
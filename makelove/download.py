@@ -0,0 +1,272 @@
+import hashlib
+import http.client
+import json
+import os
+import time
+import uuid
+import zipfile
+from pathlib import Path
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+from .binarycache import get_cache_dir
+from .errors import DownloadError
+from .util import format_size, getenv
+
+chunk_size = 1024 * 1024
+max_attempts = 5
+timeout = 30
+
+# SHA-256 digests of files that are known not to change, keyed by URL.
+# If a file is not listed here, the digest is taken from a sidecar file
+# (<url>.sha256, as produced by sha256sum), if the server has one. Otherwise the
+# digest of the first download is recorded and later downloads are checked
+# against it.
+known_sha256 = {}
+
+
+def get_mirror(config):
+    """
+    Returns the local directory or base URL all downloads of a build are
+    redirected to or None. The mirror contains the files under <host>/<path> of
+    their original URL, e.g.
+    <mirror>/github.com/love2d/love/releases/download/11.4/love-11.4-win64.zip
+    """
+    # The environment variable takes precedence over the configuration
+    return getenv("MAKELOVE_MIRROR") or config.get("mirror") or None
+
+
+def get_mirrored_url(url, mirror):
+    if mirror == None:
+        return url
+    parsed = urlparse(url)
+    path = parsed.netloc + parsed.path
+    if urlparse(mirror).scheme in ["http", "https", "file"]:
+        return mirror.rstrip("/") + "/" + path
+    return Path(os.path.abspath(os.path.join(mirror, *path.split("/")))).as_uri()
+
+
+def get_sidecar_sha256(url):
+    try:
+        with urlopen(url + ".sha256", timeout=timeout) as response:
+            content = response.read(1024).decode("utf-8", errors="replace")
+    except (HTTPError, URLError, OSError):
+        return None
+    parts = content.split()
+    if len(parts) == 0 or len(parts[0]) != 64:
+        return None
+    return parts[0].lower()
+
+
+def get_file_sha256(path):
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_recorded_sha256_path(url):
+    url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(get_cache_dir(), "sha256", url_hash + ".sha256")
+
+
+def get_recorded_sha256(url):
+    path = get_recorded_sha256_path(url)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        parts = f.read().split()
+    if len(parts) == 0 or len(parts[0]) != 64:
+        return None
+    return parts[0]
+
+
+def record_sha256(url, sha256):
+    path = get_recorded_sha256_path(url)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+    with open(tmp_path, "w") as f:
+        f.write("{}  {}\n".format(sha256, url))
+    os.replace(tmp_path, path)
+
+
+def _download_attempt(url, part_path):
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    headers = {}
+    if offset > 0:
+        headers["Range"] = "bytes={}-".format(offset)
+
+    try:
+        response = urlopen(Request(url, headers=headers), timeout=timeout)
+    except HTTPError as exc:
+        if exc.code == 416 and offset > 0:
+            # The .part file is already complete
+            return offset, 0
+        raise
+
+    with response:
+        if offset > 0 and response.status != 206:
+            print("Server does not support resuming downloads. Starting over.")
+            offset = 0
+        elif offset > 0:
+            print("Resuming download at {}".format(format_size(offset)))
+
+        length = response.headers.get("Content-Length")
+        total = offset + int(length) if length != None else None
+
+        received = 0
+        last_report = time.monotonic()
+        with open(part_path, "ab" if offset > 0 else "wb") as f:
+            for chunk in iter(lambda: response.read(chunk_size), b""):
+                f.write(chunk)
+                received += len(chunk)
+                now = time.monotonic()
+                if total != None and now - last_report > 5:
+                    print(
+                        "{} / {}".format(format_size(offset + received), format_size(total))
+                    )
+                    last_report = now
+
+        if total != None and offset + received < total:
+            raise http.client.IncompleteRead(b"", total - offset - received)
+        return offset + received, received
+
+
+def download(url, path, sha256=None, mirror=None):
+    """
+    Streams the file at url to path. The data is written to path + ".part" first,
+    which is used to resume interrupted downloads (with HTTP Range requests) and
+    only renamed to path after the download is complete and verified.
+    The SHA-256 digest is checked against sha256, known_sha256 or a sidecar file.
+    If mirror is given, the file is downloaded from there (see get_mirror).
+    """
+    original_url = url
+    url = get_mirrored_url(url, mirror)
+    part_path = path + ".part"
+    start_time = time.monotonic()
+    received = 0
+    attempt = 1
+    while True:
+        try:
+            size, attempt_received = _download_attempt(url, part_path)
+            received += attempt_received
+            break
+        except (URLError, OSError, http.client.HTTPException) as exc:
+            # Errors of the server and rate limiting are usually temporary
+            permanent = isinstance(exc, HTTPError) and not (
+                exc.code >= 500 or exc.code == 429
+            )
+            if permanent or attempt >= max_attempts or url.startswith("file:"):
+                raise DownloadError("Could not download {}: {}".format(url, exc))
+            print("Download interrupted ({}). Retrying..".format(exc))
+            attempt += 1
+            time.sleep(1)
+
+    duration = max(time.monotonic() - start_time, 0.001)
+    print(
+        "Downloaded {} in {:.1f}s ({}/s)".format(
+            format_size(size), duration, format_size(received / duration)
+        )
+    )
+
+    actual_sha256 = get_file_sha256(part_path)
+    expected_sha256 = (
+        sha256 or known_sha256.get(original_url) or get_sidecar_sha256(url)
+    )
+    recorded_sha256 = get_recorded_sha256(original_url)
+    if expected_sha256 != None:
+        if actual_sha256 != expected_sha256.lower():
+            os.remove(part_path)
+            raise DownloadError(
+                "Checksum mismatch for {}: expected {}, got {}".format(
+                    url, expected_sha256, actual_sha256
+                )
+            )
+    elif recorded_sha256 != None:
+        if actual_sha256 != recorded_sha256:
+            os.remove(part_path)
+            recorded_path = get_recorded_sha256_path(original_url)
+            raise DownloadError(
+                "{} changed since it was first downloaded: ".format(url)
+                + "expected {}, got {}. ".format(recorded_sha256, actual_sha256)
+                + "If that is expected (e.g. for a file that is not pinned to a "
+                + "release), delete '{}'.".format(recorded_path)
+            )
+    else:
+        print(
+            "Warning: Could not verify {}, its SHA-256 is not known. ".format(url)
+            + "Recorded {} to check later downloads.".format(actual_sha256)
+        )
+        record_sha256(original_url, actual_sha256)
+
+    os.replace(part_path, path)
+    return path
+
+
+def get_json_cache_path(url):
+    url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(get_cache_dir(), "json", url_hash + ".json")
+
+
+def get_json(url, max_age=0, mirror=None):
+    """
+    Returns the parsed JSON document at url. Responses are cached on disk and used
+    without a request for max_age seconds. After that they are revalidated with
+    their ETag (a \"304 Not Modified\" from the GitHub API does not count against
+    the rate limit). If the server can not be reached, the cached copy is used.
+    """
+    cache_path = get_json_cache_path(url)
+    cached = None
+    if os.path.isfile(cache_path):
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+        except ValueError:
+            pass
+
+    now = time.time()
+    if cached != None and now - cached["time"] < max_age:
+        return cached["data"]
+
+    headers = {}
+    if cached != None and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+
+    try:
+        request = Request(get_mirrored_url(url, mirror), headers=headers)
+        with urlopen(request, timeout=timeout) as response:
+            data = json.loads(response.read().decode("utf-8"))
+            etag = response.headers.get("ETag")
+    except HTTPError as exc:
+        if exc.code == 304 and cached != None:
+            data, etag = cached["data"], cached.get("etag")
+        elif cached != None:
+            print("Could not retrieve {} ({}). Using cached copy.".format(url, exc))
+            return cached["data"]
+        else:
+            raise DownloadError("Could not retrieve {}: {}".format(url, exc))
+    except (URLError, OSError, http.client.HTTPException, ValueError) as exc:
+        if cached != None:
+            print("Could not retrieve {} ({}). Using cached copy.".format(url, exc))
+            return cached["data"]
+        raise DownloadError("Could not retrieve {}: {}".format(url, exc))
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(cache_path, uuid.uuid4().hex)
+    with open(tmp_path, "w") as f:
+        json.dump({"url": url, "etag": etag, "time": now, "data": data}, f)
+    os.replace(tmp_path, cache_path)
+    return data
+
+
+def check_zip(path):
+    # Used if no checksum is known, so a broken download is not cached
+    try:
+        with zipfile.ZipFile(path) as f:
+            bad_file = f.testzip()
+    except zipfile.BadZipFile as exc:
+        raise DownloadError("Downloaded file '{}' is not a valid zip: {}".format(path, exc))
+    if bad_file != None:
+        raise DownloadError("Downloaded file '{}' is corrupt ({})".format(path, bad_file))
@@ -0,0 +1,18 @@
+class MakeloveError(Exception):
+    """Base class of all errors makelove reports. The message is meant for the user."""
+
+
+class ConfigError(MakeloveError):
+    """The configuration is invalid or could not be loaded."""
+
+
+class HookError(MakeloveError):
+    """A hook could not be loaded or failed."""
+
+
+class DownloadError(MakeloveError):
+    """Löve binaries or tools could not be downloaded."""
+
+
+class BuildError(MakeloveError):
+    """A build step failed."""
@@ -1,25 +1,32 @@
 import fnmatch
 import os
 import re
-import sys
+
+from .errors import BuildError
 
 
 class FileList(object):
-    def __init__(self, path):
+    def __init__(self, path, full_list=None):
         self.dir = path
         self.full_list = []
         self.file_list = set()
+        if full_list != None:
+            # Paths that are not on disk (e.g. the entries of a .love file)
+            self.full_list = [os.path.join(".", path) for path in full_list]
+            return
         dirs_seen = set()
         for root, dirs, files in os.walk(self.dir, followlinks=True):
             for d in dirs:
                 realpath = os.path.realpath(os.path.join(root, d))
                 if realpath in dirs_seen:
-                    sys.exit("Detected infinite recursion while walking directory")
+                    raise BuildError("Detected infinite recursion while walking directory")
                 dirs_seen.add(realpath)
 
             for fname in files:
-                path = os.path.join(root, fname)
-                self.full_list.append(path)
+                # The patterns are matched against paths relative to self.dir,
+                # which start with "./"
+                path = os.path.relpath(os.path.join(root, fname), self.dir)
+                self.full_list.append(os.path.join(".", path))
 
     def include(self, pattern):
         matches = set(fnmatch.filter(self.full_list, pattern))
@@ -29,10 +36,11 @@ class FileList(object):
 
     def include_raw(self, item):
         path = os.path.join(".", os.path.normpath(item))
-        if os.path.isfile(path):
+        full_path = os.path.join(self.dir, path)
+        if os.path.isfile(full_path):
             self.file_list.add(path)
         # we ignore directories (which git doesn't track) and symlinks (which git does track!)
-        elif not os.path.exists(path):
+        elif not os.path.exists(full_path):
             raise FileNotFoundError
         else:
             print("'{}' is not a file!".format(path))
@@ -46,3 +54,18 @@ class FileList(object):
     def __iter__(self):
         for path in sorted(self.file_list):
             yield path
+
+
+def get_matching_files(directory, rules, paths=None):
+    # Applies include ("+" or no prefix) and exclude ("-") rules like love_files
+    # and returns the matching paths relative to directory. If paths is given,
+    # the rules are applied to these instead of the files in directory.
+    file_list = FileList(directory, paths)
+    for rule in rules:
+        if rule[0] == "-":
+            file_list.exclude(rule[1:])
+        elif rule[0] == "+":
+            file_list.include(rule[1:])
+        else:
+            file_list.include(rule)
+    return [os.path.normpath(path) for path in file_list]
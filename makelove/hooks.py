@@ -1,23 +1,181 @@
 import subprocess
 import tempfile
+import contextvars
 import copy
+import glob
+import hashlib
+import importlib
+import importlib.machinery
+import importlib.util
+import json
 import shlex
 import sys
 import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import toml
 
-from .config import get_config
-from .util import tmpfile
+from .config import get_config, validate_config
+from .errors import ConfigError, HookError
+from .util import get_environment, tmpfile
 
+python_hook_prefix = "python:"
+hook_entry_point_group = "makelove.hooks"
+
+
+def load_hook_entry_point(name):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:  # Python 3.7
+        import pkg_resources
+
+        matches = list(pkg_resources.iter_entry_points(hook_entry_point_group, name))
+    else:
+        eps = entry_points()
+        if hasattr(eps, "select"):
+            matches = list(eps.select(group=hook_entry_point_group, name=name))
+        else:  # Python < 3.10
+            matches = [
+                ep for ep in eps.get(hook_entry_point_group, []) if ep.name == name
+            ]
+
+    if len(matches) == 0:
+        raise HookError(
+            "Could not find a '{}' entry point named '{}'".format(
+                hook_entry_point_group, name
+            )
+        )
+    return matches[0].load()
+
+
+def get_project_package(project_dir):
+    """
+    Returns the name of a package for the modules of the project in
+    project_dir, so that the hook modules of different projects (built in one
+    process by a batch or the daemon) can have the same name.
+    """
+    name = "makelove_project_{}".format(
+        hashlib.sha256(project_dir.encode("utf-8")).hexdigest()[:16]
+    )
+    if not name in sys.modules:
+        spec = importlib.machinery.ModuleSpec(name, None, is_package=True)
+        spec.submodule_search_locations = [project_dir]
+        sys.modules.setdefault(name, importlib.util.module_from_spec(spec))
+    return name
+
+
+def import_hook_module(module_name, project_dir):
+    package = get_project_package(os.path.abspath(project_dir))
+    top_level = package + "." + module_name.split(".")[0]
+    if importlib.util.find_spec(top_level) == None:
+        # Not a module of the project, e.g. an installed package
+        return importlib.import_module(module_name)
+    return importlib.import_module(package + "." + module_name)
+
+
+def load_python_hook(spec, project_dir="."):
+    # "module:function" or the name of an entry point in the group "makelove.hooks"
+    if ":" not in spec:
+        return load_hook_entry_point(spec)
+
+    module_name, function_name = spec.split(":", 1)
+    try:
+        module = import_hook_module(module_name, project_dir)
+    except ImportError as exc:
+        raise HookError("Could not import hook module '{}': {}".format(module_name, exc))
+    try:
+        return getattr(module, function_name)
+    except AttributeError:
+        raise HookError(
+            "Hook module '{}' has no attribute '{}'".format(module_name, function_name)
+        )
+
+
+def execute_python_hook(
+    command,
+    config,
+    version,
+    targets,
+    build_directory,
+    modifies_config=True,
+    project_dir=".",
+):
+    hook = load_python_hook(command[len(python_hook_prefix) :], project_dir)
+
+    hook_config = copy.deepcopy(config)
+    try:
+        new_config = hook(hook_config, version, targets, build_directory)
+    except Exception as e:
+        raise HookError("Hook '{}' failed: {}".format(command, e))
+
+    if not modifies_config:
+        return config
+
+    # Hooks may modify the config in place and not return anything
+    if new_config == None:
+        new_config = hook_config
+    validate_config(new_config)
+    return new_config
+
+
+def is_output_captured():
+    # E.g. for the log of a batch build or by the daemon (see batch.ThreadOutput)
+    if hasattr(sys.stdout, "is_capturing"):
+        return sys.stdout.is_capturing()
+    return sys.stdout is not sys.__stdout__
+
+
+def run_command(command, env, cwd):
+    if not is_output_captured():
+        # The command writes to the terminal directly (with colors, progress
+        # bars and its stderr kept separate)
+        subprocess.run(command, shell=True, check=True, env=env, cwd=cwd)
+        return
+
+    # The output is written to sys.stdout instead of the file descriptor, so it
+    # ends up in the log of a batch build or is sent to the client of the daemon
+    with subprocess.Popen(
+        command,
+        shell=True,
+        env=env,
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    ) as process:
+        for line in iter(process.stdout.readline, b""):
+            sys.stdout.write(line.decode("utf-8", errors="replace"))
+            sys.stdout.flush()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def execute_hook(
+    command,
+    config,
+    version,
+    targets,
+    build_directory,
+    modifies_config=True,
+    project_dir=".",
+):
+    if command.startswith(python_hook_prefix):
+        return execute_python_hook(
+            command,
+            config,
+            version,
+            targets,
+            build_directory,
+            modifies_config,
+            project_dir,
+        )
 
-def execute_hook(command, config, version, targets, build_directory):
     tmp_config_path = tmpfile(suffix=".toml")
 
     with open(tmp_config_path, "w") as f:
         toml.dump(config, f)
 
-    env = os.environ.copy()
+    env = dict(get_environment())
     env.update({
         "MAKELOVE_TEMP_CONFIG": tmp_config_path,
         "MAKELOVE_VERSION": version or "",
@@ -30,10 +188,286 @@ def execute_hook(command, config, version, targets, build_directory):
     )
 
     try:
-        subprocess.run(command_replaced, shell=True, check=True, env=env)
+        run_command(command_replaced, env, project_dir)
     except Exception as e:
-        sys.exit("Hook '{}' failed: {}".format(command, e))
+        raise HookError("Hook '{}' failed: {}".format(command, e))
+
+    if not modifies_config:
+        os.remove(tmp_config_path)
+        return config
 
-    new_config = get_config(tmp_config_path)
+    new_config = get_config(tmp_config_path, project_dir)
     os.remove(tmp_config_path)
     return new_config
+
+
+Hook = namedtuple(
+    "Hook", ["name", "command", "after", "modifies_config", "inputs", "outputs"]
+)
+
+
+def get_hooks(config, hook):
+    hooks = []
+    for i, entry in enumerate(config["hooks"][hook]):
+        if isinstance(entry, str):
+            # Plain commands run after the hook before them and may modify the
+            # config, which is how all hooks behaved before hooks could be declared.
+            name = entry
+            if any(h.name == name for h in hooks):
+                name = "{} #{}".format(entry, i + 1)
+            after = [hooks[-1].name] if len(hooks) > 0 else []
+            hooks.append(Hook(name, entry, after, True, None, None))
+        else:
+            if not "command" in entry:
+                raise ConfigError("Hook #{} in '{}' has no command".format(i + 1, hook))
+            name = entry.get("name", entry["command"])
+            if any(h.name == name for h in hooks):
+                raise ConfigError("Duplicate hook name '{}' in '{}'".format(name, hook))
+            hooks.append(
+                Hook(
+                    name,
+                    entry["command"],
+                    entry.get("after", []),
+                    entry.get("modifies_config", False),
+                    entry.get("inputs"),
+                    entry.get("outputs", []),
+                )
+            )
+
+    names = [h.name for h in hooks]
+    for h in hooks:
+        for dependency in h.after:
+            if not dependency in names:
+                raise ConfigError(
+                    "Hook '{}' depends on unknown hook '{}'".format(h.name, dependency)
+                )
+    return hooks
+
+
+def get_config_changes(old_config, new_config):
+    changed = {k: v for k, v in new_config.items() if old_config.get(k) != v}
+    removed = [k for k in old_config if not k in new_config]
+    return changed, removed
+
+
+def apply_config_changes(config, changes):
+    changed, removed = changes
+    for k, v in changed.items():
+        config[k] = copy.deepcopy(v)
+    for k in removed:
+        config.pop(k, None)
+
+
+def get_hook_state_path(build_directory):
+    return os.path.join(build_directory, ".makelove-hookstate")
+
+
+def load_hook_state(path):
+    if os.path.isfile(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except ValueError:
+            pass
+    return {}
+
+
+def save_hook_state(path, state):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def get_files_fingerprint(patterns, project_dir="."):
+    paths = set()
+    for pattern in patterns:
+        for path in glob.glob(os.path.join(project_dir, pattern), recursive=True):
+            if os.path.isfile(path):
+                paths.add(os.path.relpath(path, project_dir))
+    file_hash = hashlib.sha256()
+    for path in sorted(paths):
+        stat = os.stat(os.path.join(project_dir, path))
+        file_hash.update(
+            "{}\0{}\0{}\n".format(path, stat.st_size, stat.st_mtime_ns).encode("utf-8")
+        )
+    return file_hash.hexdigest(), len(paths)
+
+
+def get_hook_fingerprint(h, config, version, targets, build_directory, project_dir):
+    inputs, _ = get_files_fingerprint(h.inputs, project_dir)
+    data = {
+        "command": h.command,
+        "config": config,
+        "version": version,
+        "targets": targets,
+        "build_directory": build_directory,
+        "inputs": inputs,
+    }
+    # default=str for the dates toml can produce
+    data = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def is_hook_up_to_date(h, fingerprint, hook_state, project_dir):
+    if hook_state == None or hook_state["fingerprint"] != fingerprint:
+        return False
+    outputs, num_outputs = get_files_fingerprint(h.outputs, project_dir)
+    if len(h.outputs) > 0 and num_outputs == 0:
+        return False
+    return hook_state["outputs"] == outputs
+
+
+def execute_hooks(hook, config, version, targets, build_directory, project_dir="."):
+    """
+    Executes all hooks of the given stage with up to hooks.max_parallel hooks at
+    the same time, each as soon as all hooks listed in its "after" are done.
+    Every hook sees the config with the changes of the hooks it (transitively)
+    depends on. To keep the result independent of the order in which the hooks
+    finish, the (top level) changes of all hooks are applied in the order the
+    hooks are declared in.
+    """
+    if not "hooks" in config or not hook in config["hooks"]:
+        return
+
+    hooks = get_hooks(config, hook)
+    max_parallel = config["hooks"].get("max_parallel", os.cpu_count() or 1)
+    base_config = copy.deepcopy(config)
+
+    # Hooks that declare their inputs are skipped if neither the inputs nor the
+    # config they get nor their outputs changed since their last successful run.
+    state_path = get_hook_state_path(config.get("build_directory", build_directory))
+    state = load_hook_state(state_path)
+    stage_state = state.setdefault(hook, {})
+
+    if max_parallel < 1:
+        raise ConfigError("hooks.max_parallel has to be at least 1")
+
+    # All hooks each hook depends on, directly or indirectly
+    after = {h.name: h.after for h in hooks}
+    dependencies = {}
+    for h in hooks:
+        dependencies[h.name] = set()
+        stack = list(h.after)
+        while len(stack) > 0:
+            dependency = stack.pop()
+            if not dependency in dependencies[h.name]:
+                dependencies[h.name].add(dependency)
+                stack.extend(after[dependency])
+
+    def run_hook(h, hook_config):
+        if h.inputs == None:
+            new_config = execute_hook(
+                h.command,
+                hook_config,
+                version,
+                targets,
+                build_directory,
+                h.modifies_config,
+                project_dir,
+            )
+            return new_config, None
+
+        fingerprint = get_hook_fingerprint(
+            h, hook_config, version, targets, build_directory, project_dir
+        )
+        hook_state = stage_state.get(h.name)
+        if is_hook_up_to_date(h, fingerprint, hook_state, project_dir):
+            print("Skipping hook '{}' (inputs unchanged)".format(h.name))
+            new_config = copy.deepcopy(hook_config)
+            if hook_state.get("changes") != None:
+                apply_config_changes(new_config, hook_state["changes"])
+            return new_config, hook_state
+
+        new_config = execute_hook(
+            h.command,
+            hook_config,
+            version,
+            targets,
+            build_directory,
+            h.modifies_config,
+            project_dir,
+        )
+        hook_state = {
+            "fingerprint": fingerprint,
+            "outputs": get_files_fingerprint(h.outputs, project_dir)[0],
+            "changes": None,
+        }
+        if h.modifies_config:
+            hook_state["changes"] = get_config_changes(hook_config, new_config)
+        return new_config, hook_state
+
+    def get_hook_config(h):
+        hook_config = copy.deepcopy(base_config)
+        for other in hooks:
+            if other.name in dependencies[h.name] and other.name in changes:
+                apply_config_changes(hook_config, changes[other.name])
+        return hook_config
+
+    def save_state():
+        if not any(h.inputs != None for h in hooks):
+            return
+        try:
+            save_hook_state(state_path, state)
+        except (TypeError, ValueError):
+            # The config changes can not be stored (e.g. dates in the config)
+            for h in hooks:
+                if h.modifies_config:
+                    stage_state.pop(h.name, None)
+            save_hook_state(state_path, state)
+
+    changes = {}
+    done = set()
+    pending = list(hooks)
+    running = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                for h in list(pending):
+                    if len(running) >= max_parallel:
+                        break
+                    if all(dependency in done for dependency in h.after):
+                        hook_config = get_hook_config(h)
+                        # In a copy of the context, so captured output stays captured
+                        future = executor.submit(
+                            contextvars.copy_context().run, run_hook, h, hook_config
+                        )
+                        running[future] = (h, hook_config)
+                        pending.remove(h)
+
+                if len(running) == 0:
+                    raise ConfigError(
+                        "Circular dependency between hooks: {}".format(
+                            ", ".join(h.name for h in pending)
+                        )
+                    )
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    h, hook_config = running.pop(future)
+                    new_config, hook_state = future.result()
+                    if hook_state != None:
+                        stage_state[h.name] = hook_state
+                    if h.modifies_config:
+                        changes[h.name] = get_config_changes(hook_config, new_config)
+                    done.add(h.name)
+    except BaseException:
+        # The hooks that succeeded (the executor waited for the ones that were
+        # still running) do not have to run again in the next build
+        for future, (h, _hook_config) in running.items():
+            if future.done() and not future.cancelled() and future.exception() == None:
+                hook_state = future.result()[1]
+                if hook_state != None:
+                    stage_state[h.name] = hook_state
+        save_state()
+        raise
+
+    for h in hooks:
+        if h.name in changes:
+            apply_config_changes(base_config, changes[h.name])
+    validate_config(base_config)
+    save_state()
+
+    config.clear()
+    config.update(base_config)
@@ -0,0 +1,117 @@
+import io
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, UnidentifiedImageError, __version__ as pillow_version
+
+from .binarycache import get_converted_file
+from .filelist import get_matching_files
+from .util import format_size
+
+# Bump this if optimize_png changes, so the cached results are not used anymore
+optimizer_version = "1"
+
+# Modes that can be compared losslessly after converting them to RGBA
+simple_modes = ["1", "L", "LA", "P", "RGB", "RGBA"]
+
+
+def encode_png(image):
+    params = {"optimize": True}
+    if "transparency" in image.info:
+        params["transparency"] = image.info["transparency"]
+    data = io.BytesIO()
+    image.save(data, "PNG", **params)
+    return data.getvalue()
+
+
+def reduce_colors(rgba):
+    # Returns the smallest mode (grayscale or palette) that can represent all
+    # pixels of rgba exactly or None if there is none
+    opaque = rgba.getextrema()[3][0] == 255
+    colors = rgba.getcolors(256)
+    if colors == None:
+        return rgba.convert("RGB") if opaque else None
+
+    colors = [color for _count, color in colors]
+    if opaque and all(r == g == b for r, g, b, _a in colors):
+        return rgba.convert("L")
+
+    index = {color: i for i, color in enumerate(colors)}
+    palette_image = Image.frombytes(
+        "P", rgba.size, bytes(index[color] for color in rgba.getdata())
+    )
+    palette_image.putpalette([v for color in colors for v in color[:3]])
+    if not opaque:
+        palette_image.info["transparency"] = bytes(color[3] for color in colors)
+    return palette_image
+
+
+def optimize_png(source_path, output_path):
+    """
+    Re-encodes the PNG at source_path without metadata, with the smallest
+    lossless color mode and zlib's best compression. Writes the original if
+    that is not smaller or the file is not a plain PNG.
+    """
+    with open(source_path, "rb") as f:
+        best = f.read()
+
+    try:
+        image = Image.open(io.BytesIO(best))
+        image.load()
+    except (UnidentifiedImageError, OSError):
+        image = None
+    animated = getattr(image, "is_animated", False)
+    if image != None and image.format == "PNG" and not animated:
+        if image.mode in simple_modes:
+            reference = image.convert("RGBA")
+            candidates = [image]
+            reduced = reduce_colors(reference)
+            if reduced != None:
+                candidates.append(reduced)
+        else:
+            reference = image
+            candidates = [image]
+
+        for candidate in candidates:
+            # Everything but the pixels (text, exif, icc profile, ...) is dropped
+            candidate.info = {
+                k: v for k, v in candidate.info.items() if k == "transparency"
+            }
+            data = encode_png(candidate)
+            if len(data) >= len(best):
+                continue
+            # Only use the result if it is really lossless
+            decoded = Image.open(io.BytesIO(data))
+            if decoded.mode != reference.mode:
+                decoded = decoded.convert(reference.mode)
+            if decoded.tobytes() == reference.tobytes():
+                best = data
+
+    with open(output_path, "wb") as f:
+        f.write(best)
+
+
+def optimize_game_directory(config, game_directory):
+    """
+    Replaces the images in game_directory that match optimize_images.files with
+    their optimized versions from the cache (see optimize_png), which are
+    created in up to optimize_images.max_parallel threads if necessary.
+    """
+    section = config["optimize_images"]
+    paths = get_matching_files(game_directory, section.get("files", ["*.png"]))
+    key = "{}\0{}".format(optimizer_version, pillow_version)
+
+    def optimize(path):
+        full_path = os.path.join(game_directory, path)
+        size = os.path.getsize(full_path)
+        optimized_path = get_converted_file(
+            full_path, "images", ".png", optimize_png, key
+        )
+        shutil.copyfile(optimized_path, full_path)
+        return size - os.path.getsize(full_path)
+
+    max_parallel = section.get("max_parallel", os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel)) as executor:
+        saved = list(executor.map(optimize, paths))
+    print("Optimized {} images, saved {}".format(len(paths), format_size(sum(saved))))
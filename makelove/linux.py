@@ -1,50 +1,73 @@
 import os
-import sys
-from urllib.request import urlretrieve, urlopen, URLError
 import shutil
 import subprocess
 import re
-import json
+import struct
+import time
 from collections import namedtuple
 
 from PIL import Image, UnidentifiedImageError
-import appdirs
 
-from .util import fuse_files, tmpfile, parse_love_version, ask_yes_no
+from .binarycache import CacheEntry, ensure, get_cache_dir
+from . import download
+from . import util
+from .util import fuse_files, parse_love_version, ask_yes_no, get_source_date_epoch
 from .config import all_love_versions, should_build_artifact
+from .errors import BuildError, DownloadError
 
 
 def get_appimagetool_path():
-    return os.path.join(appdirs.user_cache_dir("makelove"), "appimagetool")
+    return os.path.join(get_cache_dir(), "tools", "appimagetool", "appimagetool")
 
 
-def download_love_appimage(version):
+# Resolving the URL might require asking the user, so it is kept in memory,
+# but only as long as the release metadata is fresh. The daemon and batch builds
+# run for a long time and have to pick up new releases.
+appimage_urls = {}
+
+
+def get_love_appimage_url(version, release_cache_ttl, mirror):
+    key = (version, release_cache_ttl, mirror)
+    cached = appimage_urls.get(key)
+    if cached != None and time.monotonic() - cached[0] < release_cache_ttl:
+        return cached[1]
+    url = resolve_love_appimage_url(version, release_cache_ttl, mirror)
+    appimage_urls[key] = (time.monotonic(), url)
+    return url
+
+
+def resolve_love_appimage_url(version, release_cache_ttl, mirror):
     parsed_version = parse_love_version(version)
 
     # If we're building for 11.4 or later, use the official appimages.
     if (parsed_version[0], parsed_version[1]) >= (11, 4):
-        return download_official_appimage(version)
+        return get_official_appimage_url(version, release_cache_ttl, mirror)
+
+    return get_legacy_appimage_url(version, release_cache_ttl, mirror)
 
-    return download_legacy_appimage(version)
 
+def get_official_appimage_url(version, release_cache_ttl, mirror):
+    if mirror != None:
+        # The download URLs of the official releases are predictable, so a mirror
+        # does not need to contain the release metadata.
+        return f"https://github.com/love2d/love/releases/download/{version}/love-{version}-x86_64.AppImage"
 
-def download_official_appimage(version):
     url = f"https://api.github.com/repos/love2d/love/releases/tags/{version}"
-    asset_data = get_release_asset_list(url)
+    asset_data = get_release_asset_list(url, release_cache_ttl, mirror)
 
     matching_asset = next(
         (a for a in asset_data if a["name"] == f"love-{version}-x86_64.AppImage"), None
     )
 
     if not matching_asset:
-        sys.exit(f"Could not find AppImage to download for {version}!")
+        raise DownloadError(f"Could not find AppImage to download for {version}!")
 
-    return download_appimage(matching_asset["browser_download_url"])
+    return matching_asset["browser_download_url"]
 
 
-def download_legacy_appimage(version):
+def get_legacy_appimage_url(version, release_cache_ttl, mirror):
     latest_url = "https://api.github.com/repos/pfirsich/love-appimages/releases/latest"
-    asset_data = get_release_asset_list(latest_url)
+    asset_data = get_release_asset_list(latest_url, release_cache_ttl, mirror)
 
     Asset = namedtuple("Asset", ["name", "version", "download_url"])
     appimages = []
@@ -61,7 +84,9 @@ def download_legacy_appimage(version):
         appimg for appimg in appimages if appimg.version[0] == parsed_version[0]
     ]
     if len(same_major) == 0:
-        sys.exit("Did not find an available AppImage with matching major version")
+        raise DownloadError(
+            "Did not find an available AppImage with matching major version"
+        )
     same_major.sort(key=lambda x: x.version, reverse=True)
     download_asset = same_major[0]
     if download_asset.version != parsed_version:
@@ -71,77 +96,167 @@ def download_legacy_appimage(version):
                 ".".join(map(str, download_asset.version))
             )
         )
+        if not util.can_ask():
+            raise DownloadError(
+                "Set love_version to {} to use that AppImage".format(
+                    ".".join(map(str, download_asset.version))
+                )
+            )
         if not ask_yes_no("Use {} instead?".format(download_asset.name), default=True):
-            sys.exit("Aborting.")
+            raise DownloadError("Aborting.")
 
-    return download_appimage(download_asset.download_url)
+    return download_asset.download_url
 
 
-def get_release_asset_list(url):
+def get_release_asset_list(url, release_cache_ttl, mirror):
     try:
-        with urlopen(url) as req:
-            data = json.loads(req.read().decode())
-    except Exception as exc:
-        sys.exit("Could not retrieve asset list: {}".format(exc))
+        data = download.get_json(url, max_age=release_cache_ttl, mirror=mirror)
+    except DownloadError as exc:
+        raise DownloadError("Could not retrieve asset list: {}".format(exc))
 
     return data["assets"]
 
 
-def download_appimage(url):
-    try:
-        appimage_path = tmpfile(suffix=".AppImage")
-        print("Downloading {}..".format(url))
-        urlretrieve(url, appimage_path)
-        os.chmod(appimage_path, 0o755)
-        return appimage_path
-    except Exception as exc:
-        sys.exit("Could not download löve appimage from {}: {}".format(url, exc))
+def download_executable(url, path, mirror=None):
+    print("Downloading '{}'..".format(url))
+    download.download(url, path, mirror=mirror)
+    os.chmod(path, 0o755)
+
+
+def get_love_appimage_entry(config):
+    assert "love_version" in config
+    release_cache_ttl = config.get("appimage", {}).get("release_cache_ttl", 3600)
+    mirror = download.get_mirror(config)
+    url = get_love_appimage_url(config["love_version"], release_cache_ttl, mirror)
+    # Release assets do not change, so they are cached by their file name
+    name = os.path.basename(url)
+    return CacheEntry(
+        os.path.join(get_cache_dir(), "appimages", os.path.splitext(name)[0]),
+        lambda path: download_executable(
+            url, os.path.join(path, "love.AppImage"), mirror
+        ),
+    )
 
 
-def get_appimagetool():
+def get_appimagetool_entry(config):
+    url = "https://github.com/AppImage/AppImageKit/releases/download/continuous/appimagetool-x86_64.AppImage"
+    appimagetool_path = get_appimagetool_path()
+    mirror = download.get_mirror(config)
+    return CacheEntry(
+        os.path.dirname(appimagetool_path),
+        lambda path: download_executable(
+            url, os.path.join(path, os.path.basename(appimagetool_path)), mirror
+        ),
+    )
+
+
+def get_appimagetool(config):
     which_appimagetool = shutil.which("appimagetool")
     if which_appimagetool:
         return which_appimagetool
     else:
-        appimagetool_path = os.path.join(
-            appdirs.user_cache_dir("makelove"), "appimagetool"
-        )
-        if os.path.isfile(appimagetool_path):
-            return appimagetool_path
+        ensure(get_appimagetool_entry(config))
+        return get_appimagetool_path()
+
+
+def get_downloads(config, target):
+    downloads = []
+    if not (target in config and "source_appimage" in config[target]):
+        downloads.append(get_love_appimage_entry(config))
+    if should_build_artifact(config, target, "appimage", True) and not shutil.which(
+        "appimagetool"
+    ):
+        downloads.append(get_appimagetool_entry(config))
+    return downloads
+
+
+def get_squashfs_offset(appimage_path):
+    # An AppImage is an ELF runtime with a squashfs image appended to it.
+    # The image starts right after the ELF section header table, which is the
+    # last part of the ELF file.
+    with open(appimage_path, "rb") as f:
+        header = f.read(64)
+        if len(header) < 52 or header[:4] != b"\x7fELF":
+            return None
+
+        endianness = {1: "<", 2: ">"}.get(header[5])
+        if endianness == None:
+            return None
+
+        if header[4] == 1:  # ELFCLASS32
+            (shoff,) = struct.unpack_from(endianness + "I", header, 0x20)
+            shentsize, shnum = struct.unpack_from(endianness + "HH", header, 0x2E)
+        elif header[4] == 2 and len(header) >= 64:  # ELFCLASS64
+            (shoff,) = struct.unpack_from(endianness + "Q", header, 0x28)
+            shentsize, shnum = struct.unpack_from(endianness + "HH", header, 0x3A)
+        else:
+            return None
 
-        url = "https://github.com/AppImage/AppImageKit/releases/download/continuous/appimagetool-x86_64.AppImage"
-        try:
-            os.makedirs(os.path.dirname(appimagetool_path), exist_ok=True)
-            print("Downloading '{}'..".format(url))
-            urlretrieve(url, appimagetool_path)
-            os.chmod(appimagetool_path, 0o755)
-            return appimagetool_path
-        except URLError as exc:
-            sys.exit("Could not download appimagetool from {}: {}".format(url, exc))
+        offset = shoff + shentsize * shnum
+        f.seek(offset)
+        if f.read(4) != b"hsqs":
+            return None
+        return offset
 
 
-def build_linux(config, version, target, target_directory, love_file_path):
-    if target in config and "source_appimage" in config[target]:
-        source_appimage = config[target]["source_appimage"]
-        # We need to set the cwd to our extraction destination, so we need to turn this into an absolute path
-        if not os.path.isabs(source_appimage):
-            source_appimage = os.path.join(os.getcwd(), source_appimage)
-    else:
-        assert "love_version" in config
-        # Download it every time, in case it's updated (I might make them smaller)
-        # TODO: this shouldn't be necessary anymore if we're downloading from the official love repo
-        source_appimage = download_love_appimage(config["love_version"])
+def extract_appimage(appimage_path, target_directory):
+    appdir_path = os.path.join(target_directory, "squashfs-root")
+
+    unsquashfs = shutil.which("unsquashfs")
+    offset = get_squashfs_offset(appimage_path) if unsquashfs else None
+    if offset != None:
+        # Reading the squashfs image directly does not require executing the
+        # AppImage (which needs a matching architecture and a working runtime)
+        # and unsquashfs decompresses on all cores.
+        ret = subprocess.run(
+            [
+                unsquashfs,
+                "-offset",
+                str(offset),
+                "-dest",
+                appdir_path,
+                "-processors",
+                str(os.cpu_count() or 1),
+                "-no-progress",
+                "-no-xattrs",
+                appimage_path,
+            ],
+            capture_output=True,
+        )
+        if ret.returncode == 0:
+            return appdir_path
+        print(
+            "unsquashfs failed, falling back to --appimage-extract: {}".format(
+                ret.stderr.decode("utf-8").strip()
+            )
+        )
+        if os.path.isdir(appdir_path):
+            shutil.rmtree(appdir_path)
 
-    print("Extracting source AppImage '{}'..".format(source_appimage))
     ret = subprocess.run(
-        [source_appimage, "--appimage-extract"],
+        [appimage_path, "--appimage-extract"],
         cwd=target_directory,
         capture_output=True,
     )
     if ret.returncode != 0:
-        sys.exit("Could not extract AppImage: {}".format(ret.stderr.decode("utf-8")))
+        raise BuildError(
+            "Could not extract AppImage: {}".format(ret.stderr.decode("utf-8"))
+        )
+    return appdir_path
 
-    appdir_path = os.path.join(target_directory, "squashfs-root")
+
+def build_linux(config, version, target, target_directory, love_file_path):
+    if target in config and "source_appimage" in config[target]:
+        # Already absolute (see resolve_config_paths), the AppImage is extracted
+        # with the target directory as the working directory
+        source_appimage = config[target]["source_appimage"]
+    else:
+        source_appimage = os.path.join(
+            ensure(get_love_appimage_entry(config)), "love.AppImage"
+        )
+
+    print("Extracting source AppImage '{}'..".format(source_appimage))
+    appdir_path = extract_appimage(source_appimage, target_directory)
     appdir = lambda x: os.path.join(appdir_path, x)
 
     game_name = config["name"]
@@ -176,7 +291,7 @@ def build_linux(config, version, target, target_directory, love_file_path):
         os.remove(appdir("bin/love"))
         desktop_exec = f"{game_name} %f"
     else:
-        sys.exit(
+        raise BuildError(
             "Could not find love executable in AppDir. The AppImage has an unknown format."
         )
 
@@ -196,11 +311,11 @@ def build_linux(config, version, target, target_directory, love_file_path):
                 img = Image.open(icon_file)
                 img.save(dest_icon_path)
             except FileNotFoundError as exc:
-                sys.exit("Could not find icon file: {}".format(exc))
+                raise BuildError("Could not find icon file: {}".format(exc))
             except UnidentifiedImageError as exc:
-                sys.exit("Could not read icon file: {}".format(exc))
+                raise BuildError("Could not read icon file: {}".format(exc))
             except IOError as exc:
-                sys.exit("Could not convert icon to .png: {}".format(exc))
+                raise BuildError("Could not convert icon to .png: {}".format(exc))
     # appimagetool will create a symlink from the icon to .DirIcon
     os.remove(appdir(".DirIcon"))
 
@@ -235,7 +350,7 @@ def build_linux(config, version, target, target_directory, love_file_path):
             # Official AppImages (since 11.4)
             so_target_dir = appdir("lib/")
         else:
-            sys.exit(
+            raise BuildError(
                 "Could not find liblove.so in AppDir. The AppImage has an unknown format."
             )
 
@@ -246,11 +361,21 @@ def build_linux(config, version, target, target_directory, love_file_path):
     if should_build_artifact(config, target, "appimage", True):
         print("Creating new AppImage..")
         appimage_path = os.path.join(target_directory, f"{game_name}.AppImage")
+        env = None
+        source_date_epoch = get_source_date_epoch(config)
+        if source_date_epoch != None:
+            # mksquashfs (used by appimagetool) uses it for all timestamps
+            env = dict(util.get_environment())
+            env["SOURCE_DATE_EPOCH"] = str(source_date_epoch)
         ret = subprocess.run(
-            [get_appimagetool(), appdir_path, appimage_path], capture_output=True
+            [get_appimagetool(config), appdir_path, appimage_path],
+            capture_output=True,
+            env=env,
         )
         if ret.returncode != 0:
-            sys.exit("Could not create appimage: {}".format(ret.stderr.decode("utf-8")))
+            raise BuildError(
+                "Could not create appimage: {}".format(ret.stderr.decode("utf-8"))
+            )
         print("Created {}".format(appimage_path))
 
     if should_build_artifact(config, target, "appdir", False):
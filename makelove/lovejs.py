@@ -1,34 +1,57 @@
+import hashlib
 import html
 import json
 import os
-import sys
+import posixpath
+import shutil
 import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from zipfile import ZipFile
-from urllib.request import urlretrieve, URLError
+from zipfile import ZipFile, ZIP_STORED
 
-from .util import eprint, get_default_love_binary_dir, parse_love_version
+from .binarycache import CacheEntry, ensure, get_cache_dir, touch
+from .download import download, check_zip, get_mirror
+from .errors import ConfigError, DownloadError
+from .filelist import get_matching_files
+from .config import should_build_artifact
+from .util import (
+    eprint,
+    get_archive_date_time,
+    get_default_love_binary_dir,
+    parse_love_version,
+)
+from .ziputil import copy_entry_raw, copy_chunk_size, new_zipinfo, write_file_streamed
 
 
-def download_love(version, platform):
-    if parse_love_version(version)[0] != 11:
-        eprint("love.js only supports löve 11. The web build might not be functional.")
-
-    target_path = get_default_love_binary_dir(version, platform)
-    print("Downloading love binaries to: '{}'".format(target_path))
-
-    os.makedirs(target_path, exist_ok=True)
+def download_love(version, platform, target_path, mirror=None):
     try:
         download_url = "https://github.com/Davidobot/love.js/archive/master.zip"
         print("Downloading '{}'..".format(download_url))
-        urlretrieve(download_url, os.path.join(target_path, "love.zip"))
-    except URLError as exc:
-        eprint("Could not download löve: {}".format(exc))
-        eprint(
-            "If there is in fact no download on GitHub for this version, specify 'love_binaries' manually."
+        download(download_url, os.path.join(target_path, "love.zip"), mirror=mirror)
+        check_zip(os.path.join(target_path, "love.zip"))
+    except DownloadError as exc:
+        raise DownloadError(
+            "Could not download löve: {}\n".format(exc)
+            + "If there is in fact no download on GitHub for this version, specify 'love_binaries' manually."
         )
-        sys.exit(1)
-    print("Download complete")
+    print("Download of love.js complete")
+
+
+def get_love_binaries_entry(config, target):
+    assert "love_version" in config
+    version = config["love_version"]
+    mirror = get_mirror(config)
+    return CacheEntry(
+        get_default_love_binary_dir(version, target),
+        lambda path: download_love(version, target, path, mirror),
+    )
+
+
+def get_downloads(config, target):
+    if target in config and "love_binaries" in config[target]:
+        return []
+    return [get_love_binaries_entry(config, target)]
 
 
 # Simplified [mustache](https://github.com/janl/mustache.js) templating used by love.js
@@ -40,78 +63,317 @@ def render_mustache(tmpl, cx):
     return tmpl.encode("utf-8")
 
 
+# Deferred packages are only requested once the game is running, so they do not
+# delay the start. The package scripts write their files into the file system
+# as soon as they have been downloaded.
+deferred_loader_template = """<script type="text/javascript">
+(function () {{
+  var scripts = {};
+  (function loadWhenRunning() {{
+    if (typeof Module === "undefined" || !Module.calledRun) {{
+      setTimeout(loadWhenRunning, 100);
+      return;
+    }}
+    scripts.forEach(function (src) {{
+      var script = document.createElement("script");
+      script.src = src;
+      document.body.appendChild(script);
+    }});
+  }})();
+}})();
+</script>
+"""
+
+
+def get_file_packages(lovejs_config, love_zip):
+    # Returns a list of lists of .love entries. The first package is loaded
+    # before the game starts, the others are loaded in the background.
+    deferred_patterns = lovejs_config.get("deferred_files", [])
+    chunk_size = lovejs_config.get("chunk_size", 32 * 1024 * 1024)
+
+    infos = [info for info in love_zip.infolist() if not info.is_dir()]
+    deferred_paths = set()
+    if len(deferred_patterns) > 0:
+        paths = [info.filename for info in infos]
+        deferred_paths = set(get_matching_files(None, deferred_patterns, paths))
+    boot_files = []
+    deferred_files = []
+    for info in infos:
+        if os.path.normpath(info.filename) in deferred_paths:
+            deferred_files.append(info)
+        else:
+            boot_files.append(info)
+
+    packages = [boot_files]
+    current_size = chunk_size
+    for info in deferred_files:
+        if current_size + info.file_size > chunk_size and current_size > 0:
+            packages.append([])
+            current_size = 0
+        packages[-1].append(info)
+        current_size += info.file_size
+    return packages
+
+
+def write_file_package(app_zip, arcname, love_zip, package_files, date_time=None):
+    file_metadata = []
+    offset = 0
+    zinfo = new_zipinfo(app_zip, arcname, date_time)
+    with app_zip.open(zinfo, "w", force_zip64=True) as package_data:
+        for info in package_files:
+            with love_zip.open(info) as f:
+                shutil.copyfileobj(f, package_data, copy_chunk_size)
+            file_metadata.append(
+                {
+                    "filename": "/game/" + info.filename,
+                    "crunched": 0,
+                    "start": offset,
+                    "end": offset + info.file_size,
+                    "audio": False,
+                }
+            )
+            offset += info.file_size
+    return file_metadata, offset
+
+
+def get_package_uuid(love_zip, package_files, reproducible):
+    # In reproducible builds the uuid is derived from the files in the package
+    if not reproducible:
+        return uuid.uuid4().hex
+    package_hash = hashlib.sha256()
+    for info in love_zip.infolist() if package_files == None else package_files:
+        line = "{}\0{}\0{}\n".format(info.filename, info.file_size, info.CRC)
+        package_hash.update(line.encode("utf-8"))
+    return uuid.uuid5(uuid.NAMESPACE_URL, package_hash.hexdigest()).hex
+
+
+def get_create_file_paths(file_metadata):
+    dirs = set()
+    for f in file_metadata:
+        path = posixpath.dirname(f["filename"])
+        while path != "/":
+            dirs.add(path)
+            path = posixpath.dirname(path)
+
+    lines = []
+    for path in sorted(dirs):
+        parent, name = posixpath.split(path)
+        lines.append(
+            "Module['FS_createPath']({}, {}, true, true);".format(
+                json.dumps(parent), json.dumps(name)
+            )
+        )
+    return "\n".join(lines)
+
+
+precompressed_extensions = [".html", ".js", ".wasm", ".data", ".css"]
+precompressed_extensions_by_algorithm = {"gzip": ".gz", "brotli": ".br"}
+
+
+def get_precompressed_cache_dir():
+    return os.path.join(get_cache_dir(), "precompressed")
+
+
+# Returns a (compress, flush) pair of functions
+def get_compressor(algorithm):
+    if algorithm == "gzip":
+        # wbits = 31 produces a gzip header and trailer
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+        return compressor.compress, compressor.flush
+    elif algorithm == "brotli":
+        try:
+            import brotli
+        except ImportError:
+            raise ConfigError(
+                "The 'brotli' package is required for lovejs.precompress = \"brotli\". Install it with: pip install brotli"
+            )
+        compressor = brotli.Compressor(quality=9)
+        return compressor.process, compressor.finish
+    assert False
+
+
+def precompress_entry(zip_path, name, algorithms):
+    # The results are cached by content hash, so unchanged files (e.g. love.wasm)
+    # are only compressed once.
+    with ZipFile(zip_path) as app_zip:
+        content_hash = hashlib.sha256()
+        with app_zip.open(name) as f:
+            for chunk in iter(lambda: f.read(copy_chunk_size), b""):
+                content_hash.update(chunk)
+
+        sidecars = []
+        for algorithm in algorithms:
+            extension = precompressed_extensions_by_algorithm[algorithm]
+            cache_path = os.path.join(
+                get_precompressed_cache_dir(), content_hash.hexdigest() + extension
+            )
+            if os.path.isfile(cache_path):
+                touch(cache_path)
+            else:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                tmp_path = "{}.{}.tmp".format(cache_path, uuid.uuid4().hex)
+                compress, flush = get_compressor(algorithm)
+                with app_zip.open(name) as f, open(tmp_path, "wb") as out:
+                    for chunk in iter(lambda: f.read(copy_chunk_size), b""):
+                        out.write(compress(chunk))
+                    out.write(flush())
+                os.replace(tmp_path, cache_path)
+            sidecars.append((name + extension, cache_path))
+        return sidecars
+
+
+def precompress_entries(zip_path, algorithms):
+    """
+    Returns a list of (name in the zip + extension, path of compressed file)
+    for every compressible file in the web build and every algorithm.
+    """
+    if len(algorithms) == 0:
+        return []
+
+    with ZipFile(zip_path) as app_zip:
+        names = [
+            name
+            for name in app_zip.namelist()
+            if os.path.splitext(name)[1] in precompressed_extensions
+        ]
+
+    print("Precompressing {} files ({})..".format(len(names), ", ".join(algorithms)))
+    with ThreadPoolExecutor() as executor:
+        results = executor.map(
+            lambda name: precompress_entry(zip_path, name, algorithms), names
+        )
+        return [sidecar for sidecars in results for sidecar in sidecars]
+
+
 def build_lovejs(config, version, target, target_directory, love_file_path):
+    if parse_love_version(config["love_version"])[0] != 11:
+        eprint("love.js only supports löve 11. The web build might not be functional.")
+
     if target in config and "love_binaries" in config[target]:
         love_binaries = config[target]["love_binaries"]
     else:
-        assert "love_version" in config
         print("No love binaries specified for target {}".format(target))
-        love_binaries = get_default_love_binary_dir(config["love_version"], target)
-        if os.path.isdir(love_binaries):
-            print("Love binaries already present in '{}'".format(love_binaries))
-        else:
-            download_love(config["love_version"], target)
+        love_binaries = ensure(get_love_binaries_entry(config, target))
+
+    lovejs_config = config.get("lovejs", {})
+    package_mode = lovejs_config.get("package", "love")
+    if package_mode == "love" and "deferred_files" in lovejs_config:
+        raise ConfigError(
+            'lovejs.deferred_files can only be used with lovejs.package = "files"'
+        )
 
-    with open(love_file_path, "rb") as love_zip:
-        game_data = love_zip.read()
+    date_time = get_archive_date_time(config)
+    reproducible = date_time != None
 
     src = Path(love_binaries) / "love.zip"
     dst = Path(target_directory) / f"{config['name']}-{target}.zip"
-    with ZipFile(src, mode="r") as love_binary_zip, ZipFile(dst, mode="w") as app_zip:
-        fileMetadata = [
-            {
-                "filename": "/game.love",
-                "crunched": 0,
-                "start": 0,
-                "end": len(game_data),
-                "audio": False,
-            }
-        ]
-
+    with ZipFile(src, mode="r") as love_binary_zip, ZipFile(
+        dst, mode="w", compression=ZIP_STORED
+    ) as app_zip, ZipFile(love_file_path) as love_zip:
         prefix = love_binary_zip.filelist[0].filename
         if not prefix.endswith("/"):
             prefix = prefix + "/"
-        app_zip.writestr(
-            f"{config['name']}/index.html",
-            render_mustache(
-                love_binary_zip.read(prefix + "src/compat/index.html"),
-                {
-                    "title": config.get("lovejs", {}).get("title", config["name"]),
-                    "arguments": json.dumps(["./game.love"]),
-                    "memory": int(config.get("lovejs", {}).get("memory", "20000000")),
-                },
-            ),
-        )
-        app_zip.writestr(
-            f"{config['name']}/game.js",
-            render_mustache(
-                love_binary_zip.read(prefix + "src/game.js"),
-                {
-                    "create_file_paths": "",
-                    "metadata": json.dumps(
-                        {
-                            "package_uuid": uuid.uuid4().hex,
-                            "remote_package_size": len(game_data),
-                            "files": fileMetadata,
-                        }
-                    ),
-                },
-            ),
-        )
-        app_zip.writestr(f"{config['name']}/game.data", game_data)
-        app_zip.writestr(
-            f"{config['name']}/love.js",
-            love_binary_zip.read(prefix + "src/compat/love.js"),
-        )
-        app_zip.writestr(
-            f"{config['name']}/love.wasm",
-            love_binary_zip.read(prefix + "src/compat/love.wasm"),
-        )
-        app_zip.writestr(
-            f"{config['name']}/theme/love.css",
-            love_binary_zip.read(prefix + "src/compat/theme/love.css"),
+        package_template = love_binary_zip.read(prefix + "src/game.js")
+
+        if package_mode == "files":
+            packages = get_file_packages(lovejs_config, love_zip)
+            game_arguments = ["./game"]
+        else:
+            packages = [None]
+            game_arguments = ["./game.love"]
+
+        package_scripts = []
+        for i, package_files in enumerate(packages):
+            name = "game" if i == 0 else "game-{}".format(i)
+            data_path = f"{config['name']}/{name}.data"
+            if package_files == None:
+                # The .love is a zip itself, so it is stored uncompressed and streamed
+                write_file_streamed(
+                    app_zip, love_file_path, data_path, date_time, reproducible
+                )
+                package_size = os.path.getsize(love_file_path)
+                file_metadata = [
+                    {
+                        "filename": "/game.love",
+                        "crunched": 0,
+                        "start": 0,
+                        "end": package_size,
+                        "audio": False,
+                    }
+                ]
+            else:
+                file_metadata, package_size = write_file_package(
+                    app_zip, data_path, love_zip, package_files, date_time
+                )
+
+            app_zip.writestr(
+                new_zipinfo(app_zip, f"{config['name']}/{name}.js", date_time),
+                render_mustache(
+                    package_template.replace(b"game.data", f"{name}.data".encode()),
+                    {
+                        "create_file_paths": get_create_file_paths(file_metadata),
+                        "metadata": json.dumps(
+                            {
+                                "package_uuid": get_package_uuid(
+                                    love_zip, package_files, reproducible
+                                ),
+                                "remote_package_size": package_size,
+                                "files": file_metadata,
+                            }
+                        ),
+                    },
+                ),
+            )
+            if i > 0:
+                package_scripts.append(f"{name}.js")
+
+        index_html = render_mustache(
+            love_binary_zip.read(prefix + "src/compat/index.html"),
+            {
+                "title": lovejs_config.get("title", config["name"]),
+                "arguments": json.dumps(game_arguments),
+                "memory": int(lovejs_config.get("memory", "20000000")),
+            },
         )
+        if len(package_scripts) > 0:
+            loader = deferred_loader_template.format(json.dumps(package_scripts))
+            index_html = index_html.replace(b"</body>", loader.encode("utf-8") + b"</body>")
         app_zip.writestr(
-            f"{config['name']}/theme/bg.png",
-            love_binary_zip.read(prefix + "src/compat/theme/bg.png"),
+            new_zipinfo(app_zip, f"{config['name']}/index.html", date_time), index_html
         )
+
+        # The runtime files are copied without decompressing and recompressing them
+        for src_name, dest_name in [
+            ("src/compat/love.js", "love.js"),
+            ("src/compat/love.wasm", "love.wasm"),
+            ("src/compat/theme/love.css", "theme/love.css"),
+            ("src/compat/theme/bg.png", "theme/bg.png"),
+        ]:
+            copy_entry_raw(
+                love_binary_zip,
+                love_binary_zip.getinfo(prefix + src_name),
+                app_zip,
+                f"{config['name']}/{dest_name}",
+                date_time,
+            )
+
+    precompress = lovejs_config.get("precompress", [])
+    if isinstance(precompress, str):
+        precompress = [precompress]
+    sidecars = precompress_entries(dst, precompress)
+
+    if should_build_artifact(config, target, "directory", False):
+        with ZipFile(dst) as app_zip:
+            app_zip.extractall(target_directory)
+        for name, sidecar_path in sidecars:
+            shutil.copyfile(sidecar_path, os.path.join(target_directory, name))
+
+    if should_build_artifact(config, target, "archive", True):
+        if len(sidecars) > 0:
+            with ZipFile(dst, mode="a", compression=ZIP_STORED) as app_zip:
+                for name, sidecar_path in sidecars:
+                    write_file_streamed(
+                        app_zip, sidecar_path, name, date_time, reproducible
+                    )
+    else:
+        os.remove(dst)
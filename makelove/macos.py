@@ -2,37 +2,51 @@ import io
 import os
 import plistlib
 import struct
-import sys
 from pathlib import Path
 from datetime import datetime
 from zipfile import ZipFile
-from urllib.request import urlopen, urlretrieve, URLError
 
 from PIL import Image
 
-from .util import eprint, get_default_love_binary_dir, get_download_url
+from .binarycache import CacheEntry, ensure, get_converted_file
+from .download import download, check_zip, get_mirror
+from .errors import BuildError, DownloadError
+from .util import get_archive_date_time, get_default_love_binary_dir, get_download_url
+from .ziputil import copy_entry_raw, new_zipinfo, write_file_streamed
 
 
-def download_love(version, platform):
+def download_love(version, platform, target_path, mirror=None):
     """
     Note, mac builds are stored as zip files because extracting them
     would lose data about symlinks when building on windows
     """
-    target_path = get_default_love_binary_dir(version, platform)
-    print("Downloading love binaries to: '{}'".format(target_path))
-
-    os.makedirs(target_path, exist_ok=True)
     try:
         download_url = get_download_url(version, platform)
         print("Downloading '{}'..".format(download_url))
-        urlretrieve(download_url, os.path.join(target_path, "love.zip"))
-    except URLError as exc:
-        eprint("Could not download löve: {}".format(exc))
-        eprint(
-            "If there is in fact no download on GitHub for this version, specify 'love_binaries' manually."
+        download(download_url, os.path.join(target_path, "love.zip"), mirror=mirror)
+        check_zip(os.path.join(target_path, "love.zip"))
+    except DownloadError as exc:
+        raise DownloadError(
+            "Could not download löve: {}\n".format(exc)
+            + "If there is in fact no download on GitHub for this version, specify 'love_binaries' manually."
         )
-        sys.exit(1)
-    print("Download complete")
+    print("Download of löve {} for {} complete".format(version, platform))
+
+
+def get_love_binaries_entry(config, target):
+    assert "love_version" in config
+    version = config["love_version"]
+    mirror = get_mirror(config)
+    return CacheEntry(
+        get_default_love_binary_dir(version, target),
+        lambda path: download_love(version, target, path, mirror),
+    )
+
+
+def get_downloads(config, target):
+    if target in config and "love_binaries" in config[target]:
+        return []
+    return [get_love_binaries_entry(config, target)]
 
 
 def write_file(pkg, name, content):
@@ -57,8 +71,7 @@ def make_icns(iconfile, icon_image_file):
     # must all be square (width=height) and of standard pixel sizes
     width, height = icon_image.size  # a 2-tuple
     if width != height:
-        eprint("Invalid image size, discarded: %d x %d." % (width, height))
-        sys.exit(1)
+        raise BuildError("Invalid image size, discarded: %d x %d." % (width, height))
 
     sizetotypes = {
         16: [b"icp4"],  # 16x16   std only  (no 8x8@2x)
@@ -93,6 +106,11 @@ def make_icns(iconfile, icon_image_file):
         iconfile.write(imagedata)  # and the image
 
 
+def convert_to_icns(png_path, icns_path):
+    with open(png_path, "rb") as icon_img_f, open(icns_path, "wb") as icns_f:
+        make_icns(icns_f, icon_img_f)
+
+
 def get_game_icon_content(config):
     # Mac icons are not supposed to take up the full image area and generally
     # have shadows, etc - allow users to provide a different design but fall
@@ -101,23 +119,20 @@ def get_game_icon_content(config):
     if icon_file is None:
         icon_file = config.get("icon_file", None)
     elif not os.path.isfile(icon_file):
-        sys.exit(f"Couldn't find macOS icon_file at {icon_file}")
+        raise BuildError(f"Couldn't find macOS icon_file at {icon_file}")
 
     if icon_file is None:
         icon_file = config.get("icon_file", None)
     elif not os.path.isfile(icon_file):
-        sys.exit(f"Couldn't find icon_file at {icon_file}")
+        raise BuildError(f"Couldn't find icon_file at {icon_file}")
 
     if not icon_file:
         return False
 
-    with io.BytesIO() as icns_f, open(icon_file, "rb") as icon_img_f:
-        icon_key = f"{config['name']}.app/Contents/Resources/icon-{config['name']}.icns"
-        if icon_file.lower().endswith(".png"):
-            make_icns(icns_f, icon_img_f)
-            return icns_f.getvalue()
-        else:
-            return icon_img_f.read()
+    if icon_file.lower().endswith(".png"):
+        icon_file = get_converted_file(icon_file, "icons", ".icns", convert_to_icns)
+    with open(icon_file, "rb") as icon_img_f:
+        return icon_img_f.read()
 
 
 def get_info_plist_content(config, version):
@@ -160,22 +175,22 @@ def build_macos(config, version, target, target_directory, love_file_path):
     if target in config and "love_binaries" in config[target]:
         love_binaries = config[target]["love_binaries"]
     else:
-        assert "love_version" in config
         print("No love binaries specified for target {}".format(target))
-        love_binaries = get_default_love_binary_dir(config["love_version"], target)
-        if os.path.isdir(love_binaries):
-            print("Love binaries already present in '{}'".format(love_binaries))
-        else:
-            download_love(config["love_version"], target)
+        love_binaries = ensure(get_love_binaries_entry(config, target))
 
     src = os.path.join(love_binaries, "love.zip")
     dst = os.path.join(target_directory, f"{config['name']}-{target}.zip")
     with open(src, "rb") as lovef, ZipFile(lovef) as love_binary_zip, open(
         dst, "wb+"
-    ) as outf, ZipFile(outf, mode="w") as app_zip, open(
-        love_file_path, "rb"
-    ) as love_zip:
-
+    ) as outf, ZipFile(outf, mode="w") as app_zip:
+        # makes the modification time on the app correct
+        date_time = get_archive_date_time(config)
+        reproducible = date_time != None
+        if not reproducible:
+            date_time = tuple(datetime.now().timetuple()[:6])
+
+        # All files that might be large (archive files and the .love) are
+        # streamed into the zip, so memory usage does not depend on the game size.
         archive_files = {}
         if "archive_files" in config:
             archive_files.update(config["archive_files"])
@@ -186,37 +201,33 @@ def build_macos(config, version, target, target_directory, love_file_path):
         for src_path, dest_path in archive_files.items():
             path = f"{config['name']}.app/Contents/Resources/{dest_path}"
             if os.path.isfile(src_path):
-                with open(src_path, "rb") as file:
-                    app_zip.writestr(path, file.read())
+                write_file_streamed(app_zip, src_path, path, date_time, reproducible)
             elif os.path.isdir(src_path):
                 directory = Path(src_path)
-                for file_path in directory.glob("**/*"):
+                for file_path in sorted(directory.glob("**/*")):
                     if not file_path.is_file():
                         continue
-                    with open(file_path, "rb") as file:
-                        relative = file_path.relative_to(src_path)
-                        path = f"{config['name']}.app/Contents/Resources/{dest_path}/{relative}"
-                        app_zip.writestr(path, file.read())
-                        written_archive_files.add(path)
+                    relative = file_path.relative_to(src_path)
+                    path = f"{config['name']}.app/Contents/Resources/{dest_path}/{relative}"
+                    write_file_streamed(
+                        app_zip, file_path, path, date_time, reproducible
+                    )
+                    written_archive_files.add(path)
             else:
-                sys.exit(f"Cannot copy archive file '{src_path}'")
+                raise BuildError(f"Cannot copy archive file '{src_path}'")
             written_archive_files.add(path)
 
         for zipinfo in love_binary_zip.infolist():
             if not zipinfo.filename.startswith("love.app/"):
-                eprint("Got bad or unxpexpectedly formatted love zip file")
-                sys.exit(1)
+                raise BuildError("Got bad or unxpexpectedly formatted love zip file")
 
             # for getting files out of the original love archive
             orig_filename = zipinfo.filename
 
             # rename app from "love.app" to "cool game.app"
-            zipinfo.filename = config["name"] + zipinfo.filename[len("love") :]
+            filename = config["name"] + orig_filename[len("love") :]
 
-            # makes the modification time on the app correct
-            zipinfo.date_time = tuple(datetime.now().timetuple()[:6])
-
-            if zipinfo.filename in written_archive_files:
+            if filename in written_archive_files:
                 # Skip archive files to make it possible to provide replacements
                 # for files from love_binary_zip.
                 continue
@@ -226,20 +237,26 @@ def build_macos(config, version, target, target_directory, love_file_path):
                 continue  # not needed for game distributions
             elif orig_filename == "love.app/Contents/Resources/OS X AppIcon.icns":
                 # hack: change name to make macos pick up the icon
-                zipinfo = f"{config['name']}.app/Contents/Resources/icon.icns"
+                filename = f"{config['name']}.app/Contents/Resources/icon.icns"
 
                 content = get_game_icon_content(config)
-                if not content:
-                    content = love_binary_zip.read(orig_filename)
+                if content:
+                    app_zip.writestr(
+                        new_zipinfo(app_zip, filename, date_time), content
+                    )
+                    continue
             elif orig_filename == "love.app/Contents/Info.plist":
                 app_zip.writestr(
-                    zipinfo.filename, get_info_plist_content(config, version)
+                    new_zipinfo(app_zip, filename, date_time),
+                    get_info_plist_content(config, version),
                 )
                 continue
-            else:
-                content = love_binary_zip.read(orig_filename)
 
-            app_zip.writestr(zipinfo, content)
+            # Everything else is passed through unchanged, so the compressed
+            # data can be copied as is, which also keeps symlinks and permissions
+            copy_entry_raw(love_binary_zip, zipinfo, app_zip, filename, date_time)
 
         loveZipKey = f"{config['name']}.app/Contents/Resources/{config['name']}.love"
-        app_zip.writestr(loveZipKey, love_zip.read())
+        write_file_streamed(
+            app_zip, love_file_path, loveZipKey, date_time, reproducible
+        )
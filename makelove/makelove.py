@@ -1,26 +1,47 @@
 #!/usr/bin/env python3
 import argparse
+import copy
 import os
 import shutil
 import sys
 import json
 import subprocess
+import time
+from collections import Counter, namedtuple
 from email.utils import formatdate
 import zipfile
 import re
-import pkg_resources
 
-from .config import get_config, all_targets, init_config_assistant
-from .hooks import execute_hook
+from .config import (
+    get_config,
+    complete_config,
+    resolve_config_paths,
+    all_targets,
+    all_love_versions,
+    init_config_assistant,
+)
+from .errors import MakeloveError, BuildError, ConfigError
 from .filelist import FileList
 from .jsonfile import JsonFile
-from .windows import build_windows
-from .linux import build_linux
-from .macos import build_macos
-from .lovejs import build_lovejs
+from .util import parse_size, format_size, get_archive_date_time
+from .ziputil import copy_entry_raw, write_file_streamed
+from . import binarycache, util
+
+# The hooks, the download code and the target modules (which pull in Pillow and
+# the network stack) are only imported when they are needed, so that short
+# running commands like --version or --check start quickly.
 
 all_hooks = ["prebuild", "postbuild"]
 
+Artifact = namedtuple("Artifact", ["path", "size"])
+TargetResult = namedtuple("TargetResult", ["target", "directory", "artifacts", "duration"])
+BuildResult = namedtuple(
+    "BuildResult", ["version", "build_directory", "love_file", "targets", "duration"]
+)
+
+# bytecode is whether the .love contains the compiled Lua files (see bytecode.py)
+LoveVariant = namedtuple("LoveVariant", ["path", "love_files", "bytecode"])
+
 # Sadly argparse cannot handle nargs="*" and choices and will error if not at least one argument is provided
 def _choices(values):
     def f(s):
@@ -45,7 +66,7 @@ def files_in_dir(dir_path):
 def bump_version(version):
     m = re.search(r"\d+$", version)
     if not m:
-        sys.exit("Could not bump version '{}'".format(version))
+        raise BuildError("Could not bump version '{}'".format(version))
     num = int(m.group(0)) + 1
     return version[: m.start(0)] + str(num)
 
@@ -54,7 +75,7 @@ def get_build_log_path(build_directory):
     return os.path.join(build_directory, ".makelove-buildlog")
 
 
-def prepare_build_directory(args, config, version):
+def prepare_build_directory(config, version, targets, force):
     assert "build_directory" in config
     build_directory = config["build_directory"]
     versioned_build = version != None
@@ -67,30 +88,20 @@ def prepare_build_directory(args, config, version):
     if os.path.isdir(build_directory):
         # If no version is specified, overwrite by default
         built_targets = os.listdir(build_directory)
-        building_target_again = any(target in built_targets for target in args.targets)
+        building_target_again = any(target in built_targets for target in targets)
         # If the targets being built have not been built before, it should be fine to not do anything
         # The deletion/creation of the target directories is handled in main() (they are just deleted if they exist).
-        if versioned_build and building_target_again and not args.force:
-            sys.exit(
+        if versioned_build and building_target_again and not force:
+            raise BuildError(
                 "Cannot rebuild an already built version + target combination. Remove it manually first or pass --force to overwrite it"
             )
     elif os.path.exists(build_directory):
-        sys.exit("Build directory exists and is not a directory")
+        raise BuildError("Build directory exists and is not a directory")
     else:
         os.makedirs(build_directory)
     return build_directory
 
 
-def execute_hooks(hook, config, version, targets, build_directory):
-    if "hooks" in config and hook in config["hooks"]:
-        for command in config["hooks"][hook]:
-            new_config = execute_hook(
-                command, config, version, targets, build_directory
-            )
-            config.clear()
-            config.update(new_config)
-
-
 def git_ls_tree(path=".", visited=None):
     p = os.path
 
@@ -98,7 +109,7 @@ def git_ls_tree(path=".", visited=None):
         visited = set()
     rpath = p.realpath(path)
     if rpath in visited:
-        sys.exit("Symlink loop detected!")
+        raise BuildError("Symlink loop detected!")
     else:
         visited.add(rpath)
 
@@ -119,51 +130,178 @@ def git_ls_tree(path=".", visited=None):
     return out
 
 
-def assemble_game_directory(args, config, game_directory):
-    if os.path.isdir(game_directory):
-        shutil.rmtree(game_directory)
-    os.makedirs(game_directory)
-    file_list = FileList(".")
-    for rule in config["love_files"]:
+def get_file_list(love_files, project_dir):
+    file_list = FileList(project_dir)
+    for rule in love_files:
         if rule == "+::git-ls-tree::" or rule == "::git-ls-tree::":
-            ls_tree = git_ls_tree(".")
+            ls_tree = git_ls_tree(project_dir)
             for item in ls_tree:
+                item = os.path.relpath(item, project_dir)
                 try:
                     file_list.include_raw(item)
                 except FileNotFoundError:
-                    sys.exit("Could not find git-tracked file '{}'".format(item))
+                    raise BuildError("Could not find git-tracked file '{}'".format(item))
         elif rule[0] == "-":
             file_list.exclude(rule[1:])
         elif rule[0] == "+":
             file_list.include(rule[1:])
         else:
             file_list.include(rule)
+    return list(file_list)
+
+
+def assemble_game_directory(
+    config, game_directory, project_dir, verbose=False, files=None
+):
+    # files are the paths to copy, by default the ones matching love_files
+    if os.path.isdir(game_directory):
+        shutil.rmtree(game_directory)
+    os.makedirs(game_directory)
+    if files == None:
+        files = get_file_list(config["love_files"], project_dir)
 
-    if args.verbose:
+    if verbose:
         print(".love files:")
 
-    for fname in file_list:
-        if args.verbose:
+    for fname in files:
+        if verbose:
             print(fname)
         dest_path = os.path.join(game_directory, fname)
         os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-        shutil.copyfile(fname, dest_path)
-
+        shutil.copyfile(os.path.join(project_dir, fname), dest_path)
+
+
+def create_love_files(game_dir, love_files, replacements=None, date_time=None):
+    """
+    Creates several .love files from game_dir. love_files is a list of
+    (path, files, use_replacements) with the paths (relative to game_dir) of
+    the files in that .love. replacements maps paths in game_dir to files that
+    are packed instead (e.g. compiled Lua files) if use_replacements is true.
+    Entries that are in more than one .love are written only once into a
+    temporary archive, from which they are copied without recompressing them.
+    If date_time is given, the entries are normalized for reproducible builds.
+    """
+    replacements = replacements or {}
+    love_files = [
+        (love_file_path, sorted(os.path.normpath(path) for path in files), use)
+        for love_file_path, files, use in love_files
+    ]
+
+    def get_entry(path, use_replacements):
+        name = path.replace(os.sep, "/")
+        if use_replacements and path in replacements:
+            return "replaced/" + name, replacements[path]
+        return "original/" + name, os.path.join(game_dir, path)
+
+    def write_entry(zip_file, source_path, arcname):
+        write_file_streamed(
+            zip_file, source_path, arcname, date_time, reproducible=date_time != None
+        )
 
-def create_love_file(game_dir, love_file_path):
-    love_archive = zipfile.ZipFile(love_file_path, "w")
-    for path in files_in_dir(game_dir):
-        arcname = os.path.normpath(os.path.relpath(path, game_dir))
-        love_archive.write(path, arcname=arcname)
-    love_archive.close()
+    uses = Counter(
+        get_entry(path, use_replacements)[0]
+        for _love_file_path, files, use_replacements in love_files
+        for path in files
+    )
+    shared = set(name for name, count in uses.items() if count > 1)
+
+    entries_path = game_dir + ".entries.zip"
+    entries = None
+    try:
+        if len(shared) > 0:
+            with zipfile.ZipFile(entries_path, "w") as entries_archive:
+                for _love_file_path, files, use_replacements in love_files:
+                    for path in files:
+                        entry_name, source_path = get_entry(path, use_replacements)
+                        if entry_name in shared:
+                            if not entry_name in entries_archive.NameToInfo:
+                                write_entry(entries_archive, source_path, entry_name)
+            entries = zipfile.ZipFile(entries_path)
+
+        for love_file_path, files, use_replacements in love_files:
+            os.makedirs(os.path.dirname(love_file_path), exist_ok=True)
+            with zipfile.ZipFile(love_file_path, "w") as love_archive:
+                for path in files:
+                    entry_name, source_path = get_entry(path, use_replacements)
+                    if entry_name in shared:
+                        copy_entry_raw(
+                            entries,
+                            entries.getinfo(entry_name),
+                            love_archive,
+                            arcname=path,
+                        )
+                    else:
+                        write_entry(love_archive, source_path, path)
+    finally:
+        if entries != None:
+            entries.close()
+        if os.path.isfile(entries_path):
+            os.remove(entries_path)
+
+
+def get_love_variants(config, targets, love_directory):
+    """
+    Returns the LoveVariant of every target. Targets with their own love_files
+    get a .love of their own, the others share the default one or the one with
+    compiled Lua files.
+    """
+    from .bytecode import target_uses_bytecode
+
+    # Always the same file name, because some targets use it (e.g. appimage)
+    love_file_name = "{}.love".format(config["name"])
+    variants = {}
+    for target in targets:
+        bytecode = target_uses_bytecode(config, target)
+        if "love_files" in config.get(target, {}):
+            path = os.path.join(love_directory, target, love_file_name)
+            love_files = config[target]["love_files"]
+        elif bytecode:
+            path = os.path.join(love_directory, "bytecode", love_file_name)
+            love_files = config["love_files"]
+        else:
+            path = os.path.join(love_directory, love_file_name)
+            love_files = config["love_files"]
+        variants[target] = LoveVariant(path, love_files, bytecode)
+    return variants
+
+
+def get_patches_directory(config, old_version, new_version):
+    return os.path.join(config["build_directory"], new_version, "patches", old_version)
+
+
+def create_patches(config, version, targets):
+    # Patches from the last completed versioned builds to this one
+    from .delta import diff_builds
+
+    with open(get_build_log_path(config["build_directory"])) as f:
+        build_log = json.load(f)
+    previous_versions = []
+    for entry in build_log:
+        if entry["completed"] and not entry["version"] in previous_versions + [version]:
+            previous_versions.append(entry["version"])
+
+    count = config["patches"].get("previous_versions", 1)
+    delta_min_size = parse_size(config["patches"].get("delta_min_size", "1M"))
+    for old_version in previous_versions[len(previous_versions) - count :]:
+        if not os.path.isdir(os.path.join(config["build_directory"], old_version)):
+            print("Build of version '{}' does not exist anymore".format(old_version))
+            continue
+        diff_builds(
+            config["build_directory"],
+            old_version,
+            version,
+            targets,
+            get_patches_directory(config, old_version, version),
+            delta_min_size,
+        )
 
 
-def get_build_version(args, config):
+def get_build_version(config, version):
     build_log_path = get_build_log_path(config["build_directory"])
 
     # Bump version if we are doing a versioned build and no version is specified
     were_versioned_builds_made = os.path.isfile(build_log_path)
-    if were_versioned_builds_made and args.version == None:
+    if were_versioned_builds_made and version == None:
         print(
             "Versioned builds were made in the past, but no version was specified for this build. Bumping last built version."
         )
@@ -173,18 +311,66 @@ def get_build_version(args, config):
 
         return bump_version(last_built_version)
 
-    return args.version
+    return version
+
+
+def get_makelove_version():
+    try:
+        from importlib.metadata import version
+    except ImportError:  # Python 3.7
+        import pkg_resources
+
+        return pkg_resources.get_distribution("makelove").version
+    return version("makelove")
+
+
+def get_target_module(target):
+    if target == "win32" or target == "win64":
+        from . import windows as module
+    elif target == "appimage":
+        from . import linux as module
+    elif target == "macos":
+        from . import macos as module
+    elif target == "lovejs":
+        from . import lovejs as module
+    return module
+
+
+def build_target(config, version, target, target_directory, love_file_path):
+    module = get_target_module(target)
+    if target == "win32" or target == "win64":
+        module.build_windows(config, version, target, target_directory, love_file_path)
+    elif target == "appimage":
+        module.build_linux(config, version, target, target_directory, love_file_path)
+    elif target == "macos":
+        module.build_macos(config, version, target, target_directory, love_file_path)
+    elif target == "lovejs":
+        module.build_lovejs(config, version, target, target_directory, love_file_path)
+
+
+def get_downloads(config, targets):
+    downloads = []
+    for target in targets:
+        downloads.extend(get_target_module(target).get_downloads(config, target))
+    return downloads
+
+
+def start_prefetch(config, targets):
+    return binarycache.Prefetch(get_downloads(config, targets))
 
 
-def get_targets(args, config):
-    targets = args.targets
-    if len(targets) == 0:
+def get_targets(targets, config):
+    if targets == None or len(targets) == 0:
         assert "default_targets" in config
         targets = config["default_targets"]
 
     # use this lame loop to make unique but keep target order
     unique_targets = []
     for target in targets:
+        if not target in all_targets:
+            raise ConfigError(
+                "Invalid target '{}'. Options: {}".format(target, ", ".join(all_targets))
+            )
         if target not in unique_targets:
             unique_targets.append(target)
     targets = unique_targets
@@ -192,101 +378,265 @@ def get_targets(args, config):
     return targets
 
 
-def main():
-    parser = argparse.ArgumentParser(prog="makelove")
-    parser.add_argument(
-        "--init",
-        action="store_true",
-        help="Start assistant to create a new configuration.",
+def fetch_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="makelove fetch",
+        description="Download everything needed to build the given targets into the cache, so later builds do not need network access.",
     )
     parser.add_argument(
         "--config",
-        help="Specify config file manually. If not specified 'makelove.toml' in the current working directory is used.",
+        help="Config file to take the löve version, targets and mirror from. If not specified 'makelove.toml' in the current working directory is used, if it exists.",
     )
     parser.add_argument(
-        "-d",
-        "--disable-hook",
-        default=[],
-        dest="disabled_hooks",
-        action="append",
-        choices=all_hooks + ["all"],
+        "--love-version",
+        type=_choices(all_love_versions),
+        help="The löve version to download binaries for.",
     )
     parser.add_argument(
-        "--force",
-        dest="force",
-        action="store_true",
-        help="If doing a versioned build, specify this to overwrite a target that was already built.",
+        "--targets",
+        nargs="+",
+        type=_choices(all_targets),
+        help="Options: {}".format(", ".join(all_targets)),
     )
     parser.add_argument(
-        "--resume",
-        action="store_true",
-        help="If doing an unversioned build, specify this to not rebuild targets that were already built.",
+        "--mirror",
+        help="Local directory or base URL to download from instead of GitHub. Can also be set with the MAKELOVE_MIRROR environment variable.",
+    )
+    args = parser.parse_args(argv)
+
+    config = get_config(args.config)
+    if args.love_version:
+        config["love_version"] = args.love_version
+    if args.mirror:
+        config["mirror"] = args.mirror
+    targets = args.targets or config["default_targets"]
+
+    print(
+        "Fetching löve {} for targets: {}".format(
+            config["love_version"], ", ".join(targets)
+        )
+    )
+    start_prefetch(config, targets).wait()
+    print("All downloads complete")
+
+
+def cache_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="makelove cache",
+        description="Show the contents of the download cache ({}) and remove the least recently used entries.".format(
+            binarycache.get_cache_dir()
+        ),
     )
     parser.add_argument(
-        "--verbose",
+        "--prune",
         action="store_true",
-        help="Display more information (files included in love archive)",
+        help="Remove the least recently used entries until the cache is not larger than --max-size.",
     )
-    # Restrict version name format somehow? A git refname?
     parser.add_argument(
-        "-n",
-        "--version-name",
-        dest="version",
-        help="Specify the name of the version to be built.",
+        "--max-size",
+        default=os.environ.get("MAKELOVE_CACHE_MAX_SIZE"),
+        help="Size budget of the cache, e.g. '2G' or '500M'. Defaults to the MAKELOVE_CACHE_MAX_SIZE environment variable.",
+    )
+    args = parser.parse_args(argv)
+
+    if args.prune:
+        if not args.max_size:
+            sys.exit("--prune requires --max-size or MAKELOVE_CACHE_MAX_SIZE")
+        removed = binarycache.prune(parse_size(args.max_size))
+        for entry in removed:
+            print("Removed {} ({})".format(entry.path, format_size(entry.size)))
+        print(
+            "Removed {} entries ({})".format(
+                len(removed), format_size(sum(entry.size for entry in removed))
+            )
+        )
+
+    cache_dir = binarycache.get_cache_dir()
+    entries = sorted(binarycache.list_entries(), key=lambda e: e.last_used, reverse=True)
+    for entry in entries:
+        print(
+            "{:>10}  {}  {}".format(
+                format_size(entry.size),
+                formatdate(entry.last_used, localtime=True),
+                os.path.relpath(entry.path, cache_dir),
+            )
+        )
+    print(
+        "{} entries, {} total in {}".format(
+            len(entries), format_size(sum(entry.size for entry in entries)), cache_dir
+        )
+    )
+
+
+def batch_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="makelove batch",
+        description="Build many projects in one process, with the download cache and all other caches shared between them.",
     )
     parser.add_argument(
-        "--check",
-        action="store_true",
-        help="Only load config and check some arguments, then exit without doing anything. This is mostly useful development.",
+        "batch_file",
+        help="TOML file with a [[project]] table (path, config, targets, version, disabled_hooks) for every project.",
     )
     parser.add_argument(
-        "--version",
-        dest="display_version",
+        "-j",
+        "--max-parallel",
+        type=int,
+        help="Number of projects to build at the same time. Default: max_parallel from the batch file or the number of CPUs.",
+    )
+    parser.add_argument(
+        "--force",
         action="store_true",
-        help="Output the makelove version and exit.",
+        help="Overwrite targets of versioned builds that were already built.",
     )
     parser.add_argument(
-        "targets",
-        nargs="*",
+        "--report",
+        help="Write a JSON report with the artifacts, sizes and timings of every project to this file.",
+    )
+    args = parser.parse_args(argv)
+
+    from .batch import load_batch_file, run_batch, print_report, write_report
+
+    batch, projects = load_batch_file(args.batch_file)
+    max_parallel = args.max_parallel or batch.get("max_parallel", os.cpu_count() or 1)
+    if max_parallel < 1:
+        raise ConfigError("max_parallel has to be at least 1")
+
+    start_time = time.monotonic()
+    print("Building {} projects, {} at a time".format(len(projects), max_parallel))
+    reports = run_batch(projects, max_parallel, args.force)
+    print_report(reports, time.monotonic() - start_time)
+    if args.report:
+        write_report(args.report, reports)
+
+    binarycache.prune_from_environment()
+
+    failed = [report for report in reports if report.error != None]
+    if len(failed) > 0:
+        sys.exit("{} of {} projects failed".format(len(failed), len(reports)))
+
+
+def diff_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="makelove diff",
+        description="Create patches from the artifacts of one versioned build to the ones of another. See README.md.",
+    )
+    parser.add_argument("old_version", help="The version to patch from.")
+    parser.add_argument("new_version", help="The version to patch to.")
+    parser.add_argument(
+        "--config",
+        help="Config file to take the build directory from. If not specified 'makelove.toml' in the current working directory is used, if it exists.",
+    )
+    parser.add_argument(
+        "--targets",
+        nargs="+",
         type=_choices(all_targets),
-        default=[],
-        help="Options: {}".format(", ".join(all_targets)),
+        help="Default: all targets built in both versions. Options: {}".format(
+            ", ".join(all_targets)
+        ),
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Directory to write the patches to. Default: patches/<old_version> in the build directory of the new version.",
+    )
+    parser.add_argument(
+        "--delta-min-size",
+        help="Changed files of at least this size (e.g. '1M') are patched with a binary delta. Default: patches.delta_min_size from the config or 1M.",
     )
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
-    if args.display_version:
-        print("makelove {}".format(pkg_resources.get_distribution("makelove").version))
-        sys.exit(0)
+    from .delta import diff_builds
 
-    if not os.path.isfile("main.lua"):
-        print(
-            "There is no main.lua present in the current directory! Unless you use MoonScript, this might be a mistake."
-        )
+    config = resolve_config_paths(get_config(args.config), ".")
+    delta_min_size = parse_size(
+        args.delta_min_size
+        or config.get("patches", {}).get("delta_min_size", "1M")
+    )
+    output = args.output or get_patches_directory(
+        config, args.old_version, args.new_version
+    )
+    diff_builds(
+        config["build_directory"],
+        args.old_version,
+        args.new_version,
+        args.targets,
+        output,
+        delta_min_size,
+    )
 
-    if args.init:
-        init_config_assistant()
-        sys.exit(0)
 
-    config = get_config(args.config)
+def daemon_main(argv):
+    from .daemon import get_socket_path, run_server
 
-    version = get_build_version(args, config)
+    parser = argparse.ArgumentParser(
+        prog="makelove daemon",
+        description="Keep caches warm in memory and execute builds sent with 'makelove --daemon'.",
+    )
+    parser.add_argument(
+        "--socket",
+        help="Path of the Unix socket to listen on. Default: $MAKELOVE_DAEMON_SOCKET or daemon.sock in the cache directory.",
+    )
+    args = parser.parse_args(argv)
+    run_server(args.socket or get_socket_path())
+
+
+subcommands = {
+    "fetch": fetch_main,
+    "cache": cache_main,
+    "batch": batch_main,
+    "diff": diff_main,
+    "daemon": daemon_main,
+}
+
+
+def get_artifacts(target_directory):
+    artifacts = []
+    for name in sorted(os.listdir(target_directory)):
+        path = os.path.join(target_directory, name)
+        artifacts.append(Artifact(path, binarycache.get_size(path)))
+    return artifacts
+
+
+def build(
+    project_dir,
+    config=None,
+    targets=None,
+    version=None,
+    force=False,
+    resume=False,
+    disabled_hooks=(),
+    verbose=False,
+):
+    """
+    Builds the game in project_dir and returns a BuildResult.
+
+    config is a config dictionary, the path of a config file or None to use
+    makelove.toml in project_dir (if it exists). Relative paths (also in the
+    config) are relative to project_dir, so the working directory of the process
+    does not matter. targets defaults to the default_targets of the config.
+    Errors are raised as subclasses of makelove.errors.MakeloveError.
+    """
+    start_time = time.monotonic()
+    project_dir = os.path.abspath(project_dir)
+    if config == None or isinstance(config, str):
+        config = get_config(config, project_dir)
+    else:
+        config = complete_config(copy.deepcopy(config), project_dir)
+    resolve_config_paths(config, project_dir)
 
+    version = get_build_version(config, version)
     if version != None:
         print("Building version '{}'".format(version))
 
-    if "all" in args.disabled_hooks:
-        args.disabled_hooks = all_hooks
-
-    if args.check:
-        print("Exiting because --check was passed.")
-        sys.exit(0)
-
-    build_directory = prepare_build_directory(args, config, version)
+    if "all" in disabled_hooks:
+        disabled_hooks = all_hooks
 
-    targets = get_targets(args, config)
+    targets = get_targets(targets, config)
 
     if sys.platform.startswith("win") and "appimage" in targets:
-        sys.exit("Currently AppImages can only be built on Linux and WSL2!")
+        raise BuildError("Currently AppImages can only be built on Linux and WSL2!")
+
+    build_directory = prepare_build_directory(config, version, targets, force)
 
     build_log_path = get_build_log_path(config["build_directory"])
     print("Building targets:", ", ".join(targets))
@@ -302,29 +652,92 @@ def main():
                 }
             )
 
-    if not "prebuild" in args.disabled_hooks:
-        execute_hooks("prebuild", config, version, targets, build_directory)
+    if not "prebuild" in disabled_hooks:
+        from .hooks import execute_hooks
+
+        execute_hooks(
+            "prebuild", config, version, targets, build_directory, project_dir
+        )
+        # The hooks might have added relative paths
+        resolve_config_paths(config, project_dir)
+
+    # Download everything the targets need in parallel, while the .love is built
+    prefetch = start_prefetch(config, targets)
 
     love_directory = os.path.join(build_directory, "love")
     love_file_path = os.path.join(love_directory, "{}.love".format(config["name"]))
     game_directory = os.path.join(love_directory, "game_directory")
+    love_variants = get_love_variants(config, targets, love_directory)
+    # The default .love is always built
+    variants = [LoveVariant(love_file_path, config["love_files"], False)]
+    for variant in love_variants.values():
+        if not any(v.path == variant.path for v in variants):
+            variants.append(variant)
 
     # This hold for both the löve file and the targets below:
     # If we do a versioned build and reached this place, force/--force
     # was passed, so we can just delete stuff.
 
-    rebuild_love = version != None or not args.resume
-    if not os.path.isfile(love_file_path) or rebuild_love:
+    rebuild_love = version != None or not resume
+    love_file_missing = any(not os.path.isfile(v.path) for v in variants)
+    if love_file_missing or rebuild_love:
         print("Assembling game directory..")
-        assemble_game_directory(args, config, game_directory)
+        # The game directory contains the files of all variants
+        file_lists = {}
+        for variant in variants:
+            rules = tuple(variant.love_files)
+            if not rules in file_lists:
+                file_lists[rules] = get_file_list(rules, project_dir)
+        assembled = sorted(set().union(*file_lists.values()))
+        assemble_game_directory(
+            config, game_directory, project_dir, verbose, assembled
+        )
 
-        if not os.path.isfile(os.path.join(game_directory, "main.lua")):
-            sys.exit(
-                "Your game directory does not contain a main.lua. This will result in a game that can not be run."
-            )
+        if "atlas" in config:
+            from .atlas import build_atlas
+
+            print("Packing atlas..")
+            build_atlas(config, game_directory)
+
+        if "optimize_images" in config:
+            from .images import optimize_game_directory
+
+            print("Optimizing images..")
+            optimize_game_directory(config, game_directory)
+
+        compiled = {}
+        if any(v.bytecode for v in variants):
+            from .bytecode import compile_game_directory
 
-        create_love_file(game_directory, love_file_path)
-        print("Created {}".format(love_file_path))
+            print("Compiling Lua files to bytecode..")
+            compiled = compile_game_directory(config, game_directory)
+
+        # Files added by the stages above (e.g. atlas pages) are in every variant
+        present = set(
+            os.path.relpath(path, game_directory)
+            for path in files_in_dir(game_directory)
+        )
+        added = present - set(os.path.normpath(path) for path in assembled)
+        love_files = []
+        for variant in variants:
+            files = set(
+                os.path.normpath(path)
+                for path in file_lists[tuple(variant.love_files)]
+            )
+            files = (files & present) | added
+            if not "main.lua" in files:
+                raise BuildError(
+                    "{} does not contain a main.lua. This will result in a game that can not be run.".format(
+                        variant.path
+                    )
+                )
+            love_files.append((variant.path, files, variant.bytecode))
+
+        create_love_files(
+            game_directory, love_files, compiled, get_archive_date_time(config)
+        )
+        for variant in variants:
+            print("Created {}".format(variant.path))
 
         if config.get("keep_game_directory", False):
             print("Keeping game directory because 'keep_game_directory' is true")
@@ -333,8 +746,16 @@ def main():
     else:
         print(".love file already exists. Not rebuilding.")
 
+    prefetch.wait()
+
+    from .remotecache import get_remote_cache, get_target_fingerprint
+
+    remote_cache = get_remote_cache(config)
+
+    target_results = []
     for target in targets:
         print(">> Building target {}".format(target))
+        target_start_time = time.monotonic()
 
         target_directory = os.path.join(build_directory, target)
         # If target_directory is not a directory, let it throw an exception
@@ -343,24 +764,187 @@ def main():
             shutil.rmtree(target_directory)
         os.makedirs(target_directory)
 
-        if target == "win32" or target == "win64":
-            build_windows(config, version, target, target_directory, love_file_path)
-        elif target == "appimage":
-            build_linux(config, version, target, target_directory, love_file_path)
-        elif target == "macos":
-            build_macos(config, version, target, target_directory, love_file_path)
-        elif target == "lovejs":
-            build_lovejs(config, version, target, target_directory, love_file_path)
-
+        target_love_file_path = love_variants[target].path
+
+        fingerprint = None
+        if remote_cache != None:
+            fingerprint = get_target_fingerprint(
+                config,
+                version,
+                target,
+                target_love_file_path,
+                get_makelove_version(),
+                get_downloads(config, [target]),
+            )
+        cached = fingerprint != None and remote_cache.fetch(
+            target, fingerprint, target_directory
+        )
+        if not cached:
+            build_target(
+                config, version, target, target_directory, target_love_file_path
+            )
+            if fingerprint != None:
+                remote_cache.store(target, fingerprint, target_directory)
+
+        target_results.append(
+            TargetResult(
+                target,
+                target_directory,
+                get_artifacts(target_directory),
+                time.monotonic() - target_start_time,
+            )
+        )
         print("Target {} complete".format(target))
 
-    if not "postbuild" in args.disabled_hooks:
-        execute_hooks("postbuild", config, version, targets, build_directory)
+    if version != None and "patches" in config:
+        print(">> Creating patches")
+        create_patches(config, version, targets)
+
+    if not "postbuild" in disabled_hooks:
+        from .hooks import execute_hooks
+
+        execute_hooks(
+            "postbuild", config, version, targets, build_directory, project_dir
+        )
 
     if version != None:
         with JsonFile(build_log_path, indent=4) as build_log:
             build_log[-1]["completed"] = True
 
+    binarycache.prune_from_environment()
+
+    return BuildResult(
+        version,
+        build_directory,
+        love_file_path,
+        target_results,
+        time.monotonic() - start_time,
+    )
+
+
+def get_build_parser():
+    parser = argparse.ArgumentParser(prog="makelove")
+    parser.add_argument(
+        "--init",
+        action="store_true",
+        help="Start assistant to create a new configuration.",
+    )
+    parser.add_argument(
+        "--config",
+        help="Specify config file manually. If not specified 'makelove.toml' in the current working directory is used.",
+    )
+    parser.add_argument(
+        "-d",
+        "--disable-hook",
+        default=[],
+        dest="disabled_hooks",
+        action="append",
+        choices=all_hooks + ["all"],
+    )
+    parser.add_argument(
+        "--force",
+        dest="force",
+        action="store_true",
+        help="If doing a versioned build, specify this to overwrite a target that was already built.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="If doing an unversioned build, specify this to not rebuild targets that were already built.",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Display more information (files included in love archive)",
+    )
+    # Restrict version name format somehow? A git refname?
+    parser.add_argument(
+        "-n",
+        "--version-name",
+        dest="version",
+        help="Specify the name of the version to be built.",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Only load config and check some arguments, then exit without doing anything. This is mostly useful development.",
+    )
+    parser.add_argument(
+        "--version",
+        dest="display_version",
+        action="store_true",
+        help="Output the makelove version and exit.",
+    )
+    parser.add_argument(
+        "targets",
+        nargs="*",
+        type=_choices(all_targets),
+        default=[],
+        help="Options: {}".format(", ".join(all_targets)),
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Let a running 'makelove daemon' do the build. See README.md.",
+    )
+    return parser
+
+
+def build_command(args, project_dir=".", config=None):
+    if args.display_version:
+        print("makelove {}".format(get_makelove_version()))
+        sys.exit(0)
+
+    if not os.path.isfile(os.path.join(project_dir, "main.lua")):
+        print(
+            "There is no main.lua present in the current directory! Unless you use MoonScript, this might be a mistake."
+        )
+
+    if args.init:
+        init_config_assistant()
+        sys.exit(0)
+
+    if config == None:
+        config = get_config(args.config, project_dir)
+
+    if args.check:
+        version = get_build_version(config, args.version)
+        if version != None:
+            print("Building version '{}'".format(version))
+        print("Exiting because --check was passed.")
+        sys.exit(0)
+
+    build(
+        project_dir,
+        config,
+        targets=args.targets,
+        version=args.version,
+        force=args.force,
+        resume=args.resume,
+        disabled_hooks=args.disabled_hooks,
+        verbose=args.verbose,
+    )
+
+
+def build_main(argv):
+    args = get_build_parser().parse_args(argv)
+    if args.daemon:
+        from .daemon import run_client
+
+        sys.exit(run_client(argv))
+    util.interactive = True
+    build_command(args)
+
+
+def main():
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] in subcommands:
+            subcommands[sys.argv[1]](sys.argv[2:])
+        else:
+            build_main(sys.argv[1:])
+    except MakeloveError as exc:
+        sys.exit(str(exc))
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,314 @@
+import hashlib
+import http.client
+import json
+import os
+import posixpath
+import re
+import shutil
+import sys
+import tarfile
+import uuid
+import zipfile
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from .config import all_targets
+from .util import format_size, get_source_date_epoch, getenv
+
+# Bump this if the fingerprint or the format of the cache entries changes
+cache_format = "1"
+
+timeout = 60
+chunk_size = 1024 * 1024
+
+# Keys that do not influence the artifacts of a target. Everything that goes
+# into the .love file is covered by the hash of its contents.
+ignored_config_keys = [
+    "build_directory",
+    "keep_game_directory",
+    "default_targets",
+    "love_files",
+    "mirror",
+    "hooks",
+    "patches",
+    "atlas",
+    "optimize_images",
+    "bytecode",
+    "remote_cache",
+]
+
+
+def hash_path(path):
+    # The hash of the contents of a file or of all files in a directory
+    path_hash = hashlib.sha256()
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                rel_path = os.path.relpath(file_path, path).replace(os.sep, "/")
+                path_hash.update(rel_path.encode("utf-8") + b"\0")
+                path_hash.update(hash_path(file_path).encode("utf-8"))
+    elif os.path.isfile(path):
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                path_hash.update(chunk)
+    else:
+        return "missing"
+    return path_hash.hexdigest()
+
+
+def hash_love_file(love_file_path):
+    # Hashes the names and contents of the files in the .love file, so that it
+    # does not matter when (with which timestamps) it was built
+    love_hash = hashlib.sha256()
+    with zipfile.ZipFile(love_file_path) as love_file:
+        for info in sorted(love_file.infolist(), key=lambda i: i.filename):
+            love_hash.update(info.filename.encode("utf-8") + b"\0")
+            with love_file.open(info) as f:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    love_hash.update(chunk)
+            love_hash.update(b"\0")
+    return love_hash.hexdigest()
+
+
+def hash_archive_files(section):
+    if "archive_files" in section:
+        section["archive_files"] = {
+            hash_path(src): dest for src, dest in section["archive_files"].items()
+        }
+
+
+def get_fingerprint_config(config, target):
+    # A copy of the parts of the config that are relevant for target, with
+    # all files on disk replaced by the hashes of their contents, so the
+    # fingerprint does not depend on where the project is checked out
+    fingerprint_config = {
+        key: value
+        for key, value in config.items()
+        if not key in ignored_config_keys + all_targets + ["windows", "linux"]
+    }
+    if "icon_file" in config:
+        fingerprint_config["icon_file"] = hash_path(config["icon_file"])
+    hash_archive_files(fingerprint_config)
+
+    platform = {"win32": "windows", "win64": "windows", "appimage": "linux"}.get(target)
+    if platform in config:
+        fingerprint_config[platform] = dict(config[platform])
+        hash_archive_files(fingerprint_config[platform])
+
+    section = dict(config.get(target, {}))
+    for key in ["love_binaries", "icon_file", "source_appimage"]:
+        if key in section:
+            section[key] = hash_path(section[key])
+    if "shared_libraries" in section:
+        section["shared_libraries"] = [
+            hash_path(path) for path in section["shared_libraries"]
+        ]
+    hash_archive_files(section)
+    fingerprint_config[target] = section
+    return fingerprint_config
+
+
+def get_target_fingerprint(
+    config, version, target, love_file_path, makelove_version, downloads
+):
+    """
+    Returns a fingerprint of everything the artifacts of target are built
+    from: the contents of the .love file, the relevant config (including the
+    files it refers to), the version, the makelove version and the contents of
+    the downloaded löve binaries and tools (the cache entries in downloads,
+    which have to be populated already), since some of them (like love.js and
+    appimagetool) are not pinned to a release.
+    """
+    data = {
+        "format": cache_format,
+        "makelove": makelove_version,
+        "platform": sys.platform,
+        "target": target,
+        "version": version,
+        # Also if it is only set by SOURCE_DATE_EPOCH
+        "source_date_epoch": get_source_date_epoch(config),
+        "love_file": hash_love_file(love_file_path),
+        "config": get_fingerprint_config(config, target),
+        "downloads": sorted(hash_path(entry.path) for entry in downloads),
+    }
+    if target in ["win32", "win64"]:
+        from .windows import can_set_metadata
+
+        # Without rcedit the executables do not have any metadata or icon
+        data["exe_metadata"] = can_set_metadata(sys.platform)
+    if target == "appimage" and shutil.which("appimagetool"):
+        # An installed appimagetool is used instead of downloading it
+        data["appimagetool"] = hash_path(shutil.which("appimagetool"))
+    # default=str for the dates toml can produce
+    data = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class DirectoryBackend(object):
+    """Stores the cache entries in a (shared) directory."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, key, path):
+        entry_path = os.path.join(self.path, *key.split("/"))
+        if not os.path.isfile(entry_path):
+            return False
+        shutil.copyfile(entry_path, path)
+        return True
+
+    def put(self, key, path):
+        entry_path = os.path.join(self.path, *key.split("/"))
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        # Other machines (and threads) must never see partial entries
+        tmp_path = "{}.{}.tmp".format(entry_path, uuid.uuid4().hex)
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, entry_path)
+
+
+class HttpBackend(object):
+    """
+    Stores the cache entries on an HTTP server, which has to respond to GET
+    requests with the entry or 404 and store the body of PUT requests.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def get(self, key, path):
+        try:
+            response = urlopen(self.url + "/" + key, timeout=timeout)
+        except HTTPError as exc:
+            if exc.code == 404:
+                return False
+            raise
+        with response, open(path, "wb") as f:
+            shutil.copyfileobj(response, f, chunk_size)
+        return True
+
+    def put(self, key, path):
+        with open(path, "rb") as f:
+            request = Request(
+                self.url + "/" + key,
+                data=f,
+                method="PUT",
+                headers={
+                    "Content-Length": str(os.path.getsize(path)),
+                    "Content-Type": "application/x-tar",
+                },
+            )
+            with urlopen(request, timeout=timeout):
+                pass
+
+
+def is_inside_archive(path):
+    return not path.startswith("/") and not ".." in path.split("/")
+
+
+def is_safe_member(member):
+    # Links (e.g. in an AppDir) have to point to a file inside the archive
+    if member.issym():
+        target = posixpath.normpath(
+            posixpath.join(posixpath.dirname(member.name), member.linkname)
+        )
+        if not is_inside_archive(target):
+            return False
+    elif member.islnk():
+        if not is_inside_archive(posixpath.normpath(member.linkname)):
+            return False
+    elif not (member.isfile() or member.isdir()):
+        return False
+    return is_inside_archive(posixpath.normpath(member.name))
+
+
+class RemoteCache(object):
+    """
+    Caches the artifacts of targets by their fingerprint (see
+    get_target_fingerprint) as tar archives in a backend. Errors of the backend
+    are reported, but do not fail the build, which then builds the target.
+    """
+
+    def __init__(self, backend, read_only=False):
+        self.backend = backend
+        self.read_only = read_only
+
+    def fetch(self, target, fingerprint, target_directory):
+        """
+        Extracts the cached artifacts into target_directory (which has to be
+        empty). Returns whether the fingerprint was in the cache.
+        """
+        archive_path = target_directory + ".remotecache.tar"
+        try:
+            if not self.backend.get(get_key(target, fingerprint), archive_path):
+                return False
+            with tarfile.open(archive_path) as archive:
+                members = archive.getmembers()
+                if not all(is_safe_member(member) for member in members):
+                    print("Invalid remote cache entry for {}. Ignoring.".format(target))
+                    return False
+                # Newer Python versions warn if no filter is set
+                archive.extraction_filter = getattr(tarfile, "data_filter", None)
+                archive.extractall(target_directory, members)
+            print(
+                "Fetched {} ({}) from the remote cache".format(
+                    target, format_size(os.path.getsize(archive_path))
+                )
+            )
+            return True
+        except (OSError, http.client.HTTPException, tarfile.TarError) as exc:
+            print("Could not fetch {} from the remote cache: {}".format(target, exc))
+            # Do not leave partially extracted files behind
+            shutil.rmtree(target_directory)
+            os.makedirs(target_directory)
+            return False
+        finally:
+            if os.path.isfile(archive_path):
+                os.remove(archive_path)
+
+    def store(self, target, fingerprint, target_directory):
+        if self.read_only:
+            return
+        archive_path = target_directory + ".remotecache.tar"
+        try:
+            # The artifacts are compressed already
+            with tarfile.open(archive_path, "w", format=tarfile.PAX_FORMAT) as archive:
+                for name in sorted(os.listdir(target_directory)):
+                    archive.add(os.path.join(target_directory, name), arcname=name)
+                members = archive.getmembers()
+            # It could never be fetched
+            if not all(is_safe_member(member) for member in members):
+                print(
+                    "Not storing {} in the remote cache, ".format(target)
+                    + "because it contains links to files outside of it"
+                )
+                return
+            self.backend.put(get_key(target, fingerprint), archive_path)
+            print(
+                "Stored {} ({}) in the remote cache".format(
+                    target, format_size(os.path.getsize(archive_path))
+                )
+            )
+        except (OSError, http.client.HTTPException, tarfile.TarError) as exc:
+            print("Could not store {} in the remote cache: {}".format(target, exc))
+        finally:
+            if os.path.isfile(archive_path):
+                os.remove(archive_path)
+
+
+def get_key(target, fingerprint):
+    return "{}/{}.tar".format(target, fingerprint)
+
+
+def get_remote_cache(config):
+    # The environment variable takes precedence over the configuration
+    section = config.get("remote_cache", {})
+    url = getenv("MAKELOVE_REMOTE_CACHE") or section.get("url")
+    if not url:
+        return None
+    if re.match(r"^https?://", url):
+        backend = HttpBackend(url)
+    else:
+        backend = DirectoryBackend(url)
+    return RemoteCache(backend, section.get("read_only", False))
@@ -1,12 +1,31 @@
 import sys
 import tempfile
 import atexit
+import contextvars
 import os
 import re
-from distutils.util import strtobool
+import threading
+import time
 
 import appdirs
 
+from .errors import ConfigError
+
+
+# The environment of a build, if it is not the one of the process: the daemon
+# uses the variables of the client, but can not set them in os.environ, because
+# it runs several builds at the same time.
+build_environment = contextvars.ContextVar("build_environment", default=None)
+
+
+def get_environment():
+    environment = build_environment.get()
+    return os.environ if environment == None else environment
+
+
+def getenv(name, default=None):
+    return get_environment().get(name, default)
+
 
 def eprint(*args, **kwargs):
     print(*args, **kwargs, file=sys.stderr)
@@ -29,10 +48,72 @@ def parse_love_version(version_str):
     if len(parts) == 3 and parts[0] == 0:
         parts = parts[1:]
     if len(parts) != 2:
-        sys.exit("Could not parse version '{}'".format(".".join(parts)))
+        raise ConfigError("Could not parse version '{}'".format(version_str))
     return parts
 
 
+def parse_size(size_str):
+    # Sizes with an optional suffix, e.g. "500M", "2G" or "1048576"
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kKmMgGtT]?)[bB]?\s*", size_str)
+    if not m:
+        raise ConfigError("Could not parse size '{}'".format(size_str))
+    factor = 1024 ** " KMGT".index(m.group(2).upper() or " ")
+    return int(float(m.group(1)) * factor)
+
+
+# 1980-01-01 00:00:00 UTC
+zip_epoch = 315532800
+
+
+def get_source_date_epoch(config):
+    """
+    The time (in seconds since the epoch) of all files in the archives of
+    reproducible builds or None if the build is not reproducible. Builds are
+    reproducible if 'reproducible' is true in the config or (if it is not
+    specified) if SOURCE_DATE_EPOCH is set, which also specifies the time.
+    """
+    epoch = getenv("SOURCE_DATE_EPOCH")
+    if not config.get("reproducible", epoch != None):
+        return None
+    if epoch == None:
+        return zip_epoch
+    try:
+        # zip files can not store earlier times
+        return max(int(epoch), zip_epoch)
+    except ValueError:
+        raise ConfigError(
+            "SOURCE_DATE_EPOCH has to be an integer, not '{}'".format(epoch)
+        )
+
+
+def get_archive_date_time(config):
+    # The date_time of zip entries in reproducible builds or None
+    epoch = get_source_date_epoch(config)
+    return None if epoch == None else time.gmtime(epoch)[:6]
+
+
+def format_size(num_bytes):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if num_bytes < 1024:
+            return "{:.1f} {}".format(num_bytes, unit)
+        num_bytes /= 1024
+    return "{:.1f} TB".format(num_bytes)
+
+
+# Only set by the plain command line build. Builds of the daemon, batch builds
+# and makelove.build can not ask questions, because their output is captured
+# or goes somewhere else than the terminal input() would read from.
+interactive = False
+
+
+def can_ask():
+    return (
+        interactive
+        and sys.stdin.isatty()
+        and threading.current_thread() is threading.main_thread()
+    )
+
+
 def ask_yes_no(question, default=None):
     if default == None:
         option_str = "[y/n]: "
@@ -47,9 +128,12 @@ def ask_yes_no(question, default=None):
         if choice == "" and default != None:
             return default
         else:
-            try:
-                return bool(strtobool(choice))
-            except ValueError:
+            # Same answers as distutils.util.strtobool, which is slow to import
+            if choice in ["y", "yes", "t", "true", "on", "1"]:
+                return True
+            elif choice in ["n", "no", "f", "false", "off", "0"]:
+                return False
+            else:
                 sys.stdout.write("Invalid answer.\n")
 
 
@@ -45,6 +45,17 @@ class String(object):
         return "String"
 
 
+class Int(object):
+    def validate(self, obj):
+        # bool is a subclass of int
+        if not isinstance(obj, int) or isinstance(obj, bool):
+            raise ValueError
+        return obj
+
+    def description(self):
+        return "Integer"
+
+
 class Any(object):
     def validate(self, obj):
         return obj
@@ -1,15 +1,21 @@
 import sys
 import os
 import shutil
-from zipfile import ZipFile
-from urllib.request import urlopen, urlretrieve, URLError
-from io import BytesIO
+from zipfile import ZipFile, BadZipFile, ZIP_DEFLATED
 import subprocess
 
 from PIL import Image, UnidentifiedImageError
-import appdirs
 
-from .util import get_default_love_binary_dir, get_download_url, tmpfile, eprint
+from .binarycache import CacheEntry, ensure, get_cache_dir, get_converted_file
+from .download import download, get_mirror
+from .errors import BuildError, DownloadError
+from .util import (
+    get_archive_date_time,
+    get_default_love_binary_dir,
+    get_download_url,
+    tmpfile,
+)
+from .ziputil import write_directory
 from .config import should_build_artifact
 
 
@@ -23,23 +29,19 @@ def common_prefix(l):
     )
 
 
-def download_love(version, platform):
-    target_path = get_default_love_binary_dir(version, platform)
-    print("Downloading love binaries to: '{}'".format(target_path))
-
-    os.makedirs(target_path, exist_ok=True)
+def download_love(version, platform, target_path, mirror=None):
     try:
         download_url = get_download_url(version, platform)
         print("Downloading '{}'..".format(download_url))
-        with urlopen(download_url) as response:
-            with ZipFile(BytesIO(response.read())) as zipfile:
-                zipfile.extractall(target_path)
-    except URLError as exc:
-        eprint("Could not download löve: {}".format(exc))
-        eprint(
-            "If there is in fact no download on GitHub for this version, specify 'love_binaries' manually."
+        zip_path = download(download_url, os.path.join(target_path, "love.zip"), mirror=mirror)
+        with ZipFile(zip_path) as zipfile:
+            zipfile.extractall(target_path)
+        os.remove(zip_path)
+    except (DownloadError, BadZipFile) as exc:
+        raise DownloadError(
+            "Could not download löve: {}\n".format(exc)
+            + "If there is in fact no download on GitHub for this version, specify 'love_binaries' manually."
         )
-        sys.exit(1)
 
     # There is usually a single directory in the zip files
     # Move the contents up one level, then delete the empty directory
@@ -48,24 +50,52 @@ def download_love(version, platform):
         shutil.move(os.path.join(subdir_path, element), target_path)
     os.rmdir(subdir_path)
 
-    print("Download complete")
+    print("Download of löve {} for {} complete".format(version, platform))
+
+
+def get_love_binaries_entry(config, target):
+    assert "love_version" in config
+    version = config["love_version"]
+    mirror = get_mirror(config)
+    return CacheEntry(
+        get_default_love_binary_dir(version, target),
+        lambda path: download_love(version, target, path, mirror),
+    )
 
 
 def get_rcedit_path():
-    return os.path.join(appdirs.user_cache_dir("makelove"), "rcedit-x64.exe")
+    return os.path.join(get_cache_dir(), "tools", "rcedit", "rcedit-x64.exe")
 
 
-def prepare_rcedit():
-    rcedit_path = get_rcedit_path()
-    if not os.path.isfile(rcedit_path):
-        try:
-            # I don't use the latest release, so I can be sure that the executable behaves as expected
-            rcedit_download_url = "https://github.com/electron/rcedit/releases/download/v1.1.1/rcedit-x64.exe"
-            os.makedirs(os.path.dirname(rcedit_path), exist_ok=True)
-            print("Downloading '{}'..".format(rcedit_download_url))
-            urlretrieve(rcedit_download_url, rcedit_path)
-        except URLError as exc:
-            sys.exit("Could not download rcedit: {}".format(exc))
+def download_rcedit(target_path, mirror=None):
+    try:
+        # I don't use the latest release, so I can be sure that the executable behaves as expected
+        rcedit_download_url = "https://github.com/electron/rcedit/releases/download/v1.1.1/rcedit-x64.exe"
+        print("Downloading '{}'..".format(rcedit_download_url))
+        download(
+            rcedit_download_url,
+            os.path.join(target_path, "rcedit-x64.exe"),
+            mirror=mirror,
+        )
+    except DownloadError as exc:
+        raise DownloadError("Could not download rcedit: {}".format(exc))
+
+
+def get_rcedit_entry(config):
+    mirror = get_mirror(config)
+    return CacheEntry(
+        os.path.dirname(get_rcedit_path()),
+        lambda path: download_rcedit(path, mirror),
+    )
+
+
+def get_downloads(config, target):
+    downloads = []
+    if not (target in config and "love_binaries" in config[target]):
+        downloads.append(get_love_binaries_entry(config, target))
+    if can_set_metadata(sys.platform):
+        downloads.append(get_rcedit_entry(config))
+    return downloads
 
 
 def can_set_metadata(platform):
@@ -128,16 +158,22 @@ def get_rcedit_command():
             try:
                 subprocess.run(["wine", "--version"], stdout=devnull)
             except FileNotFoundError:
-                eprint("Wine is required to produce Windows builds on macOS and Linux.")
+                message = "Wine is required to produce Windows builds on macOS and Linux."
                 if sys.platform.startswith("darwin"):
-                    eprint(
-                        "\nYou can install Wine with Homebrew:\n\n"
+                    message += (
+                        "\n\nYou can install Wine with Homebrew:\n\n"
                         "  brew cask install wine-stable"
                     )
-                sys.exit(1)
+                raise BuildError(message)
         return ["wine", rcedit_path]
     else:
-        sys.exit("Can not execute rcedit on ths platform ({})".format(sys.platform))
+        raise BuildError(
+            "Can not execute rcedit on ths platform ({})".format(sys.platform)
+        )
+
+
+def convert_to_ico(image_path, ico_path):
+    Image.open(image_path).save(ico_path)
 
 
 def set_exe_metadata(exe_path, metadata, icon_file):
@@ -146,43 +182,33 @@ def set_exe_metadata(exe_path, metadata, icon_file):
     for k, v in metadata.items():
         args.extend(["--set-version-string", k, v])
 
-    temp_ico_path = None
     if icon_file != None:
         if not os.path.isfile(icon_file):
-            sys.exit("Icon file does not exist '{}'".format(icon_file))
+            raise BuildError("Icon file does not exist '{}'".format(icon_file))
         if icon_file.lower().endswith(".ico"):
             args.extend(["--set-icon", icon_file])
         else:
             try:
-                img = Image.open(icon_file)
-                temp_ico_path = tmpfile(".ico")
-                img.save(temp_ico_path)
-                args.extend(["--set-icon", temp_ico_path])
+                ico_path = get_converted_file(icon_file, "icons", ".ico", convert_to_ico)
+                args.extend(["--set-icon", ico_path])
             except FileNotFoundError as exc:
-                sys.exit("Could not find icon file: {}".format(exc))
+                raise BuildError("Could not find icon file: {}".format(exc))
             except UnidentifiedImageError as exc:
-                sys.exit("Could not read icon file: {}".format(exc))
+                raise BuildError("Could not read icon file: {}".format(exc))
             except IOError as exc:
-                sys.exit("Could not convert icon to .ico: {}".format(exc))
+                raise BuildError("Could not convert icon to .ico: {}".format(exc))
 
     res = subprocess.run(args, capture_output=True)
-    if temp_ico_path:
-        os.remove(temp_ico_path)
     if res.returncode != 0:
-        sys.exit("Could not set exe metadata:\n" + res.stderr.decode("utf-8"))
+        raise BuildError("Could not set exe metadata:\n" + res.stderr.decode("utf-8"))
 
 
 def build_windows(config, version, target, target_directory, love_file_path):
     if target in config and "love_binaries" in config[target]:
         love_binaries = config[target]["love_binaries"]
     else:
-        assert "love_version" in config
         print("No love binaries specified for target {}".format(target))
-        love_binaries = get_default_love_binary_dir(config["love_version"], target)
-        if os.path.isdir(love_binaries):
-            print("Love binaries already present in '{}'".format(love_binaries))
-        else:
-            download_love(config["love_version"], target)
+        love_binaries = ensure(get_love_binaries_entry(config, target))
 
     temp_archive_dir = os.path.join(target_directory, "archive_temp")
     os.makedirs(temp_archive_dir)
@@ -191,37 +217,46 @@ def build_windows(config, version, target, target_directory, love_file_path):
     dest = lambda x: os.path.join(temp_archive_dir, x)
     copy = lambda x: shutil.copyfile(src(x), dest(x))
 
-    if not os.path.isfile(src("love_orig.exe")):
-        # Copy metadata too, because we are making a backup
-        shutil.copy2(src("love.exe"), src("love_orig.exe"))
-
     target_exe_path = dest("{}.exe".format(config["name"]))
 
-    if can_set_metadata(sys.platform):
-        prepare_rcedit()
-
-        metadata = get_exe_metadata(config, version)
-
-        # Default value is "löve.exe" of course.
-        # This value is used to determine if an executable has been renamed
-        if not "OriginalFilename" in metadata:
-            metadata["OriginalFilename"] = os.path.basename(target_exe_path)
+    # The metadata is set on a copy, so the love binaries are never modified and
+    # can be shared between concurrent builds
+    love_exe_path = src("love.exe")
+    temp_exe_path = None
 
-        set_exe_metadata(
-            src("love.exe"), metadata, config.get("icon_file", None),
-        )
-    else:
-        print(
-            "Cannot set exe metadata on this platform ({})".format(sys.platform),
-            file=sys.stderr,
-        )
-        print("If you are using a POSIX-compliant system, try installing WINE.")
-
-    with open(target_exe_path, "wb") as fused:
-        with open(src("love.exe"), "rb") as loveExe:
-            with open(love_file_path, "rb") as loveZip:
-                fused.write(loveExe.read())
-                fused.write(loveZip.read())
+    try:
+        if can_set_metadata(sys.platform):
+            ensure(get_rcedit_entry(config))
+
+            metadata = get_exe_metadata(config, version)
+
+            # Default value is "löve.exe" of course.
+            # This value is used to determine if an executable has been renamed
+            if not "OriginalFilename" in metadata:
+                metadata["OriginalFilename"] = os.path.basename(target_exe_path)
+
+            temp_exe_path = tmpfile(suffix=".exe")
+            shutil.copyfile(love_exe_path, temp_exe_path)
+            set_exe_metadata(
+                temp_exe_path, metadata, config.get("icon_file", None),
+            )
+            love_exe_path = temp_exe_path
+        else:
+            print(
+                "Cannot set exe metadata on this platform ({})".format(sys.platform),
+                file=sys.stderr,
+            )
+            print("If you are using a POSIX-compliant system, try installing WINE.")
+
+        with open(target_exe_path, "wb") as fused:
+            with open(love_exe_path, "rb") as loveExe:
+                with open(love_file_path, "rb") as loveZip:
+                    fused.write(loveExe.read())
+                    fused.write(loveZip.read())
+    finally:
+        # Not only at exit, a batch or the daemon builds many times in one process
+        if temp_exe_path != None:
+            os.remove(temp_exe_path)
 
     copy("license.txt")
     for f in os.listdir(love_binaries):
@@ -242,7 +277,7 @@ def build_windows(config, version, target, target_directory, love_file_path):
         elif os.path.isdir(k):
             shutil.copytree(k, path)
         else:
-            sys.exit("Cannot copy archive file '{}'".format(k))
+            raise BuildError("Cannot copy archive file '{}'".format(k))
 
     if target in config and "shared_libraries" in config[target]:
         for f in config[target]["shared_libraries"]:
@@ -250,9 +285,10 @@ def build_windows(config, version, target, target_directory, love_file_path):
 
     if should_build_artifact(config, target, "archive", True):
         archive_path = os.path.join(
-            target_directory, "{}-{}".format(config["name"], target)
+            target_directory, "{}-{}.zip".format(config["name"], target)
         )
-        shutil.make_archive(archive_path, "zip", temp_archive_dir)
+        with ZipFile(archive_path, "w", compression=ZIP_DEFLATED) as archive:
+            write_directory(archive, temp_archive_dir, get_archive_date_time(config))
 
     if should_build_artifact(config, target, "directory", False):
         os.rename(temp_archive_dir, os.path.join(target_directory, config["name"]))
@@ -0,0 +1,153 @@
+import os
+import shutil
+import stat
+import struct
+import time
+import zipfile
+from zipfile import ZipInfo
+
+# zipfile does not expose a way to copy an entry without decompressing and
+# recompressing it, so these functions use its (stable) internals, the same
+# way ZipFile.write and ZipFile.mkdir do.
+
+_MASK_ENCRYPTED = 0x01
+_MASK_USE_DATA_DESCRIPTOR = 0x08
+
+copy_chunk_size = 1024 * 1024
+
+
+def _raw_entry_data_offset(zip_file, zipinfo):
+    zip_file.fp.seek(zipinfo.header_offset)
+    header = zip_file.fp.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader:
+        raise zipfile.BadZipFile("Truncated file header")
+    fields = struct.unpack(zipfile.structFileHeader, header)
+    if fields[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad magic number for file header")
+    return (
+        zipinfo.header_offset
+        + zipfile.sizeFileHeader
+        + fields[zipfile._FH_FILENAME_LENGTH]
+        + fields[zipfile._FH_EXTRA_FIELD_LENGTH]
+    )
+
+
+def copy_entry_raw(src_zip, src_info, dst_zip, arcname=None, date_time=None):
+    """
+    Copies the entry described by src_info from src_zip into dst_zip without
+    decompressing it. The compressed bytes, CRC, compression method and
+    external attributes (permissions, symlinks) are taken over unchanged.
+    Only the name and the modification time may be changed.
+    """
+    if src_info.flag_bits & _MASK_ENCRYPTED:
+        raise ValueError("Cannot copy encrypted entry '{}'".format(src_info.filename))
+
+    zinfo = ZipInfo(arcname or src_info.filename, date_time or src_info.date_time)
+    zinfo.compress_type = src_info.compress_type
+    zinfo.flag_bits = src_info.flag_bits & ~_MASK_USE_DATA_DESCRIPTOR
+    zinfo.CRC = src_info.CRC
+    zinfo.compress_size = src_info.compress_size
+    zinfo.file_size = src_info.file_size
+    zinfo.create_system = src_info.create_system
+    zinfo.create_version = src_info.create_version
+    zinfo.extract_version = max(src_info.extract_version, zinfo.extract_version)
+    zinfo.internal_attr = src_info.internal_attr
+    zinfo.external_attr = src_info.external_attr
+    zinfo.comment = src_info.comment
+
+    with src_zip._lock, dst_zip._lock:
+        if dst_zip._writing:
+            raise ValueError("Can't copy to ZIP archive while an open writing handle exists")
+
+        data_offset = _raw_entry_data_offset(src_zip, src_info)
+
+        if dst_zip._seekable:
+            dst_zip.fp.seek(dst_zip.start_dir)
+        zinfo.header_offset = dst_zip.fp.tell()
+        dst_zip._writecheck(zinfo)
+        dst_zip._didModify = True
+        dst_zip.fp.write(zinfo.FileHeader())
+
+        src_zip.fp.seek(data_offset)
+        remaining = src_info.compress_size
+        while remaining > 0:
+            chunk = src_zip.fp.read(min(copy_chunk_size, remaining))
+            if not chunk:
+                raise zipfile.BadZipFile(
+                    "Truncated data for entry '{}'".format(src_info.filename)
+                )
+            remaining -= len(chunk)
+            dst_zip.fp.write(chunk)
+
+        dst_zip.filelist.append(zinfo)
+        dst_zip.NameToInfo[zinfo.filename] = zinfo
+        dst_zip.start_dir = dst_zip.fp.tell()
+    return zinfo
+
+
+def normalize_zipinfo(zinfo, date_time):
+    """
+    Removes everything from an entry that depends on the file system instead of
+    the content: The modification time is set to date_time and the permissions
+    only keep whether the file is executable. Symlinks are kept.
+    """
+    zinfo.date_time = date_time
+    mode = zinfo.external_attr >> 16
+    if stat.S_ISLNK(mode):
+        return zinfo
+    if zinfo.is_dir():
+        zinfo.external_attr = (stat.S_IFDIR | 0o755) << 16 | 0x10  # MS-DOS directory
+    else:
+        permissions = 0o755 if mode & 0o111 else 0o644
+        zinfo.external_attr = (stat.S_IFREG | permissions) << 16
+    return zinfo
+
+
+def new_zipinfo(zip_file, arcname, date_time=None):
+    # The ZipInfo ZipFile.writestr creates for a name, but with the given time
+    zinfo = ZipInfo(arcname, date_time or time.localtime(time.time())[:6])
+    zinfo.compress_type = zip_file.compression
+    zinfo._compresslevel = zip_file.compresslevel
+    zinfo.external_attr = 0o600 << 16
+    return zinfo
+
+
+def write_file_streamed(zip_file, path, arcname, date_time=None, reproducible=False):
+    """
+    Writes the file at path into zip_file in chunks, so that memory usage
+    does not depend on the size of the file. If reproducible is true, the
+    entry is normalized with normalize_zipinfo.
+    """
+    zinfo = ZipInfo.from_file(path, arcname)
+    if reproducible:
+        normalize_zipinfo(zinfo, date_time)
+    elif date_time != None:
+        zinfo.date_time = date_time
+    zinfo.compress_type = zip_file.compression
+    zinfo._compresslevel = zip_file.compresslevel
+    with open(path, "rb") as src, zip_file.open(zinfo, "w", force_zip64=True) as dst:
+        shutil.copyfileobj(src, dst, copy_chunk_size)
+    return zinfo
+
+
+def write_directory(zip_file, directory, date_time=None):
+    """
+    Writes all files and directories in directory into zip_file in sorted
+    order (unlike shutil.make_archive). If date_time is given, the entries are
+    normalized (see normalize_zipinfo), so the archive only depends on the
+    contents of the files.
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            path = os.path.join(root, name)
+            arcname = os.path.relpath(path, directory)
+            if os.path.isdir(path):
+                zinfo = ZipInfo.from_file(path, arcname)
+                if date_time != None:
+                    normalize_zipinfo(zinfo, date_time)
+                zip_file.writestr(zinfo, b"")
+            else:
+                write_file_streamed(
+                    zip_file, path, arcname, date_time, reproducible=date_time != None
+                )
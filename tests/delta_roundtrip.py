@@ -0,0 +1,90 @@
+# Checks that makelove.delta.apply_delta rebuilds the new file from the old one
+# and a delta from write_delta and that small changes produce small deltas.
+# Run with: python tests/delta_roundtrip.py
+import io
+import os
+import random
+import struct
+
+from makelove import delta
+
+
+def make_delta(old, new):
+    out = io.BytesIO()
+    size = delta.write_delta(delta.index_chunks(io.BytesIO(old)), io.BytesIO(new), out)
+    assert size == len(out.getvalue())
+    return out.getvalue()
+
+
+def apply(old, delta_data):
+    out = io.BytesIO()
+    delta.apply_delta(io.BytesIO(old), io.BytesIO(delta_data), out)
+    return out.getvalue()
+
+
+def get_copy_lengths(delta_data):
+    lengths = []
+    f = io.BytesIO(delta_data)
+    assert f.read(len(delta.delta_magic)) == delta.delta_magic
+    while True:
+        op = f.read(1)
+        if op == b"":
+            return lengths
+        elif op == delta.copy_op:
+            lengths.append(struct.unpack("<QI", f.read(12))[1])
+        else:
+            f.seek(struct.unpack("<I", f.read(4))[0], os.SEEK_CUR)
+
+
+def random_bytes(n):
+    return random.getrandbits(n * 8).to_bytes(n, "little")
+
+
+random.seed(1)
+words = [random_bytes(random.randint(2, 10)).hex().encode() for _ in range(2000)]
+text = b" ".join(random.choice(words) for _ in range(400000))
+contents = {"random": random_bytes(5 * 1024 * 1024), "text": text}
+
+for name, old in contents.items():
+    middle = len(old) // 2
+    cases = {
+        "identical": old,
+        "insert": old[:middle] + b"inserted" * 20 + old[middle:],
+        "delete": old[:middle] + old[middle + 5000 :],
+        "append": old + b"appended" * 100,
+        "prepend": b"prepended" + old,
+        "empty": b"",
+    }
+    for case, new in cases.items():
+        delta_data = make_delta(old, new)
+        assert apply(old, delta_data) == new, (name, case)
+        # A few chunks around the change at most
+        assert len(delta_data) < 4 * delta.max_chunk_size, (name, case)
+        print("{:<7} {:<10} {:>8} bytes".format(name, case, len(delta_data)))
+
+    # The whole file is copied at once
+    assert get_copy_lengths(make_delta(old, old)) == [len(old)]
+
+    # Everything is new
+    new = random_bytes(1024 * 1024)
+    assert apply(old, make_delta(old, new)) == new
+    assert apply(b"", make_delta(b"", new)) == new
+
+# Merged copies are split to fit into the length of a copy operation
+max_copy_length = delta.max_copy_length
+delta.max_copy_length = 1024 * 1024
+old = contents["random"]
+delta_data = make_delta(old, old)
+assert max(get_copy_lengths(delta_data)) <= delta.max_copy_length
+assert sum(get_copy_lengths(delta_data)) == len(old)
+assert apply(old, delta_data) == old
+delta.max_copy_length = max_copy_length
+
+# Truncated deltas are detected
+try:
+    apply(old, make_delta(old, old + b"new")[:-1])
+    assert False, "Truncated delta not detected"
+except ValueError as exc:
+    print("Expected error:", exc)
+
+print("All delta tests passed")
@@ -0,0 +1,122 @@
+# Tests makelove.download against a local HTTP server that supports Range requests
+# and drops the connection in the middle of the first response or is busy.
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from makelove.download import download, DownloadError
+
+content = os.urandom(3 * 1024 * 1024 + 123)
+content_sha256 = hashlib.sha256(content).hexdigest()
+requests = []
+
+
+def requests_for(path):
+    return [r for r in requests if r[0] == path]
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        requests.append((self.path, self.headers.get("Range")))
+        if self.path == "/file.zip.sha256":
+            body = "{}  file.zip\n".format(content_sha256).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        elif self.path == "/bad.zip.sha256":
+            body = ("0" * 64).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        elif self.path == "/changing.zip":
+            body = content if len(requests_for(self.path)) == 1 else b"changed"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        elif self.path == "/busy.zip" and len(requests_for(self.path)) == 1:
+            self.send_error(503)
+            return
+        elif self.path not in ["/file.zip", "/bad.zip", "/busy.zip"]:
+            self.send_error(404)
+            return
+
+        start = 0
+        m = re.match(r"bytes=(\d+)-", self.headers.get("Range") or "")
+        if m:
+            start = int(m.group(1))
+            self.send_response(206)
+            self.send_header(
+                "Content-Range",
+                "bytes {}-{}/{}".format(start, len(content) - 1, len(content)),
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+
+        if self.path != "/busy.zip" and len(requests_for(self.path)) == 1:
+            # First request: only send half and drop the connection
+            self.wfile.write(content[start : len(content) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(content[start:])
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base_url = "http://127.0.0.1:{}".format(server.server_address[1])
+
+with tempfile.TemporaryDirectory() as tmp:
+    path = download(base_url + "/file.zip", os.path.join(tmp, "file.zip"))
+    with open(path, "rb") as f:
+        assert f.read() == content
+    assert not os.path.exists(path + ".part")
+    file_requests = [r for r in requests if r[0] == "/file.zip"]
+    assert file_requests[0][1] == None
+    assert file_requests[1][1] == "bytes={}-".format(len(content) // 2)
+
+    try:
+        download(base_url + "/bad.zip", os.path.join(tmp, "bad.zip"))
+        assert False, "Checksum mismatch not detected"
+    except DownloadError as exc:
+        print("Expected error:", exc)
+    assert not os.path.exists(os.path.join(tmp, "bad.zip"))
+    assert not os.path.exists(os.path.join(tmp, "bad.zip.part"))
+
+    # Errors of the server are retried, but a missing file is not
+    path = download(base_url + "/busy.zip", os.path.join(tmp, "busy.zip"), content_sha256)
+    with open(path, "rb") as f:
+        assert f.read() == content
+    assert len(requests_for("/busy.zip")) == 2
+
+    try:
+        download(base_url + "/missing.zip", os.path.join(tmp, "missing.zip"))
+        assert False, "404 not detected"
+    except DownloadError as exc:
+        print("Expected error:", exc)
+    assert len(requests_for("/missing.zip")) == 1
+
+    # Files without a known digest are checked against the first download
+    download(base_url + "/changing.zip", os.path.join(tmp, "changing.zip"))
+    os.remove(os.path.join(tmp, "changing.zip"))
+    try:
+        download(base_url + "/changing.zip", os.path.join(tmp, "changing.zip"))
+        assert False, "Changed file not detected"
+    except DownloadError as exc:
+        print("Expected error:", exc)
+    assert not os.path.exists(os.path.join(tmp, "changing.zip"))
+
+server.shutdown()
+print("All download tests passed")
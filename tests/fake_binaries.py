@@ -0,0 +1,27 @@
+# Creates fake löve binaries for tests that build games without downloading
+# anything. Use them with love_binaries = <path>/<target>.
+import os
+import zipfile
+
+
+def create_binaries(path):
+    win64 = os.path.join(path, "win64")
+    os.makedirs(win64)
+    for name in ["love.exe", "love.dll", "lua51.dll", "license.txt"]:
+        with open(os.path.join(win64, name), "wb") as f:
+            f.write(name.encode("utf-8") * 100)
+
+    macos = os.path.join(path, "macos")
+    os.makedirs(macos)
+    with zipfile.ZipFile(os.path.join(macos, "love.zip"), "w") as love_zip:
+        love_zip.writestr("love.app/Contents/Info.plist", b"")
+        love_zip.writestr("love.app/Contents/MacOS/love", b"love" * 100)
+
+    lovejs = os.path.join(path, "lovejs")
+    os.makedirs(lovejs)
+    with zipfile.ZipFile(os.path.join(lovejs, "love.zip"), "w") as love_zip:
+        love_zip.writestr("love.js-master/", b"")
+        love_zip.writestr("love.js-master/src/game.js", b"{{{metadata}}}")
+        love_zip.writestr("love.js-master/src/compat/index.html", b"{{{title}}}")
+        for name in ["love.js", "love.wasm", "theme/love.css", "theme/bg.png"]:
+            love_zip.writestr("love.js-master/src/compat/" + name, name)
@@ -0,0 +1,42 @@
+# Checks that the peak memory usage of build_macos does not depend on the size
+# of the game. Run with: python tests/macos_memory.py [game size in MB]
+import os
+import sys
+import tempfile
+import tracemalloc
+import zipfile
+
+from makelove.macos import build_macos
+
+game_size = int(sys.argv[1] if len(sys.argv) > 1 else 256) * 1024 * 1024
+max_peak = 16 * 1024 * 1024
+
+with tempfile.TemporaryDirectory() as tmp:
+    binaries_dir = os.path.join(tmp, "binaries")
+    target_dir = os.path.join(tmp, "macos")
+    os.makedirs(binaries_dir)
+    os.makedirs(target_dir)
+
+    with zipfile.ZipFile(os.path.join(binaries_dir, "love.zip"), "w") as love_zip:
+        love_zip.writestr("love.app/Contents/Info.plist", b"")
+        love_zip.writestr("love.app/Contents/MacOS/love", os.urandom(1024 * 1024))
+
+    love_file_path = os.path.join(tmp, "game.love")
+    with open(love_file_path, "wb") as f:
+        f.truncate(game_size)
+
+    config = {
+        "name": "game",
+        "love_version": "11.4",
+        "macos": {"love_binaries": binaries_dir},
+    }
+
+    tracemalloc.start()
+    build_macos(config, None, "macos", target_dir, love_file_path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("Game size: {} MB, peak memory: {:.2f} MB".format(
+        game_size // (1024 * 1024), peak / (1024 * 1024)
+    ))
+    assert peak < max_peak
@@ -0,0 +1,156 @@
+# Tests the remote build cache with a local HTTP server (that stores the entries
+# in memory) and a directory. Uses fake löve binaries, so no downloads are needed.
+# Run with: python tests/remote_cache.py
+import filecmp
+import os
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import makelove
+from fake_binaries import create_binaries
+from makelove.remotecache import DirectoryBackend, RemoteCache
+
+targets = ["win64", "macos"]
+entries = {}
+requests = []
+failing = False
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if failing:
+            self.send_error(500)
+            return
+        requests.append(("GET", self.path, self.path in entries))
+        if not self.path in entries:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(entries[self.path])))
+        self.end_headers()
+        self.wfile.write(entries[self.path])
+
+    def do_PUT(self):
+        if failing:
+            self.send_error(500)
+            return
+        requests.append(("PUT", self.path, True))
+        entries[self.path] = self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def build(project_dir, binaries, url, main="print('hello')\n"):
+    os.makedirs(project_dir, exist_ok=True)
+    with open(os.path.join(project_dir, "main.lua"), "w") as f:
+        f.write(main)
+    config = {
+        "name": "game",
+        "love_version": "11.4",
+        "love_files": ["*", "-./makelove-build/*"],
+        "remote_cache": {"url": url},
+        # So targets that are built again are identical to the cached ones
+        "reproducible": True,
+        "win64": {"love_binaries": os.path.join(binaries, "win64")},
+        "macos": {"love_binaries": os.path.join(binaries, "macos")},
+    }
+    return makelove.build(project_dir, config, targets=targets, disabled_hooks=["all"])
+
+
+def get_artifacts(result):
+    return {
+        os.path.relpath(artifact.path, result.build_directory): artifact.path
+        for target in result.targets
+        for artifact in target.artifacts
+    }
+
+
+def assert_same_artifacts(first, second):
+    first_artifacts, second_artifacts = get_artifacts(first), get_artifacts(second)
+    assert sorted(first_artifacts) == sorted(second_artifacts)
+    for name in first_artifacts:
+        assert filecmp.cmp(
+            first_artifacts[name], second_artifacts[name], shallow=False
+        ), name
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url = "http://127.0.0.1:{}/cache".format(server.server_address[1])
+
+with tempfile.TemporaryDirectory() as tmp:
+    binaries = os.path.join(tmp, "binaries")
+    create_binaries(binaries)
+
+    # A fresh checkout on another machine (at another path) uses the entries
+    first = build(os.path.join(tmp, "first"), binaries, url)
+    assert [r[0] for r in requests] == ["GET", "PUT", "GET", "PUT"], requests
+    del requests[:]
+    second = build(os.path.join(tmp, "second"), binaries, url)
+    assert all(hit for _method, _path, hit in requests), requests
+    assert [r[0] for r in requests] == ["GET", "GET"], requests
+    assert_same_artifacts(first, second)
+
+    # A change in the game is a cache miss
+    del requests[:]
+    build(os.path.join(tmp, "second"), binaries, url, main="print('changed')\n")
+    assert [r[0] for r in requests] == ["GET", "PUT", "GET", "PUT"], requests
+    assert len(entries) == 4
+
+    # Errors of the server do not fail the build
+    failing = True
+    build(os.path.join(tmp, "third"), binaries, url)
+    failing = False
+
+    # Directory backend, configured by the environment variable
+    cache_dir = os.path.join(tmp, "shared")
+    os.environ["MAKELOVE_REMOTE_CACHE"] = cache_dir
+    del requests[:]
+    first = build(os.path.join(tmp, "fourth"), binaries, url)
+    assert len(os.listdir(os.path.join(cache_dir, "win64"))) == 1
+    assert len(os.listdir(os.path.join(cache_dir, "macos"))) == 1
+    shutil.rmtree(os.path.join(cache_dir, "macos"))
+    second = build(os.path.join(tmp, "fifth"), binaries, url)
+    assert len(os.listdir(os.path.join(cache_dir, "macos"))) == 1
+    assert requests == []
+    assert_same_artifacts(first, second)
+    del os.environ["MAKELOVE_REMOTE_CACHE"]
+
+    # Builds with a different SOURCE_DATE_EPOCH do not use the same entries
+    del requests[:]
+    os.environ["SOURCE_DATE_EPOCH"] = "1700000000"
+    build(os.path.join(tmp, "first"), binaries, url)
+    del os.environ["SOURCE_DATE_EPOCH"]
+    assert [r[0] for r in requests] == ["GET", "PUT", "GET", "PUT"], requests
+
+    # Relative symlinks inside the artifacts (e.g. of an AppDir) are restored
+    target_directory = os.path.join(tmp, "links", "appimage")
+    os.makedirs(os.path.join(target_directory, "AppDir", "usr", "bin"))
+    with open(os.path.join(target_directory, "AppDir", "usr", "bin", "game"), "w") as f:
+        f.write("game")
+    os.symlink("usr/bin/game", os.path.join(target_directory, "AppDir", "AppRun"))
+    remote_cache = RemoteCache(DirectoryBackend(os.path.join(tmp, "links_cache")))
+    remote_cache.store("appimage", "links", target_directory)
+    shutil.rmtree(target_directory)
+    os.makedirs(target_directory)
+    assert remote_cache.fetch("appimage", "links", target_directory)
+    app_run = os.path.join(target_directory, "AppDir", "AppRun")
+    assert os.readlink(app_run) == "usr/bin/game"
+    with open(app_run) as f:
+        assert f.read() == "game"
+
+    # But not ones that point outside of the target directory
+    shutil.rmtree(target_directory)
+    os.makedirs(target_directory)
+    os.symlink("../../outside", os.path.join(target_directory, "link"))
+    remote_cache.store("appimage", "outside", target_directory)
+    assert os.listdir(os.path.join(tmp, "links_cache", "appimage")) == ["links.tar"]
+
+server.shutdown()
+print("All remote cache tests passed")
@@ -0,0 +1,73 @@
+# Checks that two reproducible builds of the same game are byte-identical, even
+# if the files have different modification times and permissions.
+# Uses fake löve binaries, so no downloads are needed.
+# Run with: python tests/reproducible.py
+import filecmp
+import os
+import tempfile
+import time
+
+import makelove
+from fake_binaries import create_binaries
+
+targets = ["win64", "macos", "lovejs"]
+
+
+def create_game(path, mtime, mode):
+    files = {
+        "main.lua": "require('lib.util')\n",
+        "lib/util.lua": "return {}\n",
+        "assets/data.txt": "data" * 1000,
+        "README.md": "readme",
+    }
+    for name, content in files.items():
+        file_path = os.path.join(path, name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w") as f:
+            f.write(content)
+        os.chmod(file_path, mode)
+        os.utime(file_path, (mtime, mtime))
+
+
+def build(tmp, name, binaries, mtime, mode):
+    project_dir = os.path.join(tmp, name)
+    create_game(project_dir, mtime, mode)
+    config = {
+        "name": "game",
+        "love_version": "11.4",
+        "love_files": ["*", "-./README.md"],
+        "reproducible": True,
+        "archive_files": {"README.md": "README.md"},
+        "win64": {"love_binaries": os.path.join(binaries, "win64")},
+        "macos": {"love_binaries": os.path.join(binaries, "macos")},
+        "lovejs": {"love_binaries": os.path.join(binaries, "lovejs")},
+    }
+    return makelove.build(project_dir, config, targets=targets, disabled_hooks=["all"])
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    binaries = os.path.join(tmp, "binaries")
+    create_binaries(binaries)
+
+    first = build(tmp, "first", binaries, time.time() - 3600, 0o644)
+    time.sleep(1.1)  # zip timestamps have a resolution of two seconds
+    second = build(tmp, "second", binaries, time.time(), 0o664)
+
+    def get_artifacts(result):
+        artifacts = {"love": result.love_file}
+        for target in result.targets:
+            for artifact in target.artifacts:
+                name = os.path.relpath(artifact.path, result.build_directory)
+                artifacts[name] = artifact.path
+        return artifacts
+
+    first_artifacts, second_artifacts = get_artifacts(first), get_artifacts(second)
+    assert sorted(first_artifacts) == sorted(second_artifacts)
+    different = [
+        name
+        for name in sorted(first_artifacts)
+        if not filecmp.cmp(first_artifacts[name], second_artifacts[name], shallow=False)
+    ]
+    for name in sorted(first_artifacts):
+        print("{:<10} {}".format("DIFFERENT" if name in different else "same", name))
+    assert different == [], "Artifacts differ: {}".format(different)
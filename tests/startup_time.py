@@ -0,0 +1,76 @@
+# Checks that the short running commands (--version, --check) do not import the
+# target modules, Pillow or the network stack and reports how long they take.
+# Run with: python tests/startup_time.py [runs]
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+runs = int(sys.argv[1] if len(sys.argv) > 1 else 5)
+max_time = 0.5  # seconds, generous so slow CI machines do not fail
+
+heavy_modules = [
+    "PIL",
+    "urllib.request",
+    "http.client",
+    "plistlib",
+    "pkg_resources",
+    "distutils",
+    "makelove.windows",
+    "makelove.linux",
+    "makelove.macos",
+    "makelove.lovejs",
+    "makelove.download",
+    "makelove.hooks",
+]
+
+check_modules = """
+import json, sys
+from makelove.makelove import main
+sys.argv = ["makelove"] + sys.argv[1:]
+try:
+    main()
+except SystemExit:
+    pass
+sys.stdout = sys.__stdout__
+print(json.dumps([m for m in {} if m in sys.modules]))
+""".format(
+    heavy_modules
+)
+
+
+def run(args, cwd):
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", check_modules] + args,
+        cwd=cwd,
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+    return time.perf_counter() - start, json.loads(output.strip().splitlines()[-1])
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    with open(os.path.join(tmp, "main.lua"), "w") as f:
+        f.write("function love.draw() end\n")
+    with open(os.path.join(tmp, "makelove.toml"), "w") as f:
+        f.write('name = "game"\ndefault_targets = ["win64", "macos"]\n')
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+    baseline = (time.perf_counter() - start) / runs
+    print("Python startup: {:.0f} ms".format(baseline * 1000))
+
+    for args in [["--version"], ["--check"]]:
+        times = []
+        for _ in range(runs):
+            duration, imported = run(args, tmp)
+            assert imported == [], "{} imported {}".format(args, imported)
+            times.append(duration)
+        median = sorted(times)[len(times) // 2]
+        print("makelove {}: {:.0f} ms".format(" ".join(args), median * 1000))
+        assert median < baseline + max_time